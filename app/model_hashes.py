@@ -0,0 +1,235 @@
+from __future__ import annotations
+
+import hashlib
+import json
+import logging
+import os
+import sys
+import threading
+import time
+from typing import Callable, Optional
+
+import folder_paths
+import comfy.utils
+
+INDEX_VERSION = 1
+CHUNK_SIZE = 16 * 1024 * 1024
+SAFETENSORS_EXTENSIONS = (".safetensors", ".sft")
+EXCLUDED_FOLDERS = ["configs", "custom_nodes"]
+
+
+def file_stat(path: str) -> tuple[int, int]:
+    stat = os.stat(path)
+    return stat.st_size, stat.st_mtime_ns
+
+
+def header_sha256(path: str) -> str | None:
+    if not path.lower().endswith(SAFETENSORS_EXTENSIONS):
+        return None
+    try:
+        header = comfy.utils.safetensors_header(path)
+    except Exception:
+        return None
+    if header is None:
+        return None
+    return hashlib.sha256(header).hexdigest()
+
+
+class ModelHashIndex:
+    """
+    Index of the sha256 of the model files in the registered model folders, keyed by absolute path.
+    Entries are only valid while the size and mtime of the file match the ones that were hashed so
+    changed files are hashed again on the next scan. The index is saved to a json file so files only
+    ever get hashed once.
+    """
+    def __init__(self, index_path: str | None = None) -> None:
+        self.index_path = index_path
+        self.entries: dict[str, dict] = {}
+        self.models: dict[str, tuple[str, str]] = {}
+        self.lock = threading.Lock()
+        self.dirty = False
+        self.busy: Callable[[], bool] = lambda: False
+        self.stop_event = threading.Event()
+        self.thread: Optional[threading.Thread] = None
+        if index_path is not None:
+            self.load(index_path)
+
+    def load(self, index_path: str) -> None:
+        self.index_path = index_path
+        if not os.path.isfile(index_path):
+            return
+        try:
+            with open(index_path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+            if data.get("version", None) != INDEX_VERSION:
+                return
+            with self.lock:
+                self.entries = data.get("files", {})
+        except Exception as e:
+            logging.warning(f"Could not load the model hash index {index_path}: {e}")
+
+    def save(self) -> None:
+        if self.index_path is None:
+            return
+        with self.lock:
+            if not self.dirty:
+                return
+            data = {"version": INDEX_VERSION, "files": dict(self.entries)}
+            self.dirty = False
+        try:
+            os.makedirs(os.path.dirname(self.index_path), exist_ok=True)
+            temp_path = f"{self.index_path}.tmp"
+            with open(temp_path, "w", encoding="utf-8") as f:
+                json.dump(data, f)
+            os.replace(temp_path, self.index_path)
+        except Exception as e:
+            logging.warning(f"Could not save the model hash index {self.index_path}: {e}")
+
+    def get_entry(self, path: str) -> dict | None:
+        """Returns the index entry of the file if it is indexed and didn't change since, without touching the file contents."""
+        path = os.path.abspath(path)
+        with self.lock:
+            entry = self.entries.get(path, None)
+        if entry is None:
+            return None
+        try:
+            size, mtime = file_stat(path)
+        except OSError:
+            return None
+        if entry["size"] != size or entry["mtime"] != mtime:
+            return None
+        return entry
+
+    def hash_file(self, path: str, throttle: bool = False) -> dict | None:
+        """Hashes the file and adds it to the index. Returns None if the file changed or disappeared while it was read."""
+        path = os.path.abspath(path)
+        try:
+            size, mtime = file_stat(path)
+            h = hashlib.sha256()
+            with open(path, "rb") as f:
+                while not self.stop_event.is_set():
+                    while throttle and self.busy() and not self.stop_event.is_set():
+                        self.stop_event.wait(1.0)
+                    data = f.read(CHUNK_SIZE)
+                    if len(data) == 0:
+                        break
+                    h.update(data)
+            if self.stop_event.is_set() or file_stat(path) != (size, mtime):
+                return None
+        except OSError:
+            return None
+
+        entry = {"size": size, "mtime": mtime, "sha256": h.hexdigest(), "header_sha256": header_sha256(path)}
+        with self.lock:
+            self.entries[path] = entry
+            self.dirty = True
+        return entry
+
+    def get_hash(self, path: str, compute: bool = False) -> str | None:
+        entry = self.get_entry(path)
+        if entry is None and compute:
+            entry = self.hash_file(path)
+        if entry is None:
+            return None
+        return entry["sha256"]
+
+    def model_files(self) -> dict[str, tuple[str, str]]:
+        """Returns the model files of all the registered model folders as {absolute path: (folder name, filename)}."""
+        models = {}
+        for folder_name in list(folder_paths.folder_names_and_paths.keys()):
+            if folder_name in EXCLUDED_FOLDERS:
+                continue
+            for filename in folder_paths.get_filename_list(folder_name):
+                full_path = folder_paths.get_full_path(folder_name, filename)
+                if full_path is not None:
+                    models.setdefault(os.path.abspath(full_path), (folder_name, filename))
+        return models
+
+    def scan(self, throttle: bool = False) -> int:
+        """Hashes all the model files that are new or changed and removes the ones that are gone. Returns the number of files hashed."""
+        models = self.model_files()
+        with self.lock:
+            self.models = models
+            for path in [p for p in self.entries if p not in models and not os.path.isfile(p)]:
+                self.entries.pop(path)
+                self.dirty = True
+
+        hashed = 0
+        last_save = time.monotonic()
+        for path in models:
+            if self.stop_event.is_set():
+                break
+            if self.get_entry(path) is not None:
+                continue
+            if self.hash_file(path, throttle=throttle) is not None:
+                hashed += 1
+            if time.monotonic() - last_save > 60:
+                self.save()
+                last_save = time.monotonic()
+        self.save()
+        return hashed
+
+    def find(self, sha256: str) -> list[tuple[str, str]]:
+        """Returns the (folder name, filename) of all the indexed model files with this sha256."""
+        sha256 = sha256.lower()
+        with self.lock:
+            paths = [p for p, e in self.entries.items() if e["sha256"] == sha256]
+            models = self.models
+        out = []
+        for path in paths:
+            if path in models and self.get_entry(path) is not None:
+                out.append(models[path])
+        return out
+
+    def file_info(self, folder_name: str, filename: str) -> dict:
+        info = {"name": filename, "sha256": None, "header_sha256": None}
+        full_path = folder_paths.get_full_path(folder_name, filename)
+        if full_path is not None:
+            entry = self.get_entry(full_path)
+            if entry is not None:
+                info.update(entry)
+        return info
+
+    def run(self, interval: float) -> None:
+        if sys.platform == "linux":
+            try:
+                os.setpriority(os.PRIO_PROCESS, threading.get_native_id(), 19)
+            except Exception:
+                pass
+        while not self.stop_event.is_set():
+            try:
+                hashed = self.scan(throttle=True)
+                if hashed > 0:
+                    logging.info(f"Model hash index: hashed {hashed} model files.")
+            except Exception as e:
+                logging.warning(f"Model hash index scan failed: {e}")
+            self.stop_event.wait(interval)
+
+    def start(self, interval: float = 300.0) -> None:
+        """Starts the background thread that keeps the index up to date, files are only read while busy() returns False."""
+        if self.thread is not None:
+            return
+        self.stop_event.clear()
+        self.thread = threading.Thread(target=self.run, args=(interval,), daemon=True, name="model_hash_index")
+        self.thread.start()
+
+    def stop(self) -> None:
+        self.stop_event.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+
+index = ModelHashIndex()
+
+
+def get_model_hash(folder_name: str, filename: str, compute: bool = False) -> str | None:
+    """Returns the sha256 of a model file, None if it isn't indexed yet unless compute is set."""
+    full_path = folder_paths.get_full_path(folder_name, filename)
+    if full_path is None:
+        return None
+    return index.get_hash(full_path, compute=compute)
+
+
+def find_models_by_hash(sha256: str) -> list[tuple[str, str]]:
+    return index.find(sha256)
@@ -102,6 +102,11 @@ cache_group = parser.add_mutually_exclusive_group()
 cache_group.add_argument("--cache-classic", action="store_true", help="Use the old style (aggressive) caching.")
 cache_group.add_argument("--cache-lru", type=int, default=0, help="Use LRU caching with a maximum of N node results cached. May use more RAM/VRAM.")
 
+parser.add_argument("--preemptible-sampling", action="store_true", help="Record the model outputs of the samplings so they can be preempted at a step boundary when a prompt is queued at the front, they get requeued and resume where they stopped. Interrupted samplings resume too when they are queued again, even after a restart.")
+parser.add_argument("--pack-conds", action="store_true", help="Batch more conds together in each model call: area conds are grown to the size of bigger areas (their weight stays 0 outside of their area) and prompts of different lengths are padded and masked in the cross attention instead of being run separately. Area conds see a bit more of the image around them so results change slightly.")
+parser.add_argument("--batched-noise", action="store_true", help="Generate the initial noise in one call on the GPU with a counter based generator (Philox) instead of on the CPU. The noise of each latent of the batch only depends on the seed and its batch index so batching prompts together or splitting them gives the same images. The noise is different from the default one so the images of a seed change.")
+parser.add_argument("--parallel-prompts", type=int, default=1, metavar="N", help="Execute up to N prompts at the same time. The prompts that load the same model files with the same options share the loaded models and the sampling steps of the prompts that use the same model with the same patches get batched together into one model call.")
+
 attn_group = parser.add_mutually_exclusive_group()
 attn_group.add_argument("--use-split-cross-attention", action="store_true", help="Use the split cross attention optimization. Ignored when xformers is used.")
 attn_group.add_argument("--use-quad-cross-attention", action="store_true", help="Use the sub-quadratic cross attention optimization . Ignored when xformers is used.")
@@ -124,9 +129,18 @@ vram_group.add_argument("--novram", action="store_true", help="When lowvram isn'
 vram_group.add_argument("--cpu", action="store_true", help="To use the CPU for everything (slow).")
 
 parser.add_argument("--reserve-vram", type=float, default=None, help="Set the amount of vram in GB you want to reserve for use by your OS/other software. By default some amount is reserved depending on your OS.")
+parser.add_argument("--memory-calibration", action="store_true", help="Record the real peak memory usage of the diffusion models and use it instead of the built in estimates when deciding how much to unload or how big the batches can be. The measurements are saved in the user directory.")
+
 
+parser.add_argument("--lora-cache-size", type=float, default=1.0, help="Maximum size in GB of the LoRA files kept in memory after loading so switching between them does not read them from disk again. Set to 0 to disable.")
+parser.add_argument("--runtime-lora", action="store_true", help="Apply regular LoRAs to linear and conv layers at runtime (W x + B(A x)) instead of merging them into the model weights. Changing LoRAs or their strength becomes almost free and no weight backups are needed at the cost of some speed.")
+parser.add_argument("--lowvram-patch-cache-size", type=float, default=0.0, help="Maximum size in GB of the LoRA patched weights of partially loaded models kept in (pinned) ram so the patches don't have to be recomputed every step. Disabled (0) by default.")
+parser.add_argument("--checkpoint-delta-swap", action="store_true", help="Load checkpoints that have the same architecture as an already loaded checkpoint as a set of weight patches on top of it instead of as a separate model. Switching between fine-tunes of the same base model then only has to apply the weights that differ.")
+parser.add_argument("--deduplicate-weights", action="store_true", help="Share the ram of identical weights between loaded models, for example the same VAE or text encoder embedded in multiple checkpoints. Weights that get patched are copied first.")
+parser.add_argument("--ckpt-conversion-cache", type=str, default=None, metavar="PATH", help="Directory where a safetensors copy of pickled (.ckpt, .pt, .pth, etc...) model files is saved the first time they are loaded. Later loads use the copy, which is much faster.")
 
 parser.add_argument("--default-hashing-function", type=str, choices=['md5', 'sha1', 'sha256', 'sha512'], default='sha256', help="Allows you to choose the hash function to use for duplicate filename / contents comparison. Default is sha256.")
+parser.add_argument("--model-hash-index", action="store_true", help="Hash the model files in the background at low priority and keep the hashes in an index in the user directory. The hashes are returned by the /models api and available to nodes.")
 
 parser.add_argument("--disable-smart-memory", action="store_true", help="Force ComfyUI to agressively offload to regular ram instead of keeping models in vram when it can.")
 parser.add_argument("--deterministic", action="store_true", help="Make pytorch use slower deterministic algorithms when it can. Note that this might not make images deterministic in all cases.")
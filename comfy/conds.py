@@ -64,6 +64,30 @@ class CONDCrossAttn(CONDRegular):
             out.append(c)
         return torch.cat(out)
 
+    def can_concat_padded(self, other):
+        s1 = self.cond.shape
+        s2 = other.cond.shape
+        return s1[0] == s2[0] and s1[2] == s2[2]
+
+    def concat_padded(self, others):
+        '''
+        Pads the conds with zeros to the longest one when repeating them would make them longer, returns the concatenated
+        conds and the attention mask of their tokens (None if there is no padding).
+        '''
+        conds = [self.cond] + [x.cond for x in others]
+        max_len = max(c.shape[1] for c in conds)
+        if all(max_len % c.shape[1] == 0 for c in conds):
+            return self.concat(others), None
+
+        out = []
+        mask = []
+        for c in conds:
+            m = torch.zeros((c.shape[0], max_len), dtype=torch.bool, device=c.device)
+            m[:, :c.shape[1]] = True
+            out.append(torch.nn.functional.pad(c, (0, 0, 0, max_len - c.shape[1])))
+            mask.append(m)
+        return torch.cat(out), torch.cat(mask)
+
 class CONDConstant(CONDRegular):
     def __init__(self, cond):
         self.cond = cond
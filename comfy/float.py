@@ -47,6 +47,60 @@ def manual_stochastic_round_to_float8(x, dtype, generator=None):
 
 
 
+FP8_FORMATS = {torch.float8_e4m3fn: (4, 3, 7), torch.float8_e5m2: (5, 2, 15)}
+CPU_SLICE_SIZE = 1024 * 1024
+
+
+class StochasticRoundingScratch:
+    '''Scratch buffers for stochastic_round_to_float8_ so they only get allocated once for all the slices of a tensor.'''
+    def __init__(self, size, device):
+        self.buffers = [torch.empty((size,), dtype=torch.float16, device=device) for _ in range(5)]
+        self.mask = torch.empty((size,), dtype=torch.bool, device=device)
+
+    def get(self, numel):
+        return [b[:numel] for b in self.buffers] + [self.mask[:numel]]
+
+
+def stochastic_round_to_float8_(out, x, dtype, generator=None, scratch=None):
+    '''
+    Same result as manual_stochastic_round_to_float8 (the same half precision ops with the same random numbers) written
+    to out, but doing the math in place in a few scratch buffers instead of allocating a dozen temporaries.
+    '''
+    EXPONENT_BITS, MANTISSA_BITS, EXPONENT_BIAS = FP8_FORMATS[dtype]
+    if scratch is None:
+        scratch = StochasticRoundingScratch(x.numel(), x.device)
+    sign, abs_x, exponent, pow2, temp, normal_mask = [b.view(x.shape) for b in scratch.get(x.numel())]
+
+    abs_x.copy_(x)
+    torch.sign(abs_x, out=sign)
+    abs_x.abs_()
+    sign.masked_fill_(abs_x == 0, 0)
+
+    torch.log2(abs_x, out=exponent)
+    exponent.floor_().add_(EXPONENT_BIAS).clamp_(0, 2**EXPONENT_BITS - 1)
+    torch.ne(exponent, 0, out=normal_mask)
+    torch.pow(2.0, exponent.sub_(EXPONENT_BIAS), out=pow2)
+
+    # mantissa (calc_mantissa)
+    torch.div(abs_x, pow2, out=temp)
+    temp.sub_(1.0).mul_(2**MANTISSA_BITS)
+    abs_x.div_(2.0 ** (-EXPONENT_BIAS + 1 - MANTISSA_BITS))
+    torch.where(normal_mask, temp, abs_x, out=abs_x)
+    temp.uniform_(generator=generator)
+    abs_x.add_(temp).floor_().div_(2**MANTISSA_BITS)
+
+    torch.add(abs_x, 1.0, out=temp)
+    pow2.mul_(temp)
+    abs_x.mul_(2.0 ** (-EXPONENT_BIAS + 1))
+    torch.where(normal_mask, pow2, abs_x, out=pow2)
+    sign.mul_(pow2)
+
+    inf = torch.finfo(dtype)
+    sign.clamp_(min=inf.min, max=inf.max)
+    out.copy_(sign)
+    return out
+
+
 def stochastic_rounding(value, dtype, seed=0):
     if dtype == torch.float32:
         return value.to(dtype=torch.float32)
@@ -58,10 +112,63 @@ def stochastic_rounding(value, dtype, seed=0):
         generator = torch.Generator(device=value.device)
         generator.manual_seed(seed)
         output = torch.empty_like(value, dtype=dtype)
+        if value.device.type == "cpu" and value.is_contiguous() and output.is_contiguous():
+            # the cpu generator gives the same random numbers no matter how they are split up so smaller cache friendly slices can be used
+            value_flat = value.view(-1)
+            output_flat = output.view(-1)
+            scratch = StochasticRoundingScratch(min(CPU_SLICE_SIZE, value_flat.numel()), value.device)
+            for i in range(0, value_flat.numel(), CPU_SLICE_SIZE):
+                stochastic_round_to_float8_(output_flat[i:i + CPU_SLICE_SIZE], value_flat[i:i + CPU_SLICE_SIZE], dtype, generator=generator, scratch=scratch)
+            return output
+
         num_slices = max(1, (value.numel() / (4096 * 4096)))
         slice_size = max(1, round(value.shape[0] / num_slices))
+        scratch = StochasticRoundingScratch(value[:slice_size].numel(), value.device)
         for i in range(0, value.shape[0], slice_size):
-            output[i:i+slice_size].copy_(manual_stochastic_round_to_float8(value[i:i+slice_size], dtype, generator=generator))
+            stochastic_round_to_float8_(output[i:i+slice_size], value[i:i+slice_size], dtype, generator=generator, scratch=scratch)
         return output
 
     return value.to(dtype=dtype)
+
+
+def quantize_scaled_fp8(weight, dtype):
+    '''Returns weight rounded to the fp8 dtype after dividing it by a per tensor scale and that scale.'''
+    weight = weight.to(torch.float32)
+    scale = weight.abs().amax() / torch.finfo(dtype).max
+    if scale == 0:
+        scale = torch.ones_like(scale)
+    finfo = torch.finfo(dtype)
+    return (weight / scale).clamp_(finfo.min, finfo.max).to(dtype), scale
+
+
+def quantize_int8(weight, scale=None):
+    '''Symmetric per output channel int8 quantization, returns the int8 weight and the float32 scales (out_features, 1).'''
+    weight = weight.to(torch.float32)
+    if scale is None:
+        scale = weight.abs().amax(dim=1, keepdim=True) / 127
+        scale[scale == 0] = 1.0
+    return (weight / scale).round_().clamp_(-127, 127).to(torch.int8), scale
+
+
+def dequantize_int8(weight, scale, dtype):
+    return weight.to(dtype) * scale.to(dtype)
+
+
+def quantize_int4(weight, group_size, scale=None):
+    '''
+    Symmetric int4 quantization with a scale per group of group_size input features.
+    Returns the weight packed two values per uint8 (out_features, in_features // 2) and the float32 scales (out_features, in_features // group_size).
+    '''
+    out_features, in_features = weight.shape
+    weight = weight.to(torch.float32).reshape(out_features, in_features // group_size, group_size)
+    if scale is None:
+        scale = weight.abs().amax(dim=-1) / 7
+        scale[scale == 0] = 1.0
+    q = (weight / scale.unsqueeze(-1)).round_().clamp_(-8, 7).add_(8).to(torch.uint8).reshape(out_features, in_features)
+    return q[:, 0::2] | (q[:, 1::2] << 4), scale
+
+
+def dequantize_int4(weight, scale, dtype):
+    out_features = weight.shape[0]
+    q = torch.stack((weight & 0x0F, weight >> 4), dim=-1).reshape(out_features, scale.shape[1], -1)
+    return ((q.to(dtype) - 8) * scale.to(dtype).unsqueeze(-1)).reshape(out_features, -1)
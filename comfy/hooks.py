@@ -12,6 +12,7 @@ if TYPE_CHECKING:
     from comfy.model_base import BaseModel
     from comfy.sd import CLIP
 import comfy.lora
+import comfy.lora_cache
 import comfy.model_management
 import comfy.patcher_extension
 from node_helpers import conditioning_set_values
@@ -168,7 +169,7 @@ class WeightHook(Hook):
                 key_map = comfy.lora.model_lora_keys_clip(model.model, key_map)
             else:
                 key_map = comfy.lora.model_lora_keys_unet(model.model, key_map)
-            weights = comfy.lora.load_lora(self.weights, key_map, log_missing=False)
+            weights = comfy.lora_cache.load_lora_patches(self.weights, key_map, log_missing=False, convert=False)
         else:
             if target == EnumWeightTarget.Clip:
                 weights = self.weights_clip
@@ -647,7 +648,7 @@ def load_hook_lora_for_models(model: ModelPatcher, clip: CLIP, lora: dict[str, t
     hook_group = HookGroup()
     hook = WeightHook()
     hook_group.add(hook)
-    loaded: dict[str] = comfy.lora.load_lora(lora, key_map)
+    loaded: dict[str] = comfy.lora_cache.load_lora_patches(lora, key_map, convert=False)
     if model is not None:
         new_modelpatcher = model.clone()
         k = new_modelpatcher.add_hook_patches(hook=hook, patches=loaded, strength_patch=strength_model)
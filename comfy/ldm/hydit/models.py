@@ -380,7 +380,7 @@ class HunYuanDiT(nn.Module):
                     out["img"] = block(args["img"], args["vec"], args["txt"], args["pe"], args["skip"])
                     return out
 
-                out = blocks_replace[("double_block", layer)]({"img": x, "txt": text_states, "vec": c, "pe": freqs_cis_img, "skip": skip}, {"original_block": block_wrap})
+                out = blocks_replace[("double_block", layer)]({"img": x, "txt": text_states, "vec": c, "pe": freqs_cis_img, "skip": skip, "transformer_options": transformer_options}, {"original_block": block_wrap})
                 x = out["img"]
             else:
                 x = block(x, c, text_states, freqs_cis_img, skip)   # (N, L, D)
@@ -532,6 +532,13 @@ def optimized_attention_for_device(device, mask=False, small_input=False):
 
     return optimized_attention
 
+def cross_attn_mask(transformer_options, context, dtype):
+    # mask of the padding of the prompts of different lengths that got batched together
+    mask = transformer_options.get("cross_attn_mask", None)
+    if mask is None or context is None or tuple(mask.shape) != tuple(context.shape[:2]):
+        return None
+    return torch.zeros(mask.shape, dtype=dtype, device=context.device).masked_fill_(~mask.to(context.device), -torch.finfo(dtype).max).unsqueeze(1)
+
 
 class CrossAttention(nn.Module):
     def __init__(self, query_dim, context_dim=None, heads=8, dim_head=64, dropout=0., attn_precision=None, dtype=None, device=None, operations=ops):
@@ -706,7 +713,7 @@ class BasicTransformerBlock(nn.Module):
                 n = attn2_replace_patch[block_attn2](n, context_attn2, value_attn2, extra_options)
                 n = self.attn2.to_out(n)
             else:
-                n = self.attn2(n, context=context_attn2, value=value_attn2)
+                n = self.attn2(n, context=context_attn2, value=value_attn2, mask=cross_attn_mask(transformer_options, context_attn2, n.dtype))
 
         if "attn2_output_patch" in transformer_patches:
             patch = transformer_patches["attn2_output_patch"]
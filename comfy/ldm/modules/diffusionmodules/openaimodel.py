@@ -867,8 +867,16 @@ class UNetModel(nn.Module):
             assert y.shape[0] == x.shape[0]
             emb = emb + self.label_emb(y)
 
+        # lets a step cache skip the deep blocks, after its first shallow_blocks input blocks and until its last shallow_blocks output blocks
+        deep_blocks_skip = transformer_options.get("deep_blocks_skip", None)
+        skip = False
+
         h = x
         for id, module in enumerate(self.input_blocks):
+            if deep_blocks_skip is not None and id == deep_blocks_skip.shallow_blocks:
+                skip = deep_blocks_skip.check(h)
+                if skip:
+                    break
             transformer_options["block"] = ("input", id)
             h = forward_timestep_embed(module, h, emb, context, transformer_options, time_context=time_context, num_video_frames=num_video_frames, image_only_indicator=image_only_indicator)
             h = apply_control(h, control, 'input')
@@ -883,13 +891,24 @@ class UNetModel(nn.Module):
                 for p in patch:
                     h = p(h, transformer_options)
 
-        transformer_options["block"] = ("middle", 0)
-        if self.middle_block is not None:
-            h = forward_timestep_embed(self.middle_block, h, emb, context, transformer_options, time_context=time_context, num_video_frames=num_video_frames, image_only_indicator=image_only_indicator)
-        h = apply_control(h, control, 'middle')
+        if not skip:
+            transformer_options["block"] = ("middle", 0)
+            if self.middle_block is not None:
+                h = forward_timestep_embed(self.middle_block, h, emb, context, transformer_options, time_context=time_context, num_video_frames=num_video_frames, image_only_indicator=image_only_indicator)
+            h = apply_control(h, control, 'middle')
 
+        deep_output_blocks = -1
+        if deep_blocks_skip is not None:
+            deep_output_blocks = len(self.output_blocks) - deep_blocks_skip.shallow_blocks
 
         for id, module in enumerate(self.output_blocks):
+            if skip and id < deep_output_blocks:
+                continue
+            if id == deep_output_blocks:
+                if skip:
+                    h, transformer_options["transformer_index"] = deep_blocks_skip.restore()
+                else:
+                    deep_blocks_skip.store(h, transformer_options["transformer_index"])
             transformer_options["block"] = ("output", id)
             hsp = hs.pop()
             hsp = apply_control(hsp, control, 'output')
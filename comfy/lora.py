@@ -33,10 +33,35 @@ LORA_CLIP_MAP = {
 }
 
 
+# every key load_lora looks for is one of the to_load keys followed by one of these
+LORA_KEY_SUFFIXES = (".alpha", ".dora_scale", ".reshape_weight",
+                     ".lora_up.weight", ".lora_down.weight", ".lora_mid.weight",
+                     "_lora.up.weight", "_lora.down.weight",
+                     ".lora_B.weight", ".lora_A.weight",
+                     ".lora.up.weight", ".lora.down.weight",
+                     ".lora_B", ".lora_A",
+                     ".lora_linear_layer.up.weight", ".lora_linear_layer.down.weight",
+                     ".hada_w1_a", ".hada_w1_b", ".hada_w2_a", ".hada_w2_b", ".hada_t1", ".hada_t2",
+                     ".lokr_w1", ".lokr_w2", ".lokr_w1_a", ".lokr_w1_b", ".lokr_t2", ".lokr_w2_a", ".lokr_w2_b",
+                     ".a1.weight", ".a2.weight", ".b1.weight", ".b2.weight",
+                     ".w_norm", ".b_norm", ".diff", ".diff_b", ".set_weight")
+
+def lora_key_prefixes(lora):
+    prefixes = set()
+    for k in lora.keys():
+        for suffix in LORA_KEY_SUFFIXES:
+            if k.endswith(suffix):
+                prefixes.add(k[:-len(suffix)])
+    return prefixes
+
 def load_lora(lora, to_load, log_missing=True):
     patch_dict = {}
     loaded_keys = set()
+    # only probe the key map entries that have at least one matching key in the lora instead of the whole map
+    prefixes = lora_key_prefixes(lora)
     for x in to_load:
+        if x not in prefixes:
+            continue
         alpha_name = "{}.alpha".format(x)
         alpha = None
         if alpha_name in lora.keys():
@@ -220,8 +245,37 @@ def load_lora(lora, to_load, log_missing=True):
 
     return patch_dict
 
+LORA_KEY_MAP_CACHE = {}
+
+def cached_lora_key_map(model, name, build_function):
+    # key maps only depend on the architecture so they are built once per model object and shared between models with the same keys
+    key_maps = getattr(model, "lora_key_maps", None)
+    if key_maps is None:
+        key_maps = {}
+        model.lora_key_maps = key_maps
+
+    key_map = key_maps.get(name, None)
+    if key_map is None:
+        sdk = model.state_dict().keys()
+        unet_config = getattr(getattr(model, "model_config", None), "unet_config", None)
+        cache_key = (name, model.__class__, repr(unet_config), tuple(sdk))
+        key_map = LORA_KEY_MAP_CACHE.get(cache_key, None)
+        if key_map is None:
+            key_map = build_function(model, sdk)
+            LORA_KEY_MAP_CACHE[cache_key] = key_map
+        key_maps[name] = key_map
+    return key_map
+
 def model_lora_keys_clip(model, key_map={}):
-    sdk = model.state_dict().keys()
+    key_map.update(cached_lora_key_map(model, "clip", build_model_lora_keys_clip))
+    return key_map
+
+def model_lora_keys_unet(model, key_map={}):
+    key_map.update(cached_lora_key_map(model, "unet", build_model_lora_keys_unet))
+    return key_map
+
+def build_model_lora_keys_clip(model, sdk):
+    key_map = {}
     for k in sdk:
         if k.endswith(".weight"):
             key_map["text_encoders.{}".format(k[:-len(".weight")])] = k #generic lora format without any weird key names
@@ -298,9 +352,8 @@ def model_lora_keys_clip(model, key_map={}):
 
     return key_map
 
-def model_lora_keys_unet(model, key_map={}):
-    sd = model.state_dict()
-    sdk = sd.keys()
+def build_model_lora_keys_unet(model, sdk):
+    key_map = {}
 
     for k in sdk:
         if k.startswith("diffusion_model."):
@@ -461,8 +514,123 @@ def pad_tensor_to_shape(tensor: torch.Tensor, new_shape: list[int]) -> torch.Ten
 
     return padded_tensor
 
+STACKABLE_PATCH_TYPES = ("lora", "loha", "lokr")
+
+def stackable_patch(p, first):
+    strength, v, strength_model, offset, function = p
+    if offset is not None or function is not None or isinstance(v, list) or len(v) != 2 or v[0] not in STACKABLE_PATCH_TYPES:
+        return False
+    if strength_model != 1.0 and not first:
+        return False
+    patch_type, v = v
+    if patch_type == "lora":
+        return v[4] is None and v[5] is None
+    elif patch_type == "lokr":
+        return v[8] is None
+    return v[7] is None
+
+def stacked_patch_delta(patches, weight, intermediate_dtype):
+    # sum of the deltas of a run of lora/loha/lokr patches, all the lora ones are computed in a single matmul
+    device = weight.device
+    ups = []
+    downs = []
+    delta = None
+    for strength, v, _, _, _ in patches:
+        patch_type, v = v
+        if patch_type == "lora":
+            mat1 = comfy.model_management.cast_to_device(v[0], device, intermediate_dtype)
+            mat2 = comfy.model_management.cast_to_device(v[1], device, intermediate_dtype)
+            alpha = v[2] / mat2.shape[0] if v[2] is not None else 1.0
+            if v[3] is not None:
+                mat3 = comfy.model_management.cast_to_device(v[3], device, intermediate_dtype)
+                final_shape = [mat2.shape[1], mat2.shape[0], mat3.shape[2], mat3.shape[3]]
+                mat2 = torch.mm(mat2.transpose(0, 1).flatten(start_dim=1), mat3.transpose(0, 1).flatten(start_dim=1)).reshape(final_shape).transpose(0, 1)
+            ups.append(mat1.flatten(start_dim=1) * (strength * alpha))
+            downs.append(mat2.flatten(start_dim=1))
+            continue
+
+        if delta is None:
+            delta = torch.zeros(weight.shape, device=device, dtype=intermediate_dtype)
+
+        if patch_type == "lokr":
+            w1, w2, alpha_v, w1_a, w1_b, w2_a, w2_b, t2 = v[:8]
+            dim = None
+            if w1 is None:
+                dim = w1_b.shape[0]
+                w1 = torch.mm(comfy.model_management.cast_to_device(w1_a, device, intermediate_dtype), comfy.model_management.cast_to_device(w1_b, device, intermediate_dtype))
+            else:
+                w1 = comfy.model_management.cast_to_device(w1, device, intermediate_dtype)
+            if w2 is None:
+                dim = w2_b.shape[0]
+                if t2 is None:
+                    w2 = torch.mm(comfy.model_management.cast_to_device(w2_a, device, intermediate_dtype), comfy.model_management.cast_to_device(w2_b, device, intermediate_dtype))
+                else:
+                    w2 = torch.einsum('i j k l, j r, i p -> p r k l',
+                                      comfy.model_management.cast_to_device(t2, device, intermediate_dtype),
+                                      comfy.model_management.cast_to_device(w2_b, device, intermediate_dtype),
+                                      comfy.model_management.cast_to_device(w2_a, device, intermediate_dtype))
+            else:
+                w2 = comfy.model_management.cast_to_device(w2, device, intermediate_dtype)
+            if len(w2.shape) == 4:
+                w1 = w1.unsqueeze(2).unsqueeze(2)
+            alpha = alpha_v / dim if alpha_v is not None and dim is not None else 1.0
+            delta.add_(torch.kron(w1, w2).reshape(weight.shape), alpha=strength * alpha)
+        else:
+            w1a, w1b, alpha_v, w2a, w2b, t1, t2 = v[:7]
+            alpha = alpha_v / w1b.shape[0] if alpha_v is not None else 1.0
+            if t1 is not None:
+                m1 = torch.einsum('i j k l, j r, i p -> p r k l',
+                                  comfy.model_management.cast_to_device(t1, device, intermediate_dtype),
+                                  comfy.model_management.cast_to_device(w1b, device, intermediate_dtype),
+                                  comfy.model_management.cast_to_device(w1a, device, intermediate_dtype))
+                m2 = torch.einsum('i j k l, j r, i p -> p r k l',
+                                  comfy.model_management.cast_to_device(t2, device, intermediate_dtype),
+                                  comfy.model_management.cast_to_device(w2b, device, intermediate_dtype),
+                                  comfy.model_management.cast_to_device(w2a, device, intermediate_dtype))
+            else:
+                m1 = torch.mm(comfy.model_management.cast_to_device(w1a, device, intermediate_dtype), comfy.model_management.cast_to_device(w1b, device, intermediate_dtype))
+                m2 = torch.mm(comfy.model_management.cast_to_device(w2a, device, intermediate_dtype), comfy.model_management.cast_to_device(w2b, device, intermediate_dtype))
+            delta.addcmul_(m1.reshape(weight.shape), m2.reshape(weight.shape), value=strength * alpha)
+
+    if len(ups) > 0:
+        lora_diff = torch.mm(torch.cat(ups, dim=1), torch.cat(downs, dim=0)).reshape(weight.shape)
+        if delta is None:
+            delta = lora_diff
+        else:
+            delta += lora_diff
+    return delta
+
+def stack_patches(patches, weight, key, intermediate_dtype):
+    '''
+    Yields the patches with every run of two or more consecutive plain lora/loha/lokr patches replaced by a single
+    diff patch of their summed delta so a stack of loras costs one matmul and one update of the full weight.
+    '''
+    i = 0
+    while i < len(patches):
+        end = i + 1
+        if stackable_patch(patches[i], True):
+            while end < len(patches) and stackable_patch(patches[end], False):
+                end += 1
+        if end - i < 2:
+            yield patches[i]
+            i += 1
+            continue
+
+        try:
+            delta = stacked_patch_delta(patches[i:end], weight, intermediate_dtype)
+        except Exception as e:
+            logging.debug("stacked patches failed for {}, applying them one by one: {}".format(key, e))
+            delta = None
+
+        if delta is None:
+            yield from patches[i:end]
+        else:
+            yield (1.0, (delta,), patches[i][2], None, None)
+            del delta
+        i = end
+
 def calculate_weight(patches, weight, key, intermediate_dtype=torch.float32, original_weights=None):
-    for p in patches:
+    for p in stack_patches(patches, weight, key, intermediate_dtype):
         strength = p[0]
         v = p[1]
         strength_model = p[2]
@@ -500,9 +668,19 @@ def calculate_weight(patches, weight, key, intermediate_dtype=torch.float32, ori
                 if diff.shape != weight.shape:
                     logging.warning("WARNING SHAPE MISMATCH {} WEIGHT NOT MERGED {} != {}".format(key, diff.shape, weight.shape))
                 else:
-                    weight += function(strength * comfy.model_management.cast_to_device(diff, weight.device, weight.dtype))
+                    diff = comfy.model_management.cast_to_device(diff, weight.device, weight.dtype)
+                    if strength != 1.0:
+                        diff = strength * diff
+                    weight += function(diff)
         elif patch_type == "set":
             weight.copy_(v[0])
+        elif patch_type == "sparse_diff":
+            indices = comfy.model_management.cast_to_device(v[0], weight.device, None)
+            values = comfy.model_management.cast_to_device(v[1], weight.device, weight.dtype)
+            try:
+                weight.view(-1).index_add_(0, indices, function(values), alpha=strength)
+            except Exception as e:
+                logging.error("ERROR {} {} {}".format(patch_type, key, e))
         elif patch_type == "model_as_lora":
             target_weight: torch.Tensor = v[0]
             diff_weight = comfy.model_management.cast_to_device(target_weight, weight.device, intermediate_dtype) - \
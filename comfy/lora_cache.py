@@ -0,0 +1,111 @@
+import collections
+import logging
+import os
+import threading
+
+import torch
+
+import comfy.lora
+import comfy.lora_convert
+import comfy.utils
+from comfy.cli_args import args
+
+
+class LoraCacheEntry:
+    def __init__(self, lora):
+        self.lora = lora
+        self.size = sum(v.nbytes for v in lora.values() if isinstance(v, torch.Tensor))
+        # (len(key_map), convert) -> list of (copy of the key map, patches), the key maps are compared on lookup
+        self.patches = {}
+
+    def find_patches(self, key_map, convert):
+        for k, patches in self.patches.get((len(key_map), convert), []):
+            if k == key_map:
+                return patches
+        return None
+
+    def add_patches(self, key_map, convert, patches):
+        self.patches.setdefault((len(key_map), convert), []).append((dict(key_map), patches))
+
+
+class LoraCache:
+    '''
+    Process wide LRU cache of LoRA files and the patch dicts that were created from them for each model type.
+    Entries are keyed by path, size and mtime so editing a file on disk invalidates it.
+    '''
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.size = 0
+        self.entries: collections.OrderedDict[tuple, LoraCacheEntry] = collections.OrderedDict()
+        self.entries_by_lora: dict[int, LoraCacheEntry] = {}
+        self.lock = threading.Lock()
+
+    def load(self, lora_path):
+        stat = os.stat(lora_path)
+        key = (lora_path, stat.st_size, stat.st_mtime_ns)
+        with self.lock:
+            entry = self.entries.get(key, None)
+            if entry is not None:
+                self.entries.move_to_end(key)
+                return entry.lora
+
+        lora = comfy.utils.load_torch_file(lora_path, safe_load=True)
+        entry = LoraCacheEntry(lora)
+        if entry.size > self.max_size:
+            return lora
+
+        with self.lock:
+            existing = self.entries.get(key, None)
+            if existing is not None:
+                # loaded by another thread at the same time
+                return existing.lora
+            self.entries[key] = entry
+            self.entries_by_lora[id(lora)] = entry
+            self.size += entry.size
+            self.evict()
+        return lora
+
+    def evict(self):
+        while self.size > self.max_size and len(self.entries) > 0:
+            _, entry = self.entries.popitem(last=False)
+            self.entries_by_lora.pop(id(entry.lora), None)
+            self.size -= entry.size
+            logging.debug("Evicted lora from cache, {} bytes in cache.".format(self.size))
+
+    def get_patches(self, lora, key_map, log_missing=True, convert=True):
+        with self.lock:
+            entry = self.entries_by_lora.get(id(lora), None)
+            if entry is not None and entry.lora is not lora:
+                entry = None
+            if entry is not None:
+                patches = entry.find_patches(key_map, convert)
+                if patches is not None:
+                    return patches
+
+        if convert:
+            lora = comfy.lora_convert.convert_lora(lora)
+        patches = comfy.lora.load_lora(lora, key_map, log_missing=log_missing)
+        if entry is not None:
+            with self.lock:
+                if entry.find_patches(key_map, convert) is None:
+                    entry.add_patches(key_map, convert, patches)
+        return patches
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.entries_by_lora.clear()
+            self.size = 0
+
+
+cache = LoraCache(int(args.lora_cache_size * 1024 * 1024 * 1024))
+
+
+def load_lora_file(lora_path):
+    return cache.load(lora_path)
+
+
+def load_lora_patches(lora, key_map, log_missing=True, convert=True):
+    '''Same as comfy.lora.load_lora (with comfy.lora_convert.convert_lora applied first if convert is set) but reuses the
+    result when lora was loaded with load_lora_file and the same key map was used before.'''
+    return cache.get_patches(lora, key_map, log_missing=log_missing, convert=convert)
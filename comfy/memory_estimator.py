@@ -0,0 +1,176 @@
+import json
+import logging
+import math
+import os
+import threading
+
+import numpy
+import torch
+
+import comfy.model_management
+
+# Records the real peak inference memory of model evaluations and fits a small
+# per model family formula that replaces the fixed memory_required heuristics
+# once enough samples have been seen.
+
+MIN_SAMPLES = 3
+MAX_SAMPLES_PER_FAMILY = 64
+SAFETY_FACTOR = 1.15
+MAX_EXTRAPOLATION = 4.0
+FILE_VERSION = 1
+
+
+def attention_backend():
+    import comfy.ldm.modules.attention
+    return getattr(comfy.ldm.modules.attention.optimized_attention, "__name__", "unknown")
+
+
+def inference_dtype(model):
+    if model.manual_cast_dtype is not None:
+        return model.manual_cast_dtype
+    return model.get_dtype()
+
+
+def shape_features(input_shape):
+    batch = input_shape[0]
+    tokens = math.prod(input_shape[2:])
+    return [1.0, float(batch * tokens), float(batch * tokens * tokens)]
+
+
+class MemoryEstimator:
+    def __init__(self):
+        self.enabled = False
+        self.path = None
+        self.samples = {}
+        self.fits = {}
+        self.dirty = False
+        self.lock = threading.Lock()
+
+    def family_key(self, model, dtype):
+        return "{}:{}:{}".format(model.__class__.__name__, str(dtype).replace("torch.", ""), attention_backend())
+
+    def enable(self, path=None):
+        self.enabled = True
+        self.path = path
+        if path is not None:
+            self.load(path)
+
+    def record(self, model, input_shape, peak_bytes):
+        if not self.enabled or peak_bytes <= 0:
+            return
+        key = self.family_key(model, inference_dtype(model))
+        shape = [int(s) for s in input_shape]
+        with self.lock:
+            samples = self.samples.setdefault(key, {})
+            shape_key = "x".join(map(str, shape))
+            # keep the worst observed peak for a shape, allocator fragmentation makes it vary a bit between runs
+            if samples.get(shape_key, (None, 0))[1] >= peak_bytes:
+                return
+            samples[shape_key] = (shape, int(peak_bytes))
+            if len(samples) > MAX_SAMPLES_PER_FAMILY:
+                samples.pop(next(iter(samples)))
+            self.fits.pop(key, None)
+            self.dirty = True
+
+    def fit(self, key):
+        samples = list(self.samples.get(key, {}).values())
+        if len(samples) < MIN_SAMPLES:
+            return None
+
+        features = numpy.array([shape_features(s[0]) for s in samples], dtype=numpy.float64)
+        peaks = numpy.array([s[1] for s in samples], dtype=numpy.float64)
+        scale = numpy.maximum(features.max(axis=0), 1.0)
+
+        coef = None
+        # drop the quadratic (attention) term and then the constant term if the fit produces negative coefficients
+        for columns in ([0, 1, 2], [0, 1], [1]):
+            if len(samples) < len(columns):
+                continue
+            c, _, _, _ = numpy.linalg.lstsq(features[:, columns] / scale[columns], peaks, rcond=None)
+            if (c >= 0).all():
+                coef = numpy.zeros(3)
+                coef[columns] = c / scale[columns]
+                break
+
+        if coef is None:
+            return None
+
+        return {"coef": coef.tolist(), "max_elements": float(features[:, 1].max())}
+
+    def estimate(self, model, input_shape):
+        if not self.enabled:
+            return None
+        key = self.family_key(model, inference_dtype(model))
+        with self.lock:
+            if key not in self.fits:
+                self.fits[key] = self.fit(key)
+            fit = self.fits[key]
+
+        if fit is None:
+            return None
+
+        features = shape_features(input_shape)
+        if features[1] > fit["max_elements"] * MAX_EXTRAPOLATION:
+            return None
+        return sum(c * f for c, f in zip(fit["coef"], features)) * SAFETY_FACTOR
+
+    def load(self, path):
+        if not os.path.isfile(path):
+            return
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+        except Exception as e:
+            logging.warning("Could not load memory estimates from {}: {}".format(path, e))
+            return
+        if data.get("version", None) != FILE_VERSION:
+            return
+        with self.lock:
+            for key, samples in data.get("families", {}).items():
+                family = self.samples.setdefault(key, {})
+                for shape, peak in samples:
+                    family["x".join(map(str, shape))] = (shape, peak)
+            self.fits.clear()
+
+    def save(self):
+        if self.path is None or not self.dirty:
+            return
+        with self.lock:
+            data = {"version": FILE_VERSION, "families": {k: [list(s) for s in v.values()] for k, v in self.samples.items()}}
+            self.dirty = False
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            temp_path = self.path + ".tmp"
+            with open(temp_path, "w", encoding="utf-8") as f:
+                json.dump(data, f)
+            os.replace(temp_path, self.path)
+        except Exception as e:
+            logging.warning("Could not save memory estimates to {}: {}".format(self.path, e))
+
+
+estimator = MemoryEstimator()
+
+
+def enable(path=None):
+    estimator.enable(path)
+
+
+def estimate(model, input_shape):
+    return estimator.estimate(model, input_shape)
+
+
+def save():
+    estimator.save()
+
+
+def measure_start(device):
+    if not estimator.enabled or not comfy.model_management.is_device_cuda(device):
+        return None
+    torch.cuda.reset_peak_memory_stats(device)
+    return torch.cuda.memory_allocated(device)
+
+
+def measure_end(model, input_shape, device, start):
+    if start is None:
+        return
+    estimator.record(model, input_shape, torch.cuda.max_memory_allocated(device) - start)
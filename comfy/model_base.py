@@ -38,9 +38,11 @@ import comfy.ldm.lumina.model
 import comfy.ldm.wan.model
 
 import comfy.model_management
+import comfy.memory_estimator
 import comfy.patcher_extension
 import comfy.conds
 import comfy.ops
+import comfy.float
 from enum import Enum
 from . import utils
 import comfy.latent_formats
@@ -264,7 +266,7 @@ class BaseModel(torch.nn.Module):
     def process_latent_out(self, latent):
         return self.latent_format.process_out(latent)
 
-    def state_dict_for_saving(self, clip_state_dict=None, vae_state_dict=None, clip_vision_state_dict=None):
+    def state_dict_for_saving(self, clip_state_dict=None, vae_state_dict=None, clip_vision_state_dict=None, scaled_fp8=None):
         extra_sds = []
         if clip_state_dict is not None:
             extra_sds.append(self.model_config.process_clip_state_dict_for_saving(clip_state_dict))
@@ -273,9 +275,22 @@ class BaseModel(torch.nn.Module):
         if clip_vision_state_dict is not None:
             extra_sds.append(self.model_config.process_clip_vision_state_dict_for_saving(clip_vision_state_dict))
 
-        unet_state_dict = self.diffusion_model.state_dict()
-
-        if self.model_config.scaled_fp8 is not None:
+        unet_state_dict = comfy.ops.dequantize_state_dict(self.diffusion_model, self.diffusion_model.state_dict(), self.get_dtype())
+
+        if scaled_fp8 is not None and self.model_config.scaled_fp8 is None:
+            # the linear layers get loaded with comfy.ops.scaled_fp8_ops so they can be saved already quantized
+            for n, m in self.diffusion_model.named_modules():
+                if isinstance(m, torch.nn.Linear) and hasattr(m, "comfy_cast_weights"):
+                    weight, scale = comfy.float.quantize_scaled_fp8(unet_state_dict["{}.weight".format(n)], scaled_fp8)
+                    unet_state_dict["{}.weight".format(n)] = weight
+                    unet_state_dict["{}.scale_weight".format(n)] = scale
+                    unet_state_dict["{}.scale_input".format(n)] = torch.ones((), dtype=torch.float32)
+                    bias_key = "{}.bias".format(n)
+                    if bias_key in unet_state_dict: # scaled_fp8_ops creates the bias with the same dtype
+                        finfo = torch.finfo(scaled_fp8)
+                        unet_state_dict[bias_key] = unet_state_dict[bias_key].to(torch.float32).clamp(finfo.min, finfo.max).to(scaled_fp8)
+            unet_state_dict["scaled_fp8"] = torch.tensor([], dtype=scaled_fp8)
+        elif self.model_config.scaled_fp8 is not None:
             unet_state_dict["scaled_fp8"] = torch.tensor([], dtype=self.model_config.scaled_fp8)
 
         unet_state_dict = self.model_config.process_unet_state_dict_for_saving(unet_state_dict)
@@ -304,6 +319,10 @@ class BaseModel(torch.nn.Module):
         return self.model_sampling.noise_scaling(sigma.reshape([sigma.shape[0]] + [1] * (len(noise.shape) - 1)), noise, latent_image)
 
     def memory_required(self, input_shape):
+        estimate = comfy.memory_estimator.estimate(self, input_shape)
+        if estimate is not None:
+            return estimate
+
         if comfy.model_management.xformers_enabled() or comfy.model_management.pytorch_attention_flash_attention():
             dtype = self.get_dtype()
             if self.manual_cast_dtype is not None:
@@ -693,8 +712,8 @@ class StableAudio1(BaseModel):
             out['c_crossattn'] = comfy.conds.CONDRegular(cross_attn)
         return out
 
-    def state_dict_for_saving(self, clip_state_dict=None, vae_state_dict=None, clip_vision_state_dict=None):
-        sd = super().state_dict_for_saving(clip_state_dict=clip_state_dict, vae_state_dict=vae_state_dict, clip_vision_state_dict=clip_vision_state_dict)
+    def state_dict_for_saving(self, clip_state_dict=None, vae_state_dict=None, clip_vision_state_dict=None, scaled_fp8=None):
+        sd = super().state_dict_for_saving(clip_state_dict=clip_state_dict, vae_state_dict=vae_state_dict, clip_vision_state_dict=clip_vision_state_dict, scaled_fp8=scaled_fp8)
         d = {"conditioner.conditioners.seconds_start.": self.seconds_start_embedder.state_dict(), "conditioner.conditioners.seconds_total.": self.seconds_total_embedder.state_dict()}
         for k in d:
             s = d[k]
@@ -1,18 +1,57 @@
 import comfy.supported_models
 import comfy.supported_models_base
 import comfy.utils
+import bisect
+import collections
+import copy
+import hashlib
 import math
 import logging
 import torch
 
+class StateDictKeys:
+    '''Keys of a state dict with fast membership and prefix lookups.'''
+    def __init__(self, keys):
+        self.keys = list(keys)
+        self.key_set = set(self.keys)
+        self.sorted_keys = sorted(self.keys)
+
+    def __contains__(self, key):
+        return key in self.key_set
+
+    def __iter__(self):
+        return iter(self.keys)
+
+    def __len__(self):
+        return len(self.keys)
+
+    def with_prefix(self, prefix):
+        start = bisect.bisect_left(self.sorted_keys, prefix)
+        end = start
+        while end < len(self.sorted_keys) and self.sorted_keys[end].startswith(prefix):
+            end += 1
+        return self.sorted_keys[start:end]
+
+    def has_prefix(self, prefix):
+        start = bisect.bisect_left(self.sorted_keys, prefix)
+        return start < len(self.sorted_keys) and self.sorted_keys[start].startswith(prefix)
+
+def keys_with_prefix(state_dict_keys, prefix):
+    if isinstance(state_dict_keys, StateDictKeys):
+        return state_dict_keys.with_prefix(prefix)
+    return sorted(list(filter(lambda a: a.startswith(prefix), state_dict_keys)))
+
 def count_blocks(state_dict_keys, prefix_string):
     count = 0
     while True:
-        c = False
-        for k in state_dict_keys:
-            if k.startswith(prefix_string.format(count)):
-                c = True
-                break
+        if isinstance(state_dict_keys, StateDictKeys):
+            c = state_dict_keys.has_prefix(prefix_string.format(count))
+        else:
+            c = False
+            for k in state_dict_keys:
+                if k.startswith(prefix_string.format(count)):
+                    c = True
+                    break
         if c == False:
             break
         count += 1
@@ -23,7 +62,7 @@ def calculate_transformer_depth(prefix, state_dict_keys, state_dict):
     use_linear_in_transformer = False
 
     transformer_prefix = prefix + "1.transformer_blocks."
-    transformer_keys = sorted(list(filter(lambda a: a.startswith(transformer_prefix), state_dict_keys)))
+    transformer_keys = keys_with_prefix(state_dict_keys, transformer_prefix)
     if len(transformer_keys) > 0:
         last_transformer_depth = count_blocks(state_dict_keys, transformer_prefix + '{}')
         context_dim = state_dict['{}0.attn2.to_k.weight'.format(transformer_prefix)].shape[1]
@@ -34,7 +73,7 @@ def calculate_transformer_depth(prefix, state_dict_keys, state_dict):
     return None
 
 def detect_unet_config(state_dict, key_prefix):
-    state_dict_keys = list(state_dict.keys())
+    state_dict_keys = StateDictKeys(state_dict.keys())
 
     if '{}joint_blocks.0.context_block.attn.qkv.weight'.format(key_prefix) in state_dict_keys: #mmdit model
         unet_config = {}
@@ -149,7 +188,7 @@ def detect_unet_config(state_dict, key_prefix):
         dit_config["axes_dim"] = [16, 56, 56]
         dit_config["theta"] = 256
         dit_config["qkv_bias"] = True
-        guidance_keys = list(filter(lambda a: a.startswith("{}guidance_in.".format(key_prefix)), state_dict_keys))
+        guidance_keys = keys_with_prefix(state_dict_keys, "{}guidance_in.".format(key_prefix))
         dit_config["guidance_embed"] = len(guidance_keys) > 0
         return dit_config
 
@@ -367,11 +406,11 @@ def detect_unet_config(state_dict, key_prefix):
         prefix = '{}input_blocks.{}.'.format(key_prefix, count)
         prefix_output = '{}output_blocks.{}.'.format(key_prefix, input_block_count - count - 1)
 
-        block_keys = sorted(list(filter(lambda a: a.startswith(prefix), state_dict_keys)))
+        block_keys = keys_with_prefix(state_dict_keys, prefix)
         if len(block_keys) == 0:
             break
 
-        block_keys_output = sorted(list(filter(lambda a: a.startswith(prefix_output), state_dict_keys)))
+        block_keys_output = keys_with_prefix(state_dict_keys, prefix_output)
 
         if "{}0.op.weight".format(prefix) in block_keys: #new layer
             num_res_blocks.append(last_res_blocks)
@@ -454,11 +493,38 @@ def model_config_from_unet_config(unet_config, state_dict=None):
     logging.error("no match {}".format(unet_config))
     return None
 
+DETECTION_CACHE_SIZE = 64
+detection_cache = collections.OrderedDict()
+
+def state_dict_signature(state_dict):
+    '''Hash of the key names, shapes and dtypes of a state dict, which is all the model detection looks at.'''
+    h = hashlib.sha256()
+    for k in state_dict:
+        v = state_dict[k]
+        h.update("{}:{}:{};".format(k, tuple(v.shape), v.dtype).encode())
+    return h.hexdigest()
+
 def model_config_from_unet(state_dict, unet_key_prefix, use_base_if_no_match=False):
-    unet_config = detect_unet_config(state_dict, unet_key_prefix)
+    key = (state_dict_signature(state_dict), unet_key_prefix)
+    cached = detection_cache.get(key, None)
+    if cached is None:
+        unet_config = detect_unet_config(state_dict, unet_key_prefix)
+        model_config = None
+        if unet_config is not None:
+            model_config = model_config_from_unet_config(unet_config, state_dict)
+        cached = (copy.deepcopy(unet_config), None if model_config is None else model_config.__class__)
+        detection_cache[key] = cached
+        if len(detection_cache) > DETECTION_CACHE_SIZE:
+            detection_cache.popitem(last=False)
+    else:
+        detection_cache.move_to_end(key)
+        unet_config = copy.deepcopy(cached[0])
+        model_config = None
+        if unet_config is not None and cached[1] is not None:
+            model_config = cached[1](unet_config)
+
     if unet_config is None:
         return None
-    model_config = model_config_from_unet_config(unet_config, state_dict)
     if model_config is None and use_base_if_no_match:
         model_config = comfy.supported_models_base.BASE(unet_config)
 
@@ -471,6 +537,26 @@ def model_config_from_unet(state_dict, unet_key_prefix, use_base_if_no_match=Fal
 
     return model_config
 
+def model_config_from_file(path, use_base_if_no_match=False):
+    '''
+    Detects the model config of a safetensors checkpoint or diffusion model from its header without loading it.
+    Returns the model config and the diffusion model key prefix, or (None, None) if the file is not a safetensors file or the model is not detected.
+    '''
+    if not path.lower().endswith((".safetensors", ".sft")):
+        return None, None
+    header = comfy.utils.safetensors_header(path)
+    if header is None:
+        return None, None
+    state_dict = comfy.utils.safetensors_header_state_dict(header)
+    unet_key_prefix = unet_prefix_from_state_dict(state_dict)
+    model_config = model_config_from_unet(state_dict, unet_key_prefix, use_base_if_no_match=use_base_if_no_match)
+    if model_config is None and unet_key_prefix != "":
+        unet_key_prefix = ""
+        model_config = model_config_from_unet(state_dict, unet_key_prefix, use_base_if_no_match=use_base_if_no_match)
+    if model_config is None:
+        return None, None
+    return model_config, unet_key_prefix
+
 def unet_prefix_from_state_dict(state_dict):
     candidates = ["model.diffusion_model.", #ldm/sgm models
                   "model.model.", #audio models
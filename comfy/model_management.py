@@ -25,6 +25,7 @@ import sys
 import platform
 import weakref
 import gc
+import comfy.step_batching
 
 class VRAMState(Enum):
     DISABLED = 0    #No vram present: no need to move models to vram
@@ -463,7 +464,7 @@ def free_memory(memory_required, device, keep_loaded=[]):
     for i in range(len(current_loaded_models) -1, -1, -1):
         shift_model = current_loaded_models[i]
         if shift_model.device == device:
-            if shift_model not in keep_loaded and not shift_model.is_dead():
+            if shift_model not in keep_loaded and not shift_model.is_dead() and not comfy.step_batching.in_use(shift_model.model.model):
                 can_unload.append((-shift_model.model_offloaded_memory(), sys.getrefcount(shift_model.model), shift_model.model_memory(), i))
                 shift_model.currently_used = False
 
@@ -1169,6 +1170,32 @@ def soft_empty_cache(force=False):
 def unload_all_models():
     free_memory(1e30, get_torch_device())
 
+#Batch/tile sizes that were found to work after an OOM, per prompt (see begin_prompt) and reset at its start
+oom_safe_sizes = {}
+
+def get_oom_safe_sizes():
+    sizes = getattr(prompt_state, "oom_safe_sizes", None)
+    return oom_safe_sizes if sizes is None else sizes
+
+def get_oom_safe_size(key, size):
+    return min(size, get_oom_safe_sizes().get(key, size))
+
+def reduce_oom_safe_size(key, size, minimum=1):
+    '''
+    Call after catching an OOM_EXCEPTION: frees the cache and remembers a halved size for key.
+    Returns 0 if the size can't be reduced below minimum, in which case the caller should give up or use a fallback.
+    '''
+    soft_empty_cache(True)
+    size = size // 2
+    if size < minimum:
+        return 0
+    get_oom_safe_sizes()[key] = size
+    logging.warning("Ran out of memory, retrying with a smaller batch/tile size {}.".format(size))
+    return size
+
+def reset_oom_safe_sizes():
+    get_oom_safe_sizes().clear()
+
 
 #TODO: might be cleaner to put this somewhere else
 import threading
@@ -1178,23 +1205,71 @@ class InterruptProcessingException(Exception):
 
 interrupt_processing_mutex = threading.RLock()
 
+#The interrupt flag and the oom safe sizes are per prompt so the prompts executed at the same time (--parallel-prompts)
+#don't interrupt each other, interrupt_processing is the flag of the threads that don't execute a prompt.
 interrupt_processing = False
-def interrupt_current_processing(value=True):
+prompt_state = threading.local()
+running_prompts = set()
+interrupted_prompts = set()
+
+def current_prompt_id():
+    return getattr(prompt_state, "prompt_id", None)
+
+def begin_prompt(prompt_id):
+    global interrupt_processing
+    with interrupt_processing_mutex:
+        if len(running_prompts) == 0:
+            interrupt_processing = False
+        prompt_state.prompt_id = prompt_id
+        prompt_state.oom_safe_sizes = {}
+        running_prompts.add(prompt_id)
+        interrupted_prompts.discard(prompt_id)
+
+def end_prompt():
+    with interrupt_processing_mutex:
+        prompt_id = current_prompt_id()
+        running_prompts.discard(prompt_id)
+        interrupted_prompts.discard(prompt_id)
+        prompt_state.prompt_id = None
+        prompt_state.oom_safe_sizes = None
+
+def interrupt_current_processing(value=True, prompt_id=None):
+    '''Sets the interrupt flag of the prompt, by default the one of the current thread or all of them outside of a prompt.'''
     global interrupt_processing
     global interrupt_processing_mutex
     with interrupt_processing_mutex:
-        interrupt_processing = value
+        if prompt_id is None:
+            prompt_id = current_prompt_id()
+        if prompt_id is None:
+            prompts = list(running_prompts)
+            if len(prompts) == 0 or not value:
+                interrupt_processing = value
+        else:
+            prompts = [prompt_id] if prompt_id in running_prompts else []
+        for p in prompts:
+            if value:
+                interrupted_prompts.add(p)
+            else:
+                interrupted_prompts.discard(p)
 
 def processing_interrupted():
     global interrupt_processing
     global interrupt_processing_mutex
     with interrupt_processing_mutex:
-        return interrupt_processing
+        prompt_id = current_prompt_id()
+        if prompt_id is None:
+            return interrupt_processing
+        return prompt_id in interrupted_prompts
 
 def throw_exception_if_processing_interrupted():
     global interrupt_processing
     global interrupt_processing_mutex
     with interrupt_processing_mutex:
-        if interrupt_processing:
-            interrupt_processing = False
+        prompt_id = current_prompt_id()
+        if prompt_id is None:
+            if interrupt_processing:
+                interrupt_processing = False
+                raise InterruptProcessingException()
+        elif prompt_id in interrupted_prompts:
+            interrupted_prompts.discard(prompt_id)
             raise InterruptProcessingException()
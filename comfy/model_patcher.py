@@ -24,17 +24,26 @@ import inspect
 import logging
 import uuid
 import collections
+import concurrent.futures
 import math
+import os
+import threading
+import weakref
 
 import comfy.utils
 import comfy.float
 import comfy.model_management
 import comfy.lora
 import comfy.hooks
+import comfy.tensor_intern
+import comfy.step_batching
 import comfy.patcher_extension
+from comfy.cli_args import args
 from comfy.patcher_extension import CallbacksMP, WrappersMP, PatcherInjection
 from comfy.comfy_types import UnetWrapperFunction
 
+PATCH_THREADS = min(8, os.cpu_count() or 1)
+
 def string_to_seed(data):
     crc = 0xFFFFFFFF
     for byte in data:
@@ -103,6 +112,10 @@ def wipe_lowvram_weight(m):
     if hasattr(m, "bias_function"):
         m.bias_function = []
 
+def wipe_lora_function(m):
+    if len(getattr(m, "lora_function", [])) > 0:
+        m.lora_function = []
+
 def move_weight_functions(m, device):
     if device is None:
         return 0
@@ -117,12 +130,103 @@ def move_weight_functions(m, device):
         for f in m.bias_function:
             if hasattr(f, "move_to"):
                 memory += f.move_to(device=device)
+
+    if hasattr(m, "lora_function"):
+        for f in m.lora_function:
+            memory += f.move_to(device=device)
     return memory
 
+class LowVramPatchCache:
+    '''
+    Patched weights of the lowvram modules kept in ram (pinned when the compute device is cuda) so the lora math
+    doesn't run again every time the weight gets cast. An entry is only used if the patches of the key and the
+    source weight didn't change since it was computed. Once full nothing new gets cached: every step goes through
+    the layers in the same order so evicting old entries would only make every lookup miss.
+    '''
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.size = 0
+        self.entries = {}
+        self.lock = threading.Lock()
+
+    def entry_key(self, patch, dtype, device):
+        return (id(patch.model), patch.key, dtype, device)
+
+    def get(self, patch, source, dtype, device):
+        key = self.entry_key(patch, dtype, device)
+        with self.lock:
+            entry = self.entries.get(key, None)
+            if entry is None:
+                return None
+            patches, source_ref, version, weight = entry
+            current = patch.patches.get(patch.key, [])
+            if source_ref() is not source or source._version != version or len(patches) != len(current) or any(a is not b for a, b in zip(patches, current)):
+                self.remove(key)
+                return None
+            return weight
+
+    def put(self, patch, source, dtype, device, weight):
+        size = weight.nbytes
+        with self.lock:
+            if not self.fits(size):
+                return
+        if comfy.model_management.is_device_cuda(device):
+            cached = torch.empty(weight.shape, dtype=weight.dtype, device="cpu", pin_memory=True)
+            cached.copy_(weight)
+        else:
+            cached = weight.to("cpu", copy=True)
+        key = self.entry_key(patch, dtype, device)
+        with self.lock:
+            self.remove(key)
+            # another thread could have filled the cache during the copy
+            if not self.fits(size):
+                return
+            self.entries[key] = (tuple(patch.patches[patch.key]), weakref.ref(source), source._version, cached)
+            self.size += size
+
+    def fits(self, size):
+        if self.size + size > self.max_size:
+            self.remove_dead()
+        return self.size + size <= self.max_size
+
+    def remove(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.size -= entry[3].nbytes
+
+    def remove_dead(self):
+        for k in [k for k, e in self.entries.items() if e[1]() is None]:
+            self.remove(k)
+
+    def clear(self, model=None):
+        with self.lock:
+            if model is None:
+                self.entries.clear()
+                self.size = 0
+                return
+            for k in [k for k in self.entries if k[0] == id(model)]:
+                self.remove(k)
+
+lowvram_patch_cache = LowVramPatchCache(int(args.lowvram_patch_cache_size * 1024 * 1024 * 1024))
+
 class LowVramPatch:
-    def __init__(self, key, patches):
+    def __init__(self, key, patches, model=None):
         self.key = key
         self.patches = patches
+        self.model = model
+
+    def cast_and_patch(self, tensor, dtype, device, non_blocking=False, copy=False):
+        if lowvram_patch_cache.max_size <= 0:
+            return self(comfy.model_management.cast_to(tensor, dtype, device, non_blocking=non_blocking, copy=True))
+
+        weight = lowvram_patch_cache.get(self, tensor, dtype, device)
+        if weight is not None:
+            return comfy.model_management.cast_to(weight, dtype, device, non_blocking=non_blocking, copy=copy)
+
+        weight = self(comfy.model_management.cast_to(tensor, dtype, device, non_blocking=non_blocking, copy=True))
+        lowvram_patch_cache.put(self, tensor, dtype, device, weight)
+        return weight
+
     def __call__(self, weight):
         intermediate_dtype = weight.dtype
         if intermediate_dtype not in [torch.float32, torch.float16, torch.bfloat16]: #intermediate_dtype has to be one that is supported in math ops
@@ -131,6 +235,101 @@ class LowVramPatch:
 
         return comfy.lora.calculate_weight(self.patches[self.key], weight, self.key, intermediate_dtype=intermediate_dtype)
 
+CONV_FUNCTIONS = {3: torch.nn.functional.conv1d, 4: torch.nn.functional.conv2d, 5: torch.nn.functional.conv3d}
+
+class LoraRuntimePatch:
+    '''Applies lora patches at forward time as W x + B(A x) instead of merging B A into W.
+    The lora terms without a mid weight are concatenated along the rank so they run as a single pair of matmuls/convs.'''
+    def __init__(self, key, patches, terms):
+        self.key = key
+        self.patches = patches
+        self.terms = terms
+
+    def move_to(self, device=None):
+        memory = 0
+        terms = []
+        for term in self.terms:
+            moved = []
+            for t in term:
+                if t is not None and t.device != device:
+                    t = t.to(device)
+                    memory += t.nbytes
+                moved.append(t)
+            terms.append(tuple(moved))
+        self.terms = terms
+        return memory
+
+    def __call__(self, op, input, out):
+        for down, mid, up in self.terms:
+            down = comfy.model_management.cast_to_device(down, input.device, input.dtype)
+            up = comfy.model_management.cast_to_device(up, input.device, input.dtype)
+            if up.ndim == 2:
+                out = out + torch.nn.functional.linear(torch.nn.functional.linear(input, down), up)
+                continue
+
+            conv = CONV_FUNCTIONS[up.ndim]
+            if mid is None:
+                x = op._conv_forward(input, down, None)
+            else:
+                x = op._conv_forward(conv(input, down), comfy.model_management.cast_to_device(mid, input.device, input.dtype), None)
+            out = out + conv(x, up)
+        return out
+
+def lora_runtime_patch(op, key, patches):
+    '''Returns a LoraRuntimePatch if all the patches of key are plain loras on a linear or conv layer, None if they need to be merged into the weight.'''
+    if not isinstance(op, (torch.nn.Linear, torch.nn.Conv1d, torch.nn.Conv2d, torch.nn.Conv3d)):
+        return None
+    if not isinstance(op, torch.nn.Linear) and op.groups != 1:
+        return None
+
+    weight_shape = op.weight.shape
+    if isinstance(op, torch.nn.Linear):
+        weight_shape = torch.Size((op.out_features, op.in_features)) # the weight can be stored packed
+    rank_shape = [1] * (len(weight_shape) - 2)
+    merged = []
+    terms = []
+    for strength, v, strength_model, offset, function in patches[key]:
+        if strength_model != 1.0 or offset is not None or function is not None or isinstance(v, list) or len(v) != 2 or v[0] != "lora":
+            return None
+        mat1, mat2, alpha, mid, dora_scale, reshape = v[1][:6]
+        if dora_scale is not None or reshape is not None:
+            return None
+        if strength == 0.0:
+            continue
+
+        rank = mat2.shape[0]
+        if alpha is not None:
+            alpha = alpha / rank
+        else:
+            alpha = 1.0
+
+        if mat1.numel() != weight_shape[0] * rank:
+            return None
+        up = mat1.reshape([weight_shape[0], rank] + rank_shape).to(torch.float32) * (strength * alpha)
+        up = up.to(mat1.dtype)
+        if mid is not None:
+            if mid.shape[:2] != (rank, rank) or mid.shape[2:] != weight_shape[2:] or mat2.numel() != rank * weight_shape[1]:
+                return None
+            terms.append((mat2.reshape([rank, weight_shape[1]] + rank_shape), mid, up))
+        else:
+            if mat2.numel() != rank * math.prod(weight_shape[1:]):
+                return None
+            merged.append((mat2.reshape([rank] + list(weight_shape[1:])), up))
+
+    if len(merged) > 0:
+        down = torch.cat([m[0] for m in merged], dim=0)
+        up = torch.cat([m[1].to(down.dtype) for m in merged], dim=1)
+        terms.insert(0, (down, None, up))
+    return LoraRuntimePatch(key, patches, terms)
+
+def get_key_weight_scale(set_func, key):
+    '''The scale of the weight when the set function requantizes it (int8/int4 ops), it changes with the weight so it has to be backed up too.'''
+    op = getattr(set_func, "__self__", None)
+    scale = getattr(op, "{}_scale".format(key.rsplit('.', 1)[-1]), None)
+    if not isinstance(scale, torch.Tensor):
+        return None, None
+    return "{}_scale".format(key), scale
+
 def get_key_weight(model, key):
     set_func = None
     convert_func = None
@@ -219,6 +418,7 @@ class ModelPatcher:
         self.offload_device = offload_device
         self.weight_inplace_update = weight_inplace_update
         self.force_cast_weights = False
+        self.runtime_lora = args.runtime_lora
         self.patches_uuid = uuid.uuid4()
         self.parent = None
 
@@ -279,6 +479,7 @@ class ModelPatcher:
         n.parent = self
 
         n.force_cast_weights = self.force_cast_weights
+        n.runtime_lora = self.runtime_lora
 
         # attachments
         n.attachments = {}
@@ -546,10 +747,13 @@ class ModelPatcher:
             return
 
         weight, set_func, convert_func = get_key_weight(self.model, key)
-        inplace_update = self.weight_inplace_update or inplace_update
+        inplace_update = (self.weight_inplace_update or inplace_update) and not comfy.tensor_intern.is_shared(self.model, key)
 
         if key not in self.backup:
             self.backup[key] = collections.namedtuple('Dimension', ['weight', 'inplace_update'])(weight.to(device=self.offload_device, copy=inplace_update), inplace_update)
+        scale_key, scale = get_key_weight_scale(set_func, key)
+        if scale_key is not None and scale_key not in self.backup:
+            self.backup[scale_key] = collections.namedtuple('Dimension', ['weight', 'inplace_update'])(scale.to(device=self.offload_device, copy=inplace_update), inplace_update)
 
         if device_to is not None:
             temp_weight = comfy.model_management.cast_to_device(weight, device_to, torch.float32, copy=True)
@@ -568,6 +772,19 @@ class ModelPatcher:
         else:
             set_func(out_weight, inplace_update=inplace_update, seed=string_to_seed(key))
 
+    def patch_weights_to_device(self, keys, device_to=None):
+        keys = [k for k in keys if k in self.patches]
+        workers = min(PATCH_THREADS, len(keys))
+        if workers <= 1 or not comfy.model_management.is_device_cpu(device_to):
+            for key in keys:
+                self.patch_weight_to_device(key, device_to=device_to)
+            return
+
+        # patching on the cpu is mostly memory bound small ops, running a few keys at once keeps more cores busy
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+            for f in [executor.submit(self.patch_weight_to_device, key, device_to) for key in keys]:
+                f.result()
+
     def _load_list(self):
         loading = []
         for n, m in self.model.named_modules():
@@ -589,6 +806,7 @@ class ModelPatcher:
             mem_counter = 0
             patch_counter = 0
             lowvram_counter = 0
+            runtime_keys = set()
             loading = self._load_list()
 
             load_completely = []
@@ -611,23 +829,31 @@ class ModelPatcher:
                         if hasattr(m, "prev_comfy_cast_weights"): #Already lowvramed
                             continue
 
+                lora_patch = None
+                if self.runtime_lora and not force_patch_weights and weight_key in self.patches and hasattr(m, "lora_function"):
+                    lora_patch = lora_runtime_patch(m, weight_key, self.patches)
+                    if lora_patch is not None:
+                        m.lora_function = [lora_patch]
+                        runtime_keys.add(weight_key)
+                        patch_counter += 1
+
                 cast_weight = self.force_cast_weights
                 if lowvram_weight:
                     if hasattr(m, "comfy_cast_weights"):
                         m.weight_function = []
                         m.bias_function = []
 
-                    if weight_key in self.patches:
+                    if weight_key in self.patches and lora_patch is None:
                         if force_patch_weights:
                             self.patch_weight_to_device(weight_key)
                         else:
-                            m.weight_function = [LowVramPatch(weight_key, self.patches)]
+                            m.weight_function = [LowVramPatch(weight_key, self.patches, self.model)]
                             patch_counter += 1
                     if bias_key in self.patches:
                         if force_patch_weights:
                             self.patch_weight_to_device(bias_key)
                         else:
-                            m.bias_function = [LowVramPatch(bias_key, self.patches)]
+                            m.bias_function = [LowVramPatch(bias_key, self.patches, self.model)]
                             patch_counter += 1
 
                     cast_weight = True
@@ -652,6 +878,7 @@ class ModelPatcher:
                 mem_counter += move_weight_functions(m, device_to)
 
             load_completely.sort(reverse=True)
+            patch_keys = []
             for x in load_completely:
                 n = x[1]
                 m = x[2]
@@ -661,11 +888,15 @@ class ModelPatcher:
                         continue
 
                 for param in params:
-                    self.patch_weight_to_device("{}.{}".format(n, param), device_to=device_to)
+                    key = "{}.{}".format(n, param)
+                    if key not in runtime_keys:
+                        patch_keys.append(key)
 
                 logging.debug("lowvram: loaded module regularly {} {}".format(n, m))
                 m.comfy_patched_weights = True
 
+            self.patch_weights_to_device(patch_keys, device_to=device_to)
+
             for x in load_completely:
                 x[2].to(device_to)
 
@@ -714,10 +945,14 @@ class ModelPatcher:
                 for m in self.model.modules():
                     move_weight_functions(m, device_to)
                     wipe_lowvram_weight(m)
+                lowvram_patch_cache.clear(self.model)
 
                 self.model.model_lowvram = False
                 self.model.lowvram_patch_counter = 0
 
+            for m in self.model.modules():
+                wipe_lora_function(m)
+
             keys = list(self.backup.keys())
 
             for k in keys:
@@ -733,6 +968,8 @@ class ModelPatcher:
             if device_to is not None:
                 self.model.to(device_to)
                 self.model.device = device_to
+                if torch.device(device_to).type == "cpu":
+                    comfy.tensor_intern.restore_shared(self.model)
             self.model.model_loaded_weight_memory = 0
 
             for m in self.model.modules():
@@ -781,13 +1018,15 @@ class ModelPatcher:
                     if move_weight:
                         cast_weight = self.force_cast_weights
                         m.to(device_to)
+                        if torch.device(device_to).type == "cpu":
+                            comfy.tensor_intern.restore_shared(self.model, ["{}.{}".format(n, param) for param in params])
                         module_mem += move_weight_functions(m, device_to)
                         if lowvram_possible:
-                            if weight_key in self.patches:
-                                m.weight_function.append(LowVramPatch(weight_key, self.patches))
+                            if weight_key in self.patches and len(m.lora_function) == 0:
+                                m.weight_function.append(LowVramPatch(weight_key, self.patches, self.model))
                                 patch_counter += 1
                             if bias_key in self.patches:
-                                m.bias_function.append(LowVramPatch(bias_key, self.patches))
+                                m.bias_function.append(LowVramPatch(bias_key, self.patches, self.model))
                                 patch_counter += 1
                             cast_weight = True
 
@@ -808,7 +1047,10 @@ class ModelPatcher:
             unpatch_weights = self.model.current_weight_patches_uuid is not None and (self.model.current_weight_patches_uuid != self.patches_uuid or force_patch_weights)
             # TODO: force_patch_weights should not unload + reload full model
             used = self.model.model_loaded_weight_memory
-            self.unpatch_model(self.offload_device, unpatch_weights=unpatch_weights)
+            # with --checkpoint-delta-swap the variants of a fully loaded model only need different patches: restore the
+            # patched weights without moving the rest of the model off the device, it gets fully loaded again below
+            in_place = args.checkpoint_delta_swap and unpatch_weights and not self.model.model_lowvram and used >= self.model_size()
+            self.unpatch_model(None if in_place else self.offload_device, unpatch_weights=unpatch_weights)
             if unpatch_weights:
                 extra_memory += (used - self.model.model_loaded_weight_memory)
 
@@ -817,9 +1059,9 @@ class ModelPatcher:
             if self.model.model_lowvram == False and self.model.model_loaded_weight_memory > 0:
                 self.apply_hooks(self.forced_hooks, force_apply=True)
                 return 0
-            if self.model.model_loaded_weight_memory + extra_memory > self.model_size():
+            if in_place or self.model.model_loaded_weight_memory + extra_memory > self.model_size():
                 full_load = True
-            current_used = self.model.model_loaded_weight_memory
+            current_used = used if in_place else self.model.model_loaded_weight_memory
             try:
                 self.load(device_to, lowvram_model_memory=current_used + extra_memory, force_patch_weights=force_patch_weights, full_load=full_load)
             except Exception as e:
@@ -847,7 +1089,7 @@ class ModelPatcher:
     def cleanup(self):
         self.clean_hooks()
         if hasattr(self.model, "current_patcher"):
-            self.model.current_patcher = None
+            self.model.current_patcher = comfy.step_batching.running_patcher(self.model, exclude=self)
         for callback in self.get_all_callbacks(CallbacksMP.ON_CLEANUP):
             callback(self)
 
@@ -1127,6 +1369,7 @@ class ModelPatcher:
                 if used:
                     target_device = weight.device
             self.hook_backup[key] = (weight.to(device=target_device, copy=True), weight.device)
+        comfy.tensor_intern.make_private(self.model, key)
         comfy.utils.copy_to_param(self.model, key, cached_weights[key][0].to(device=cached_weights[key][1]))
 
     def clear_cached_hook_weights(self):
@@ -1146,6 +1389,9 @@ class ModelPatcher:
                 if used:
                     target_device = weight.device
             self.hook_backup[key] = (weight.to(device=target_device, copy=True), weight.device)
+        scale_key, scale = get_key_weight_scale(set_func, key)
+        if scale_key is not None and scale_key not in self.hook_backup:
+            self.hook_backup[scale_key] = (scale.to(device=self.offload_device, copy=True), scale.device)
         # TODO: properly handle LowVramPatch, if it ends up an issue
         temp_weight = comfy.model_management.cast_to_device(weight, weight.device, torch.float32, copy=True)
         if convert_func is not None:
@@ -1155,6 +1401,7 @@ class ModelPatcher:
                                                  temp_weight,
                                                  key, original_weights=original_weights)
         del original_weights[key]
+        comfy.tensor_intern.make_private(self.model, key)
         if set_func is None:
             out_weight = comfy.float.stochastic_rounding(out_weight, weight.dtype, seed=string_to_seed(key))
             comfy.utils.copy_to_param(self.model, key, out_weight)
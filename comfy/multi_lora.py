@@ -0,0 +1,149 @@
+import logging
+
+import comfy.lora
+import comfy.lora_cache
+import comfy.model_patcher
+import comfy.utils
+
+# Per batch element LoRAs. Conds can carry a tuple of LoraAdapter objects in their "lora_adapters" key. Instead of
+# patching the weights (which needs one model and one forward pass per LoRA combination) the adapters are applied
+# at runtime in the comfy.ops layers to the rows of the batch that belong to the conds that use them, so conds
+# with different LoRAs can still be batched together.
+
+
+class LoraAdapter:
+    def __init__(self, lora, strength=1.0, name=None):
+        self.lora = lora
+        self.strength = strength
+        self.name = name
+
+    def get_patches(self, model_patcher):
+        key_map = comfy.lora.model_lora_keys_unet(model_patcher.model, {})
+        return comfy.lora_cache.load_lora_patches(self.lora, key_map, log_missing=False)
+
+
+class LoraAdapterLayer:
+    def __init__(self, batch, patches):
+        self.batch = batch
+        self.patches = patches # LoraRuntimePatch (or None) for every adapter set of the batch
+
+    def __call__(self, op, input, out):
+        segments = self.batch.segments
+        rows = input.shape[0]
+        if rows != self.batch.batch_size:
+            if rows % self.batch.batch_size != 0:
+                if len(segments) != 1:
+                    raise RuntimeError("Can't apply different lora adapters to the batch elements of a layer with an input batch size of {} (expected a multiple of {}).".format(rows, self.batch.batch_size))
+                segments = [(0, rows, segments[0][2])]
+            else:
+                m = rows // self.batch.batch_size
+                segments = [(s * m, length * m, i) for s, length, i in segments]
+
+        for start, length, i in segments:
+            patch = self.patches[i]
+            if patch is None:
+                continue
+            if length == rows:
+                out = patch(op, input, out)
+            else:
+                out.narrow(0, start, length).add_(patch(op, input.narrow(0, start, length), 0))
+        return out
+
+
+class LoraAdapterBatch:
+    '''
+    The adapters of all the conds of a sampling run, resolved for the layers of the model.
+    Every distinct tuple of adapters (adapter set) gets one LoraRuntimePatch per layer with their low rank matrices concatenated.
+    '''
+    def __init__(self, model_patcher, adapter_sets):
+        self.sets = {}
+        for adapters in adapter_sets:
+            self.sets.setdefault(adapters, len(self.sets))
+        self.layers = {}
+        self.segments = []
+        self.batch_size = 0
+
+        model = model_patcher.model
+        skipped = 0
+        for adapters, i in self.sets.items():
+            patches = {}
+            for adapter in adapters:
+                for k, v in adapter.get_patches(model_patcher).items():
+                    if isinstance(k, str):
+                        patches.setdefault(k, []).append((adapter.strength, v, 1.0, None, None))
+                    else:
+                        skipped += 1
+
+            for key in patches:
+                op_key, param = key.rsplit(".", 1)
+                patch = None
+                if param == "weight":
+                    op = comfy.utils.get_attr(model, op_key)
+                    if hasattr(op, "lora_function"):
+                        patch = comfy.model_patcher.lora_runtime_patch(op, key, patches)
+                if patch is None:
+                    skipped += 1
+                    continue
+                if op_key not in self.layers:
+                    self.layers[op_key] = (op, LoraAdapterLayer(self, [None] * len(self.sets)))
+                self.layers[op_key][1].patches[i] = patch
+
+        if skipped > 0:
+            logging.warning("{} lora adapter weights are not regular loras on linear or conv layers and can't be applied per batch element, they were skipped.".format(skipped))
+
+    def size(self):
+        size = 0
+        for op, layer in self.layers.values():
+            for patch in layer.patches:
+                if patch is not None:
+                    for term in patch.terms:
+                        size += sum(t.nbytes for t in term if t is not None)
+        return size
+
+    def move_to(self, device):
+        for op, layer in self.layers.values():
+            for patch in layer.patches:
+                if patch is not None:
+                    patch.move_to(device)
+
+    def attach(self, segments):
+        '''segments is a list of (row start, row count, adapter tuple) covering the batch that is about to run.'''
+        self.segments = []
+        self.batch_size = 0
+        for start, length, adapters in segments:
+            i = self.sets.get(adapters, None) if adapters is not None else None
+            if i is not None:
+                if len(self.segments) > 0 and self.segments[-1][2] == i and self.segments[-1][0] + self.segments[-1][1] == start:
+                    self.segments[-1] = (self.segments[-1][0], self.segments[-1][1] + length, i)
+                else:
+                    self.segments.append((start, length, i))
+            self.batch_size = max(self.batch_size, start + length)
+
+        if len(self.segments) == 0:
+            return False
+        for op, layer in self.layers.values():
+            op.lora_function = op.lora_function + [layer]
+        return True
+
+    def detach(self):
+        for op, layer in self.layers.values():
+            op.lora_function = [f for f in op.lora_function if f is not layer]
+        self.segments = []
+
+
+def get_adapter_sets(conds):
+    adapter_sets = set()
+    for k in conds:
+        for c in conds[k]:
+            adapters = c.get("lora_adapters", None)
+            if adapters:
+                adapter_sets.add(adapters)
+    return adapter_sets
+
+
+def prepare_adapter_batch(model_patcher, conds):
+    '''Returns a LoraAdapterBatch for the lora adapters used in conds or None if none of them use any.'''
+    adapter_sets = get_adapter_sets(conds)
+    if len(adapter_sets) == 0:
+        return None
+    return LoraAdapterBatch(model_patcher, adapter_sets)
@@ -26,6 +26,18 @@ cast_to = comfy.model_management.cast_to #TODO: remove once no more references
 def cast_to_input(weight, input, non_blocking=False, copy=True):
     return comfy.model_management.cast_to(weight, input.dtype, input.device, non_blocking=non_blocking, copy=copy)
 
+def cast_with_functions(tensor, functions, dtype, device, non_blocking):
+    has_function = len(functions) > 0
+    if has_function and hasattr(functions[0], "cast_and_patch"):
+        # lets the lowvram patch return a cached patched weight instead of casting and patching again
+        out = functions[0].cast_and_patch(tensor, dtype, device, non_blocking=non_blocking, copy=len(functions) > 1)
+        functions = functions[1:]
+    else:
+        out = comfy.model_management.cast_to(tensor, dtype, device, non_blocking=non_blocking, copy=has_function)
+    for f in functions:
+        out = f(out)
+    return out
+
 def cast_bias_weight(s, input=None, dtype=None, device=None, bias_dtype=None):
     if input is not None:
         if dtype is None:
@@ -38,23 +50,21 @@ def cast_bias_weight(s, input=None, dtype=None, device=None, bias_dtype=None):
     bias = None
     non_blocking = comfy.model_management.device_supports_non_blocking(device)
     if s.bias is not None:
-        has_function = len(s.bias_function) > 0
-        bias = comfy.model_management.cast_to(s.bias, bias_dtype, device, non_blocking=non_blocking, copy=has_function)
-        if has_function:
-            for f in s.bias_function:
-                bias = f(bias)
-
-    has_function = len(s.weight_function) > 0
-    weight = comfy.model_management.cast_to(s.weight, dtype, device, non_blocking=non_blocking, copy=has_function)
-    if has_function:
-        for f in s.weight_function:
-            weight = f(weight)
+        bias = cast_with_functions(s.bias, s.bias_function, bias_dtype, device, non_blocking)
+
+    weight = cast_with_functions(s.weight, s.weight_function, dtype, device, non_blocking)
     return weight, bias
 
+def run_lora_functions(s, input, out):
+    for f in s.lora_function:
+        out = f(s, input, out)
+    return out
+
 class CastWeightBiasOp:
     comfy_cast_weights = False
     weight_function = []
     bias_function = []
+    lora_function = []
 
 class disable_weight_init:
     class Linear(torch.nn.Linear, CastWeightBiasOp):
@@ -67,9 +77,12 @@ class disable_weight_init:
 
         def forward(self, *args, **kwargs):
             if self.comfy_cast_weights or len(self.weight_function) > 0 or len(self.bias_function) > 0:
-                return self.forward_comfy_cast_weights(*args, **kwargs)
+                out = self.forward_comfy_cast_weights(*args, **kwargs)
             else:
-                return super().forward(*args, **kwargs)
+                out = super().forward(*args, **kwargs)
+            if len(self.lora_function) > 0:
+                out = run_lora_functions(self, args[0], out)
+            return out
 
     class Conv1d(torch.nn.Conv1d, CastWeightBiasOp):
         def reset_parameters(self):
@@ -81,9 +94,12 @@ class disable_weight_init:
 
         def forward(self, *args, **kwargs):
             if self.comfy_cast_weights or len(self.weight_function) > 0 or len(self.bias_function) > 0:
-                return self.forward_comfy_cast_weights(*args, **kwargs)
+                out = self.forward_comfy_cast_weights(*args, **kwargs)
             else:
-                return super().forward(*args, **kwargs)
+                out = super().forward(*args, **kwargs)
+            if len(self.lora_function) > 0:
+                out = run_lora_functions(self, args[0], out)
+            return out
 
     class Conv2d(torch.nn.Conv2d, CastWeightBiasOp):
         def reset_parameters(self):
@@ -95,9 +111,12 @@ class disable_weight_init:
 
         def forward(self, *args, **kwargs):
             if self.comfy_cast_weights or len(self.weight_function) > 0 or len(self.bias_function) > 0:
-                return self.forward_comfy_cast_weights(*args, **kwargs)
+                out = self.forward_comfy_cast_weights(*args, **kwargs)
             else:
-                return super().forward(*args, **kwargs)
+                out = super().forward(*args, **kwargs)
+            if len(self.lora_function) > 0:
+                out = run_lora_functions(self, args[0], out)
+            return out
 
     class Conv3d(torch.nn.Conv3d, CastWeightBiasOp):
         def reset_parameters(self):
@@ -109,9 +128,12 @@ class disable_weight_init:
 
         def forward(self, *args, **kwargs):
             if self.comfy_cast_weights or len(self.weight_function) > 0 or len(self.bias_function) > 0:
-                return self.forward_comfy_cast_weights(*args, **kwargs)
+                out = self.forward_comfy_cast_weights(*args, **kwargs)
             else:
-                return super().forward(*args, **kwargs)
+                out = super().forward(*args, **kwargs)
+            if len(self.lora_function) > 0:
+                out = run_lora_functions(self, args[0], out)
+            return out
 
     class GroupNorm(torch.nn.GroupNorm, CastWeightBiasOp):
         def reset_parameters(self):
@@ -355,6 +377,102 @@ def scaled_fp8_ops(fp8_matrix_mult=False, scale_input=False, override_dtype=None
 
     return scaled_fp8_op
 
+def int_weight_ops(bits=8, group_size=64):
+    '''
+    Weight only quantization of the linear layers: int8 with a scale per output channel or int4 with a scale per group
+    of group_size input features (int8 is used for the layers with an in_features that isn't a multiple of group_size).
+    Float weights get quantized when they are loaded and dequantized to the input dtype in the forward.
+    '''
+    class int_weight_op(manual_cast):
+        class Linear(manual_cast.Linear):
+            def __init__(self, in_features, out_features, bias=True, device=None, dtype=None):
+                torch.nn.Module.__init__(self)
+                self.in_features = in_features
+                self.out_features = out_features
+                self.bits = bits if bits == 4 and in_features % group_size == 0 else 8
+                if self.bits == 4:
+                    weight = torch.empty((out_features, in_features // 2), dtype=torch.uint8, device=device)
+                    scale = torch.empty((out_features, in_features // group_size), dtype=torch.float32, device=device)
+                else:
+                    weight = torch.empty((out_features, in_features), dtype=torch.int8, device=device)
+                    scale = torch.empty((out_features, 1), dtype=torch.float32, device=device)
+                self.weight = torch.nn.Parameter(weight, requires_grad=False)
+                self.weight_scale = torch.nn.Parameter(scale, requires_grad=False)
+                if bias:
+                    self.bias = torch.nn.Parameter(torch.empty(out_features, dtype=dtype, device=device), requires_grad=False)
+                else:
+                    self.register_parameter("bias", None)
+
+            def quantize(self, weight, scale=None):
+                if self.bits == 4:
+                    return comfy.float.quantize_int4(weight, group_size, scale=scale)
+                return comfy.float.quantize_int8(weight, scale=scale)
+
+            def dequantize(self, weight, scale, dtype):
+                if self.bits == 4:
+                    return comfy.float.dequantize_int4(weight, scale, dtype)
+                return comfy.float.dequantize_int8(weight, scale, dtype)
+
+            def _load_from_state_dict(self, state_dict, prefix, local_metadata, strict, missing_keys, unexpected_keys, error_msgs):
+                weight = state_dict.get("{}weight".format(prefix), None)
+                if weight is not None and weight.is_floating_point() and "{}weight_scale".format(prefix) not in state_dict:
+                    scale_weight = state_dict.pop("{}scale_weight".format(prefix), None)
+                    state_dict.pop("{}scale_input".format(prefix), None)
+                    if scale_weight is not None: #scaled fp8 weights
+                        weight = weight.to(torch.float32) * scale_weight.to(torch.float32)
+                    state_dict["{}weight".format(prefix)], state_dict["{}weight_scale".format(prefix)] = self.quantize(weight)
+                return super()._load_from_state_dict(state_dict, prefix, local_metadata, strict, missing_keys, unexpected_keys, error_msgs)
+
+            def forward_comfy_cast_weights(self, input):
+                non_blocking = comfy.model_management.device_supports_non_blocking(input.device)
+                bias = None
+                if self.bias is not None:
+                    bias = cast_with_functions(self.bias, self.bias_function, input.dtype, input.device, non_blocking)
+                weight = comfy.model_management.cast_to(self.weight, None, input.device, non_blocking=non_blocking)
+                scale = comfy.model_management.cast_to(self.weight_scale, None, input.device, non_blocking=non_blocking)
+                weight = self.dequantize(weight, scale, input.dtype)
+                for f in self.weight_function:
+                    weight = f(weight)
+                return torch.nn.functional.linear(input, weight, bias)
+
+            def convert_weight(self, weight, inplace=False, **kwargs):
+                if self.bits == 4:
+                    weight = weight.to(torch.uint8)
+                return self.dequantize(weight, self.weight_scale.to(weight.device), torch.float32)
+
+            def set_weight(self, weight, inplace_update=False, seed=None, **kwargs):
+                # new scales so the patched values don't get clipped, the model patcher backs them up with the weight
+                weight, scale = self.quantize(weight)
+                if inplace_update:
+                    self.weight.data.copy_(weight)
+                    self.weight_scale.data.copy_(scale)
+                else:
+                    self.weight = torch.nn.Parameter(weight, requires_grad=False)
+                    self.weight_scale = torch.nn.Parameter(scale, requires_grad=False)
+
+    return int_weight_op
+
+int8_weight_ops = int_weight_ops(bits=8)
+int4_weight_ops = int_weight_ops(bits=4)
+WEIGHT_QUANTIZATION_OPS = {"int8": int8_weight_ops, "int4": int4_weight_ops}
+
+def dequantize_state_dict(module, state_dict, dtype=None):
+    '''
+    Replaces the int8/int4 weights of the int_weight_ops layers of module in its state_dict by float weights so the
+    saved files can be loaded normally. The weights get the dtype of the bias of the layer, dtype or float32.
+    '''
+    for n, m in module.named_modules():
+        if not (hasattr(m, "weight_scale") and hasattr(m, "dequantize")):
+            continue
+        prefix = "{}.".format(n) if n else ""
+        weight = state_dict.get("{}weight".format(prefix), None)
+        scale = state_dict.pop("{}weight_scale".format(prefix), None)
+        if weight is None or scale is None:
+            continue
+        weight_dtype = m.bias.dtype if m.bias is not None else (dtype or torch.float32)
+        state_dict["{}weight".format(prefix)] = m.dequantize(weight, scale, torch.float32).to(weight_dtype)
+    return state_dict
+
 def pick_operations(weight_dtype, compute_dtype, load_device=None, disable_fast_fp8=False, fp8_optimizations=False, scaled_fp8=None):
     fp8_compute = comfy.model_management.supports_fp8_compute(load_device)
     if scaled_fp8 is not None:
@@ -4,12 +4,76 @@ import comfy.samplers
 import comfy.utils
 import numpy as np
 import logging
+from comfy.cli_args import args
+
+PHILOX_M = (0xD2511F53, 0xCD9E8D57)
+PHILOX_W = (0x9E3779B9, 0xBB67AE85)
+PHILOX_ROUNDS = 10
+PHILOX_CHUNK = 2 ** 18
+MASK_32 = 0xFFFFFFFF
+
+def mulhilo32(a, b):
+    # b holds 32 bit values in int64, the product wraps around but its bits are the ones of the unsigned 64 bit product
+    product = b * a
+    return (product >> 32) & MASK_32, product & MASK_32
+
+def philox4x32(counter, key):
+    """
+    Philox4x32-10, counter is a list of 4 int64 tensors with the 32 bit words of the counters and key 2 32 bit ints.
+    """
+    c0, c1, c2, c3 = counter
+    k0, k1 = key
+    for i in range(PHILOX_ROUNDS):
+        if i > 0:
+            k0 = (k0 + PHILOX_W[0]) & MASK_32
+            k1 = (k1 + PHILOX_W[1]) & MASK_32
+        hi0, lo0 = mulhilo32(PHILOX_M[0], c0)
+        hi1, lo1 = mulhilo32(PHILOX_M[1], c2)
+        c0, c1, c2, c3 = hi1 ^ c1 ^ k0, lo1, hi0 ^ c3 ^ k1, lo0
+    return c0, c1, c2, c3
+
+def philox_randn(shape, seed, noise_inds, device):
+    """
+    normal noise where the noise of each batch element only depends on the seed and its index in noise_inds.
+    the counter is (position in the element, index) and the key is the seed so all of it is generated at once.
+    """
+    per_element = 1
+    for s in shape[1:]:
+        per_element *= s
+    counters = (per_element + 3) // 4
+    index = torch.tensor(noise_inds, dtype=torch.int64, device=device)
+    seed = seed & 0xFFFFFFFFFFFFFFFF
+    key = (seed & MASK_32, seed >> 32)
+    noise = torch.empty((len(noise_inds) * counters, 4), dtype=torch.float32, device=device)
+
+    # in chunks to limit the memory used by the temporary int64 tensors
+    for start in range(0, noise.shape[0], PHILOX_CHUNK):
+        c = torch.arange(start, min(start + PHILOX_CHUNK, noise.shape[0]), dtype=torch.int64, device=device)
+        position = c % counters
+        i = index[c // counters]
+        bits = philox4x32([position & MASK_32, position >> 32, i & MASK_32, i >> 32], key)
+
+        # Box-Muller on the high 24 bits of each word so the uniforms are in (0, 1)
+        u = [((b >> 8).to(torch.float32) + 0.5) * (2.0 ** -24) for b in bits]
+        out = noise[start:start + c.shape[0]]
+        for j in range(0, 4, 2):
+            radius = torch.sqrt(-2.0 * torch.log(u[j]))
+            angle = (2.0 * torch.pi) * u[j + 1]
+            out[:, j] = radius * torch.cos(angle)
+            out[:, j + 1] = radius * torch.sin(angle)
+    return noise.reshape(len(noise_inds), -1)[:, :per_element].reshape([len(noise_inds)] + list(shape[1:]))
 
 def prepare_noise(latent_image, seed, noise_inds=None):
     """
     creates random noise given a latent image and a seed.
     optional arg skip can be used to skip and discard x number of noise generations for a given seed
     """
+    if args.batched_noise:
+        if noise_inds is None:
+            noise_inds = range(latent_image.shape[0])
+        noise = philox_randn(latent_image.size(), seed, [int(i) for i in noise_inds], comfy.model_management.get_torch_device())
+        return noise.to(device="cpu", dtype=latent_image.dtype)
+
     generator = torch.manual_seed(seed)
     if noise_inds is None:
         return torch.randn(latent_image.size(), dtype=latent_image.dtype, layout=latent_image.layout, generator=generator, device="cpu")
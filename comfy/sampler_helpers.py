@@ -1,10 +1,12 @@
 from __future__ import annotations
+import threading
 import uuid
 import comfy.model_management
 import comfy.conds
 import comfy.utils
 import comfy.hooks
 import comfy.patcher_extension
+import comfy.multi_lora
 from typing import TYPE_CHECKING
 if TYPE_CHECKING:
     from comfy.model_patcher import ModelPatcher
@@ -105,15 +107,101 @@ def cleanup_additional_models(models):
             m.cleanup()
 
 
-def prepare_sampling(model: ModelPatcher, noise_shape, conds, model_options=None):
+NOT_REUSABLE_COND_KEYS = ("control", "gligen", "hooks", "lora_adapters", "additional_models")
+
+def cond_value_signature(v):
+    if isinstance(v, (int, float, str, bool, type(None))):
+        return v
+    if isinstance(v, dict):
+        return tuple(sorted((k, cond_value_signature(x)) for k, x in v.items()))
+    if isinstance(v, (list, tuple)):
+        return tuple(cond_value_signature(x) for x in v)
+    if isinstance(v, comfy.conds.CONDRegular):
+        return (type(v).__name__, id(v.cond), cond_value_signature(getattr(v, "extra", None)))
+    return (type(v).__name__, id(v))
+
+def conds_signature(conds):
+    """Signature of the conds from the identity of their tensors, None if they use things that have to be prepared for every sampling (controlnets, hooks, etc...)"""
+    out = []
+    for k in sorted(conds):
+        for c in conds[k]:
+            if any(x in c for x in NOT_REUSABLE_COND_KEYS):
+                return None
+            out.append((k, cond_value_signature({x: c[x] for x in c if x != "uuid"})))
+    return tuple(out)
+
+class PreparedSampling(threading.local):
+    """
+    What the last sampling of the prompt prepared: the models it loaded and the processed conds. Chained sampler nodes
+    (refiner and multi pass workflows) use the same model and conds so they reuse them instead of loading the models and
+    processing the conds again. Everything is dropped when a sampling uses something else and at the end of the prompt.
+    """
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.models = None
+        self.load_state = None
+        self.memory_required = 0
+        self.conds_key = None
+        self.conds = None
+        self.conds_refs = None
+
+    def model_load_state(self):
+        return [(m.patches_uuid, m.model.current_weight_patches_uuid, m.loaded_size(), m.current_loaded_device()) for m in self.models]
+
+    def models_loaded(self, models, memory_required):
+        """True if models are still loaded like they were by the last sampling and there is enough free memory to run it."""
+        if self.models is None or len(models) != len(self.models) or any(a is not b for a, b in zip(models, self.models)):
+            return False
+        if memory_required > self.memory_required or self.model_load_state() != self.load_state:
+            return False
+        loaded = comfy.model_management.loaded_models()
+        if any(not any(m is x for x in loaded) for m in models):
+            return False
+        return comfy.model_management.get_free_memory(models[0].load_device) > memory_required
+
+    def set_models(self, models, memory_required):
+        self.models = models
+        self.memory_required = memory_required
+        self.load_state = self.model_load_state()
+
+    def process_conds(self, process_conds, model, noise, conds, device, latent_image=None, denoise_mask=None, seed=None, latent_source=None):
+        signature = conds_signature(conds)
+        if signature is None:
+            return process_conds(model, noise, conds, device, latent_image, denoise_mask, seed)
+        # the latent image is only used for the concat conds of inpaint models
+        latent_key = id(latent_source) if len(getattr(model, "concat_keys", ())) > 0 else None
+        key = (id(model), id(model.model_sampling), signature, tuple(noise.shape), noise.dtype, noise.device, device, latent_key, id(denoise_mask), seed)
+        if key != self.conds_key:
+            self.conds = process_conds(model, noise, conds, device, latent_image, denoise_mask, seed)
+            # keep what the ids in the key refer to alive
+            self.conds_key = key
+            self.conds_refs = (model, conds, latent_source, denoise_mask)
+        return {k: [c.copy() for c in v] for k, v in self.conds.items()}
+
+prepared = PreparedSampling()
+
+def prepare_sampling(model: ModelPatcher, noise_shape, conds, model_options=None, session=None):
     real_model: BaseModel = None
     models, inference_memory = get_additional_models(conds, model.model_dtype())
     models += get_additional_models_from_model_options(model_options)
     models += model.get_nested_additional_models()  # TODO: does this require inference_memory update?
+    adapter_batch = comfy.multi_lora.prepare_adapter_batch(model, conds)
+    if adapter_batch is not None:
+        inference_memory += adapter_batch.size()
     memory_required = model.memory_required([noise_shape[0] * 2] + list(noise_shape[1:])) + inference_memory
     minimum_memory_required = model.memory_required([noise_shape[0]] + list(noise_shape[1:])) + inference_memory
-    comfy.model_management.load_models_gpu([model] + models, memory_required=memory_required, minimum_memory_required=minimum_memory_required)
+    if session is not None:
+        session.use([model] + models)
+    if not prepared.models_loaded([model] + models, memory_required):
+        comfy.model_management.load_models_gpu([model] + models, memory_required=memory_required, minimum_memory_required=minimum_memory_required)
+        prepared.set_models([model] + models, memory_required)
     real_model = model.model
+    if adapter_batch is not None:
+        adapter_batch.move_to(model.load_device)
+        if model_options is not None:
+            model_options["lora_adapter_batch"] = adapter_batch
 
     return real_model, conds, models
 
@@ -16,22 +16,41 @@ import comfy.sampler_helpers
 import comfy.model_patcher
 import comfy.patcher_extension
 import comfy.hooks
+import comfy.memory_estimator
+import comfy.step_batching
+import comfy.sampling_checkpoint
+import comfy.multi_lora
+import comfy.ldm.modules.diffusionmodules.openaimodel
+from comfy.cli_args import args
 import scipy.stats
 import numpy
 
-def get_area_and_mult(conds, x_in, timestep_in):
-    dims = tuple(x_in.shape[2:])
-    area = None
-    strength = 1.0
-
+def in_timestep_range(conds, timestep_in):
     if 'timestep_start' in conds:
         timestep_start = conds['timestep_start']
         if timestep_in[0] > timestep_start:
-            return None
+            return False
     if 'timestep_end' in conds:
         timestep_end = conds['timestep_end']
         if timestep_in[0] < timestep_end:
-            return None
+            return False
+    return True
+
+def area_input(x_in, area):
+    input_x = x_in
+    if area is not None:
+        dims = len(area) // 2
+        for i in range(dims):
+            input_x = input_x.narrow(i + 2, area[dims + i], area[i])
+    return input_x
+
+def get_area_and_mult(conds, x_in, timestep_in):
+    dims = tuple(x_in.shape[2:])
+    area = None
+    strength = 1.0
+
+    if not in_timestep_range(conds, timestep_in):
+        return None
     if 'area' in conds:
         area = list(conds['area'])
     if 'strength' in conds:
@@ -82,6 +101,7 @@ def get_area_and_mult(conds, x_in, timestep_in):
 
     hooks = conds.get('hooks', None)
     control = conds.get('control', None)
+    adapters = conds.get('lora_adapters', None)
 
     patches = None
     if 'gligen' in conds:
@@ -96,20 +116,109 @@ def get_area_and_mult(conds, x_in, timestep_in):
 
         patches['middle_patch'] = [gligen_patch]
 
-    cond_obj = collections.namedtuple('cond_obj', ['input_x', 'mult', 'conditioning', 'area', 'control', 'patches', 'uuid', 'hooks'])
-    return cond_obj(input_x, mult, conditioning, area, control, patches, conds['uuid'], hooks)
+    cond_obj = collections.namedtuple('cond_obj', ['input_x', 'mult', 'conditioning', 'area', 'control', 'patches', 'uuid', 'hooks', 'adapters'])
+    return cond_obj(input_x, mult, conditioning, area, control, patches, conds['uuid'], hooks, adapters)
+
+PACKING_MAX_GROWTH = 2.0
+
+def supports_cross_attn_mask(model, model_options):
+    diffusion_model = getattr(model, "diffusion_model", None)
+    if not isinstance(diffusion_model, comfy.ldm.modules.diffusionmodules.openaimodel.UNetModel) or diffusion_model.use_temporal_resblocks:
+        return False
+    transformer_options = model_options.get("transformer_options", {})
+    # these can change the context so the mask wouldn't match it
+    return "attn2_patch" not in transformer_options.get("patches", {}) and "attn2" not in transformer_options.get("patches_replace", {})
 
-def cond_equal_size(c1, c2):
+class CondAreaCache:
+    '''
+    The parts of get_area_and_mult that don't change during a sampling (areas, masks and mults, processed conds, gligen
+    patches) and which conds can be batched together, for every cond and input shape. Only the timestep range and the
+    input crop are done on every step.
+    With pack_areas the area conds can be grown to the size of bigger ones to be batched with them and with pad_context
+    prompts of different lengths get padded and masked instead of running separately.
+    '''
+    def __init__(self, pack_areas=False, pad_context=False):
+        self.pack_areas = pack_areas
+        self.pad_context = pad_context
+        self.entries = {}
+        self.sources = {}
+        self.grown_entries = {}
+        self.concat = {}
+
+    def get_area_and_mult(self, conds, x_in, timestep_in):
+        if not in_timestep_range(conds, timestep_in):
+            return None
+        key = (id(conds), tuple(x_in.shape), x_in.dtype, x_in.device)
+        entry = self.entries.get(key, None)
+        if entry is None:
+            # the cond dict is kept so its id stays valid
+            entry = (conds, get_area_and_mult(conds, x_in, timestep_in)._replace(input_x=None))
+            self.entries[key] = entry
+            self.sources[id(entry[1].conditioning)] = conds
+        p = entry[1]
+        return p._replace(input_x=area_input(x_in, p.area))
+
+    def grown(self, p, shape, x_in, timestep_in):
+        '''Returns p with its area grown to shape around it and a mult of 0 outside of the original area, None if it can't be.'''
+        conds = self.sources.get(id(p.conditioning), None)
+        if conds is None or p.area is None or p.control is not None or p.patches is not None:
+            return None
+        dims = len(p.area) // 2
+        size = tuple(shape[2:])
+        if len(size) != dims or tuple(shape[:2]) != tuple(x_in.shape[:2]):
+            return None
+        if any(size[i] < p.area[i] or size[i] > x_in.shape[i + 2] for i in range(dims)):
+            return None
+        if math.prod(size) > math.prod(p.area[:dims]) * PACKING_MAX_GROWTH:
+            return None
+
+        offsets = tuple(min(max(p.area[dims + i] - (size[i] - p.area[i]) // 2, 0), x_in.shape[i + 2] - size[i]) for i in range(dims))
+        area = size + offsets
+        key = (id(p.conditioning), area)
+        g = self.grown_entries.get(key, None)
+        if g is None:
+            c = conds.copy()
+            c["area"] = area
+            g = get_area_and_mult(c, x_in, timestep_in)
+            mult = torch.zeros_like(g.mult)
+            m = mult
+            for i in range(dims):
+                m = m.narrow(i + 2, p.area[dims + i] - offsets[i], p.area[i])
+            m.copy_(p.mult)
+            g = g._replace(input_x=None, mult=mult)
+            self.grown_entries[key] = (p, g)
+        else:
+            g = g[1]
+        return g._replace(input_x=area_input(x_in, g.area))
+
+    def can_concat_cond(self, c1, c2):
+        key = (id(c1.conditioning), id(c2.conditioning))
+        out = self.concat.get(key, None)
+        if out is None:
+            out = can_concat_cond(c1, c2, pad=self.pad_context)
+            self.concat[key] = out
+        return out
+
+def cond_area_and_mult(conds, x_in, timestep_in, model_options):
+    cache = model_options.get("cond_area_cache", None)
+    if cache is None:
+        return get_area_and_mult(conds, x_in, timestep_in)
+    return cache.get_area_and_mult(conds, x_in, timestep_in)
+
+def cond_equal_size(c1, c2, pad=False):
     if c1 is c2:
         return True
     if c1.keys() != c2.keys():
         return False
     for k in c1:
-        if not c1[k].can_concat(c2[k]):
+        if pad and hasattr(c1[k], "can_concat_padded"):
+            if not c1[k].can_concat_padded(c2[k]):
+                return False
+        elif not c1[k].can_concat(c2[k]):
             return False
     return True
 
-def can_concat_cond(c1, c2):
+def can_concat_cond(c1, c2, pad=False):
     if c1.input_x.shape != c2.input_x.shape:
         return False
 
@@ -127,7 +236,8 @@ def can_concat_cond(c1, c2):
     if not objects_concatable(c1.patches, c2.patches):
         return False
 
-    return cond_equal_size(c1.conditioning, c2.conditioning)
+    # controlnets get the conds without the attention mask
+    return cond_equal_size(c1.conditioning, c2.conditioning, pad=pad and c1.control is None)
 
 def cond_cat(c_list):
     temp = {}
@@ -144,6 +254,26 @@ def cond_cat(c_list):
 
     return out
 
+def cond_cat_padded(c_list):
+    # like cond_cat but the conds of different lengths get padded, returns the attention masks of the padding too
+    temp = {}
+    for x in c_list:
+        for k in x:
+            temp.setdefault(k, []).append(x[k])
+
+    out = {}
+    masks = {}
+    for k in temp:
+        conds = temp[k]
+        if hasattr(conds[0], "concat_padded"):
+            out[k], mask = conds[0].concat_padded(conds[1:])
+            if mask is not None:
+                masks[k] = mask
+        else:
+            out[k] = conds[0].concat(conds[1:])
+
+    return out, masks
+
 def finalize_default_conds(model: 'BaseModel', hooked_to_run: dict[comfy.hooks.HookGroup,list[tuple[tuple,int]]], default_conds: list[list[dict]], x_in, timestep, model_options):
     # need to figure out remaining unmasked area for conds
     default_mults = []
@@ -177,7 +307,7 @@ def finalize_default_conds(model: 'BaseModel', hooked_to_run: dict[comfy.hooks.H
         cond = default_conds[i]
         for x in cond:
             # do get_area_and_mult to get all the expected values
-            p = get_area_and_mult(x, x_in, timestep)
+            p = cond_area_and_mult(x, x_in, timestep, model_options)
             if p is None:
                 continue
             # replace p's mult with calculated mult
@@ -192,6 +322,9 @@ def calc_cond_batch(model: 'BaseModel', conds: list[list[dict]], x_in: torch.Ten
         _calc_cond_batch,
         comfy.patcher_extension.get_all_wrappers(comfy.patcher_extension.WrappersMP.CALC_COND_BATCH, model_options, is_model_options=True)
     )
+    checkpoint = model_options.get("sampling_checkpoint", None)
+    if checkpoint is not None:
+        return checkpoint.calc_cond_batch(lambda: executor.execute(model, conds, x_in, timestep, model_options), x_in)
     return executor.execute(model, conds, x_in, timestep, model_options)
 
 def _calc_cond_batch(model: 'BaseModel', conds: list[list[dict]], x_in: torch.Tensor, timestep, model_options):
@@ -214,7 +347,7 @@ def _calc_cond_batch(model: 'BaseModel', conds: list[list[dict]], x_in: torch.Te
                     default_c.append(x)
                     has_default_conds = True
                     continue
-                p = get_area_and_mult(x, x_in, timestep)
+                p = cond_area_and_mult(x, x_in, timestep, model_options)
                 if p is None:
                     continue
                 if p.hooks is not None:
@@ -228,17 +361,32 @@ def _calc_cond_batch(model: 'BaseModel', conds: list[list[dict]], x_in: torch.Te
 
     model.current_patcher.prepare_state(timestep)
 
+    cache = model_options.get("cond_area_cache", None)
+    concat_cond = can_concat_cond if cache is None else cache.can_concat_cond
+
+    pack_areas = cache is not None and cache.pack_areas
+
     # run every hooked_to_run separately
     for hooks, to_run in hooked_to_run.items():
+        if pack_areas:
+            # the smaller areas get grown to the size of the bigger ones
+            to_run.sort(key=lambda o: o[0].input_x[:1].numel(), reverse=True)
         while len(to_run) > 0:
             first = to_run[0]
             first_shape = first[0][0].shape
             to_batch_temp = []
             for x in range(len(to_run)):
-                if can_concat_cond(to_run[x][0], first[0]):
+                if concat_cond(to_run[x][0], first[0]):
                     to_batch_temp += [x]
+                elif pack_areas and to_run[x][0].input_x.shape != first_shape:
+                    grown = cache.grown(to_run[x][0], first_shape, x_in, timestep)
+                    if grown is not None and concat_cond(grown, first[0]):
+                        to_run[x] = (grown, to_run[x][1])
+                        to_batch_temp += [x]
 
             to_batch_temp.reverse()
+            oom_key = ("calc_cond_batch", tuple(first_shape))
+            to_batch_temp = to_batch_temp[:model_management.get_oom_safe_size(oom_key, len(to_batch_temp))]
             to_batch = to_batch_temp[:1]
 
             free_memory = model_management.get_free_memory(x_in.device)
@@ -249,121 +397,293 @@ def _calc_cond_batch(model: 'BaseModel', conds: list[list[dict]], x_in: torch.Te
                     to_batch = batch_amount
                     break
 
-            input_x = []
-            mult = []
-            c = []
-            cond_or_uncond = []
-            uuids = []
-            area = []
-            control = None
-            patches = None
-            for x in to_batch:
-                o = to_run.pop(x)
-                p = o[0]
-                input_x.append(p.input_x)
-                mult.append(p.mult)
-                c.append(p.conditioning)
-                area.append(p.area)
-                cond_or_uncond.append(o[1])
-                uuids.append(p.uuid)
-                control = p.control
-                patches = p.patches
-
-            batch_chunks = len(cond_or_uncond)
-            input_x = torch.cat(input_x)
-            c = cond_cat(c)
-            timestep_ = torch.cat([timestep] * batch_chunks)
-
-            transformer_options = model.current_patcher.apply_hooks(hooks=hooks)
-            if 'transformer_options' in model_options:
-                transformer_options = comfy.patcher_extension.merge_nested_dicts(transformer_options,
-                                                                                 model_options['transformer_options'],
-                                                                                 copy_dict1=False)
-
-            if patches is not None:
-                # TODO: replace with merge_nested_dicts function
-                if "patches" in transformer_options:
-                    cur_patches = transformer_options["patches"].copy()
-                    for p in patches:
-                        if p in cur_patches:
-                            cur_patches[p] = cur_patches[p] + patches[p]
-                        else:
-                            cur_patches[p] = patches[p]
-                    transformer_options["patches"] = cur_patches
-                else:
-                    transformer_options["patches"] = patches
+            batch = [to_run.pop(x) for x in to_batch]
+            if len(batch) == 1:
+                run_cond_batch_split(model, hooks, batch[0], timestep, model_options, out_conds, out_counts)
+                continue
 
-            transformer_options["cond_or_uncond"] = cond_or_uncond[:]
-            transformer_options["uuids"] = uuids[:]
-            transformer_options["sigmas"] = timestep
+            try:
+                run_cond_batch(model, hooks, batch, timestep, model_options, out_conds, out_counts)
+            except model_management.OOM_EXCEPTION:
+                # split the cond/uncond group, the smaller amount is used for this shape for the rest of the prompt
+                model_management.reduce_oom_safe_size(oom_key, len(batch))
+                to_run += batch
 
-            c['transformer_options'] = transformer_options
+    for i in range(len(out_conds)):
+        out_conds[i] /= out_counts[i]
 
-            if control is not None:
-                c['control'] = control.get_control(input_x, timestep_, c, len(cond_or_uncond), transformer_options)
+    return out_conds
 
-            if 'model_function_wrapper' in model_options:
-                output = model_options['model_function_wrapper'](model.apply_model, {"input": input_x, "timestep": timestep_, "c": c, "cond_or_uncond": cond_or_uncond}).chunk(batch_chunks)
-            else:
-                output = model.apply_model(input_x, timestep_, **c).chunk(batch_chunks)
-
-            for o in range(batch_chunks):
-                cond_index = cond_or_uncond[o]
-                a = area[o]
-                if a is None:
-                    out_conds[cond_index] += output[o] * mult[o]
-                    out_counts[cond_index] += mult[o]
+def run_cond_batch(model: 'BaseModel', hooks, batch, timestep, model_options, out_conds, out_counts, batch_offset=0):
+    input_x = []
+    mult = []
+    c = []
+    cond_or_uncond = []
+    uuids = []
+    area = []
+    adapter_segments = []
+    control = None
+    patches = None
+    for o in batch:
+        p = o[0]
+        adapter_segments.append((sum(x.shape[0] for x in input_x), p.input_x.shape[0], p.adapters))
+        input_x.append(p.input_x)
+        mult.append(p.mult)
+        c.append(p.conditioning)
+        area.append(p.area)
+        cond_or_uncond.append(o[1])
+        uuids.append(p.uuid)
+        control = p.control
+        patches = p.patches
+
+    batch_chunks = len(cond_or_uncond)
+    input_x = torch.cat(input_x)
+    masks = {}
+    cache = model_options.get("cond_area_cache", None)
+    if cache is not None and cache.pad_context and control is None:
+        c, masks = cond_cat_padded(c)
+    else:
+        c = cond_cat(c)
+    timestep_ = torch.cat([timestep] * batch_chunks)
+
+    transformer_options = model.current_patcher.apply_hooks(hooks=hooks)
+    if 'transformer_options' in model_options:
+        transformer_options = comfy.patcher_extension.merge_nested_dicts(transformer_options,
+                                                                         model_options['transformer_options'],
+                                                                         copy_dict1=False)
+
+    if patches is not None:
+        # TODO: replace with merge_nested_dicts function
+        if "patches" in transformer_options:
+            cur_patches = transformer_options["patches"].copy()
+            for p in patches:
+                if p in cur_patches:
+                    cur_patches[p] = cur_patches[p] + patches[p]
                 else:
-                    out_c = out_conds[cond_index]
-                    out_cts = out_counts[cond_index]
-                    dims = len(a) // 2
-                    for i in range(dims):
-                        out_c = out_c.narrow(i + 2, a[i + dims], a[i])
-                        out_cts = out_cts.narrow(i + 2, a[i + dims], a[i])
-                    out_c += output[o] * mult[o]
-                    out_cts += mult[o]
+                    cur_patches[p] = patches[p]
+            transformer_options["patches"] = cur_patches
+        else:
+            transformer_options["patches"] = patches
 
-    for i in range(len(out_conds)):
-        out_conds[i] /= out_counts[i]
+    transformer_options["cond_or_uncond"] = cond_or_uncond[:]
+    transformer_options["uuids"] = uuids[:]
+    transformer_options["sigmas"] = timestep
+    if "c_crossattn" in masks:
+        transformer_options["cross_attn_mask"] = masks["c_crossattn"]
 
-    return out_conds
+    c['transformer_options'] = transformer_options
+
+    if control is not None:
+        c['control'] = control.get_control(input_x, timestep_, c, len(cond_or_uncond), transformer_options)
+
+    measure = None
+    if control is None and not comfy.step_batching.concurrent(model):
+        measure = comfy.memory_estimator.measure_start(input_x.device)
+
+    adapter_batch = model_options.get("lora_adapter_batch", None)
+    if adapter_batch is not None and not adapter_batch.attach(adapter_segments):
+        adapter_batch = None
+
+    try:
+        if 'model_function_wrapper' in model_options:
+            with comfy.step_batching.evaluation(model):
+                output = model_options['model_function_wrapper'](model.apply_model, {"input": input_x, "timestep": timestep_, "c": c, "cond_or_uncond": cond_or_uncond}).chunk(batch_chunks)
+        else:
+            output = comfy.step_batching.apply_model(model, input_x, timestep_, c, mergeable=control is None and adapter_batch is None).chunk(batch_chunks)
+    finally:
+        if adapter_batch is not None:
+            adapter_batch.detach()
+
+    comfy.memory_estimator.measure_end(model, input_x.shape, input_x.device, measure)
+
+    for o in range(batch_chunks):
+        cond_index = cond_or_uncond[o]
+        a = area[o]
+        out_c = out_conds[cond_index].narrow(0, batch_offset, mult[o].shape[0])
+        out_cts = out_counts[cond_index].narrow(0, batch_offset, mult[o].shape[0])
+        if a is not None:
+            dims = len(a) // 2
+            for i in range(dims):
+                out_c = out_c.narrow(i + 2, a[i + dims], a[i])
+                out_cts = out_cts.narrow(i + 2, a[i + dims], a[i])
+        out_c += output[o] * mult[o]
+        out_cts += mult[o]
+
+def slice_cond_obj(p, start, end):
+    conditioning = {}
+    for k in p.conditioning:
+        c = p.conditioning[k]
+        if isinstance(c.cond, torch.Tensor) and c.cond.shape[0] == p.input_x.shape[0]:
+            c = c._copy_with(c.cond[start:end])
+        conditioning[k] = c
+    return p._replace(input_x=p.input_x[start:end], mult=p.mult[start:end], conditioning=conditioning)
+
+def run_cond_batch_split(model: 'BaseModel', hooks, o, timestep, model_options, out_conds, out_counts):
+    # runs a single cond, splitting it along the batch dimension if it runs out of memory
+    p = o[0]
+    batch_size = p.input_x.shape[0]
+    if batch_size == 1 or p.control is not None or p.patches is not None: # controlnets and gligen are prepared for the full batch
+        return run_cond_batch(model, hooks, [o], timestep, model_options, out_conds, out_counts)
+
+    oom_key = ("calc_cond_batch_split", tuple(p.input_x.shape))
+    chunk = model_management.get_oom_safe_size(oom_key, batch_size)
+    start = 0
+    while start < batch_size:
+        if chunk == batch_size:
+            sub, sub_timestep = o, timestep
+        else:
+            sub = (slice_cond_obj(p, start, start + chunk), o[1])
+            sub_timestep = timestep[start:start + chunk] if timestep.shape[0] == batch_size else timestep
+        try:
+            run_cond_batch(model, hooks, [sub], sub_timestep, model_options, out_conds, out_counts, batch_offset=start)
+        except model_management.OOM_EXCEPTION:
+            chunk = model_management.reduce_oom_safe_size(oom_key, chunk)
+            if chunk == 0:
+                raise
+            continue
+        start += chunk
 
 def calc_cond_uncond_batch(model, cond, uncond, x_in, timestep, model_options): #TODO: remove
     logging.warning("WARNING: The comfy.samplers.calc_cond_uncond_batch function is deprecated please use the calc_cond_batch one instead.")
     return tuple(calc_cond_batch(model, [cond, uncond], x_in, timestep, model_options))
 
-def cfg_function(model, cond_pred, uncond_pred, cond_scale, x, timestep, model_options={}, cond=None, uncond=None):
+def cfg_function(model, cond_pred, uncond_pred, cond_scale, x, timestep, model_options={}, cond=None, uncond=None, guidance_outputs={}):
     if "sampler_cfg_function" in model_options:
         args = {"cond": x - cond_pred, "uncond": x - uncond_pred, "cond_scale": cond_scale, "timestep": timestep, "input": x, "sigma": timestep,
-                "cond_denoised": cond_pred, "uncond_denoised": uncond_pred, "model": model, "model_options": model_options}
+                "cond_denoised": cond_pred, "uncond_denoised": uncond_pred, "model": model, "model_options": model_options, "guidance_outputs": guidance_outputs}
         cfg_result = x - model_options["sampler_cfg_function"](args)
     else:
         cfg_result = uncond_pred + (cond_pred - uncond_pred) * cond_scale
 
     for fn in model_options.get("sampler_post_cfg_function", []):
         args = {"denoised": cfg_result, "cond": cond, "uncond": uncond, "cond_scale": cond_scale, "model": model, "uncond_denoised": uncond_pred, "cond_denoised": cond_pred,
-                "sigma": timestep, "model_options": model_options, "input": x}
+                "sigma": timestep, "model_options": model_options, "input": x, "guidance_outputs": guidance_outputs}
         cfg_result = fn(args)
 
     return cfg_result
 
+class GuidancePass:
+    '''
+    An extra model evaluation that a guidance needs on every step, like the cond with perturbed self attention of PAG.
+    sampling_function evaluates the passes that are active at the sigma in the same batch as the cond and uncond and gives
+    their outputs to the cfg and post cfg functions in "guidance_outputs". The patches added by patch_model_options apply
+    to the whole batch so they must only change the rows of the pass, which they get with guidance_rows().
+    conds returns the conds of the pass, the positive ones by default.
+    '''
+    def __init__(self, patch_model_options=None, conds=None, sigma_start=float("inf"), sigma_end=0.0):
+        self.patch_model_options = patch_model_options
+        self.conds = conds
+        self.sigma_start = sigma_start
+        self.sigma_end = sigma_end
+
+    def __deepcopy__(self, memo):
+        # the pass is the key of its output, it has to stay the same object when the model options get cloned
+        return self
+
+    def active(self, timestep):
+        return self.sigma_end <= timestep[0].item() <= self.sigma_start
+
+    def get_conds(self, model, x, cond, uncond):
+        if self.conds is None:
+            return cond
+        return self.conds(model, x, cond, uncond)
+
+def set_model_options_guidance_pass(model_options, guidance_pass):
+    model_options["guidance_passes"] = model_options.get("guidance_passes", []) + [guidance_pass]
+    return model_options
+
+def guidance_pass_model_options(model_options, passes, first_index):
+    model_options = model_options.copy()
+    transformer_options = model_options.get("transformer_options", {}).copy()
+    transformer_options["guidance_pass_indexes"] = {p: first_index + i for i, p in enumerate(passes)}
+    model_options["transformer_options"] = transformer_options
+    for p in passes:
+        if p.patch_model_options is not None:
+            model_options = p.patch_model_options(model_options)
+    return model_options
+
+def guidance_rows(transformer_options, guidance_pass, batch_size):
+    '''The indexes of the rows of the guidance pass in the batch, None if it isn't in it.'''
+    index = transformer_options.get("guidance_pass_indexes", {}).get(guidance_pass, None)
+    cond_or_uncond = transformer_options.get("cond_or_uncond", None)
+    if index is None or cond_or_uncond is None or index not in cond_or_uncond:
+        return None
+    chunk = batch_size // len(cond_or_uncond)
+    return [r for i, c in enumerate(cond_or_uncond) if c == index for r in range(i * chunk, (i + 1) * chunk)]
+
+def run_guidance_pass(guidance_pass, model, cond, x, timestep, model_options):
+    '''Evaluates the pass on its own, for when its output isn't in the guidance outputs (custom guiders, etc...)'''
+    model_options = guidance_pass_model_options(model_options, [guidance_pass], 0)
+    return calc_cond_batch(model, [guidance_pass.get_conds(model, x, cond, None)], x, timestep, model_options)[0]
+
+class AdaptiveCFG:
+    '''
+    Stops evaluating the uncond once it barely matters: when the relative difference between the cond and uncond
+    predictions goes under the threshold only the cond gets evaluated on the next steps that are between sigma_start and
+    sigma_end. The uncond prediction of those steps is the cond one minus their last difference so the cfg and the
+    post cfg functions still get the guidance.
+    '''
+    def __init__(self, threshold, sigma_start=float("inf"), sigma_end=0.0):
+        self.threshold = threshold
+        self.sigma_start = sigma_start
+        self.sigma_end = sigma_end
+        self.delta = None
+        self.converged = False
+        self.skipped = 0
+
+    def in_range(self, timestep):
+        sigma = timestep[0].item()
+        return self.sigma_end <= sigma <= self.sigma_start
+
+    def skip_uncond(self, x, timestep):
+        return self.converged and self.delta is not None and self.delta.shape == x.shape and self.in_range(timestep)
+
+    def uncond_pred(self, cond_pred):
+        self.skipped += 1
+        return cond_pred - self.delta.to(cond_pred)
+
+    def update(self, cond_pred, uncond_pred, timestep):
+        self.delta = cond_pred - uncond_pred
+        if self.in_range(timestep):
+            difference = self.delta.abs().mean() / cond_pred.abs().mean().clamp(min=1e-6)
+            self.converged = difference.item() < self.threshold
+
 #The main sampling function shared by all the samplers
 #Returns denoised
 def sampling_function(model, x, timestep, uncond, cond, cond_scale, model_options={}, seed=None):
+    adaptive_cfg = model_options.get("adaptive_cfg_state", None)
+    skip_uncond = False
     if math.isclose(cond_scale, 1.0) and model_options.get("disable_cfg1_optimization", False) == False:
         uncond_ = None
+    elif adaptive_cfg is not None and uncond is not None and adaptive_cfg.skip_uncond(x, timestep):
+        uncond_ = None
+        skip_uncond = True
     else:
         uncond_ = uncond
 
     conds = [cond, uncond_]
-    out = calc_cond_batch(model, conds, x, timestep, model_options)
+    passes = [p for p in model_options.get("guidance_passes", []) if p.active(timestep)]
+    if len(passes) > 0:
+        # the extra evaluations of the guidances get batched with the cond and uncond
+        pass_conds = [p.get_conds(model, x, cond, uncond) for p in passes]
+        out = calc_cond_batch(model, conds + pass_conds, x, timestep, guidance_pass_model_options(model_options, passes, len(conds)))
+        guidance_outputs = dict(zip(passes, out[len(conds):]))
+        out = out[:len(conds)]
+    else:
+        out = calc_cond_batch(model, conds, x, timestep, model_options)
+        guidance_outputs = {}
+
+    if skip_uncond:
+        out[1] = adaptive_cfg.uncond_pred(out[0])
+    elif adaptive_cfg is not None and uncond_ is not None:
+        adaptive_cfg.update(out[0], out[1], timestep)
 
     for fn in model_options.get("sampler_pre_cfg_function", []):
         args = {"conds":conds, "conds_out": out, "cond_scale": cond_scale, "timestep": timestep,
                 "input": x, "sigma": timestep, "model": model, "model_options": model_options}
         out  = fn(args)
 
-    return cfg_function(model, out[0], out[1], cond_scale, x, timestep, model_options=model_options, cond=cond, uncond=uncond_)
+    return cfg_function(model, out[0], out[1], cond_scale, x, timestep, model_options=model_options, cond=cond, uncond=uncond if skip_uncond else uncond_, guidance_outputs=guidance_outputs)
 
 
 class KSamplerX0Inpaint:
@@ -919,13 +1239,18 @@ class CFGGuider:
         return sampling_function(self.inner_model, x, timestep, self.conds.get("negative", None), self.conds.get("positive", None), self.cfg, model_options=model_options, seed=seed)
 
     def inner_sample(self, noise, latent_image, device, sampler, sigmas, denoise_mask, callback, disable_pbar, seed):
+        latent_source = latent_image
         if latent_image is not None and torch.count_nonzero(latent_image) > 0: #Don't shift the empty latent image.
             latent_image = self.inner_model.process_latent_in(latent_image)
 
-        self.conds = process_conds(self.inner_model, noise, self.conds, device, latent_image, denoise_mask, seed)
+        self.conds = comfy.sampler_helpers.prepared.process_conds(process_conds, self.inner_model, noise, self.conds, device, latent_image, denoise_mask, seed, latent_source=latent_source)
 
         extra_model_options = comfy.model_patcher.create_model_options_clone(self.model_options)
         extra_model_options.setdefault("transformer_options", {})["sample_sigmas"] = sigmas
+        extra_model_options["cond_area_cache"] = CondAreaCache(pack_areas=args.pack_conds, pad_context=args.pack_conds and supports_cross_attn_mask(self.inner_model, extra_model_options))
+        adaptive_cfg = extra_model_options.get("adaptive_cfg", None)
+        if adaptive_cfg is not None:
+            extra_model_options["adaptive_cfg_state"] = AdaptiveCFG(**adaptive_cfg)
         extra_args = {"model_options": extra_model_options, "seed": seed}
 
         executor = comfy.patcher_extension.WrapperExecutor.new_class_executor(
@@ -934,27 +1259,41 @@ class CFGGuider:
             comfy.patcher_extension.get_all_wrappers(comfy.patcher_extension.WrappersMP.SAMPLER_SAMPLE, extra_args["model_options"], is_model_options=True)
         )
         samples = executor.execute(self, sigmas, extra_args, callback, noise, latent_image, denoise_mask, disable_pbar)
+        if adaptive_cfg is not None:
+            logging.info("Adaptive CFG: skipped the uncond on {} model calls.".format(extra_model_options["adaptive_cfg_state"].skipped))
         return self.inner_model.process_latent_out(samples.to(torch.float32))
 
     def outer_sample(self, noise, latent_image, sampler, sigmas, denoise_mask=None, callback=None, disable_pbar=False, seed=None):
-        self.inner_model, self.conds, self.loaded_models = comfy.sampler_helpers.prepare_sampling(self.model_patcher, noise.shape, self.conds, self.model_options)
-        device = self.model_patcher.load_device
-
-        if denoise_mask is not None:
-            denoise_mask = comfy.sampler_helpers.prepare_mask(denoise_mask, noise.shape, device)
-
-        noise = noise.to(device)
-        latent_image = latent_image.to(device)
-        sigmas = sigmas.to(device)
-        cast_to_load_options(self.model_options, device=device, dtype=self.model_patcher.model_dtype())
-
-        try:
-            self.model_patcher.pre_run()
-            output = self.inner_sample(noise, latent_image, device, sampler, sigmas, denoise_mask, callback, disable_pbar, seed)
-        finally:
-            self.model_patcher.cleanup()
-
-        comfy.sampler_helpers.cleanup_models(self.conds, self.loaded_models)
+        checkpoint = None
+        if comfy.sampling_checkpoint.enabled():
+            checkpoint = comfy.sampling_checkpoint.begin(comfy.sampling_checkpoint.sampling_key(self.model_patcher, self.conds, self.model_options, noise, latent_image, sigmas, denoise_mask, sampler, self.cfg, seed))
+            self.model_options["sampling_checkpoint"] = checkpoint
+            callback = checkpoint.wrap_callback(callback)
+
+        shareable = len(self.model_patcher.hook_patches) == 0 and len(self.model_patcher.injections) == 0 and len(comfy.multi_lora.get_adapter_sets(self.conds)) == 0
+        with comfy.step_batching.SamplingSession(self.model_patcher, shareable) as session:
+            with session.loading():
+                self.inner_model, self.conds, self.loaded_models = comfy.sampler_helpers.prepare_sampling(self.model_patcher, noise.shape, self.conds, self.model_options, session=session)
+            device = self.model_patcher.load_device
+
+            if denoise_mask is not None:
+                denoise_mask = comfy.sampler_helpers.prepare_mask(denoise_mask, noise.shape, device)
+
+            noise = noise.to(device)
+            latent_image = latent_image.to(device)
+            sigmas = sigmas.to(device)
+            cast_to_load_options(self.model_options, device=device, dtype=self.model_patcher.model_dtype())
+
+            try:
+                with session.running():
+                    self.model_patcher.pre_run()
+                    output = self.inner_sample(noise, latent_image, device, sampler, sigmas, denoise_mask, callback, disable_pbar, seed)
+            finally:
+                self.model_patcher.cleanup()
+
+            comfy.sampler_helpers.cleanup_models(self.conds, self.loaded_models)
+        if checkpoint is not None:
+            checkpoint.close()
         del self.inner_model
         del self.loaded_models
         return output
@@ -0,0 +1,516 @@
+import collections
+import functools
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import threading
+import types
+import uuid
+
+import safetensors
+import torch
+
+import comfy.model_management
+import comfy.model_patcher
+import comfy.utils
+from comfy.cli_args import args
+
+# A sampling can be preempted at a step boundary so a more important prompt runs first, or interrupted. The outputs of
+# all the model evaluations (calc_cond_batch) of the sampling up to that step are kept in a checkpoint. When the same
+# sampling runs again the recorded outputs are replayed instead of evaluating the model, the sampler runs exactly like
+# it did the first time so the latent, the sampler history (multistep buffers, etc...) and the noise RNG state at the
+# checkpoint are the same for every sampler, and it continues from there with real model evaluations.
+# The key of a checkpoint is a hash of everything the model evaluations depend on: the conds, the patches and options
+# of the model, the sampler, the noise, etc... The first evaluation is also done for real and compared to the recorded
+# one to make sure the checkpoint belongs to this sampling. The recorded outputs grow with the steps so they get
+# spilled to disk in chunks, only the last ones are kept in ram.
+
+MAX_CHECKPOINTS = 8
+MAX_CHECKPOINT_MEMORY = 1024 * 1024 * 1024
+MAX_STORE_MEMORY = 4 * 1024 * 1024 * 1024
+FINGERPRINT_SIZE = 64
+KEY_FINGERPRINT_SIZE = 4096
+KEY_MODEL_TENSORS = 64
+KEY_MAX_DEPTH = 16
+KEY_SKIPPED_KEYS = ("uuid", "sampling_checkpoint")
+VALIDATION_TOLERANCE = 1e-4
+
+
+class SamplingPreempted(comfy.model_management.InterruptProcessingException):
+    pass
+
+
+# ids of the prompts that should stop at the end of their current sampling step, None for the samplings that don't run
+# in a prompt
+preempt_requested = set()
+preempt_requested_lock = threading.Lock()
+
+
+def enabled():
+    return args.preemptible_sampling
+
+
+def request_preemption(prompt_id=None):
+    '''
+    Makes the running sampling of the prompt (of all the running prompts if None) stop at the end of its current step,
+    the prompt gets requeued and resumes later.
+    '''
+    if not enabled():
+        return
+    with preempt_requested_lock:
+        if prompt_id is None:
+            preempt_requested.update(comfy.model_management.running_prompts)
+            preempt_requested.add(None)
+        else:
+            preempt_requested.add(prompt_id)
+
+
+def clear_preemption():
+    with preempt_requested_lock:
+        preempt_requested.discard(comfy.model_management.current_prompt_id())
+
+
+def take_preemption():
+    '''True if the sampling of the current thread should be preempted, the request is cleared.'''
+    with preempt_requested_lock:
+        prompt_id = comfy.model_management.current_prompt_id()
+        if prompt_id not in preempt_requested:
+            return False
+        preempt_requested.discard(prompt_id)
+        return True
+
+
+def to_cpu(x):
+    '''Copy to the cpu that doesn't wait for the device, call wait_copies() before reading the result.'''
+    if comfy.model_management.is_device_cuda(x.device):
+        out = torch.empty(x.shape, dtype=x.dtype, device="cpu", pin_memory=True)
+        out.copy_(x, non_blocking=True)
+        return out
+    return x.to("cpu", copy=True)
+
+
+def wait_copies():
+    if torch.cuda.is_available():
+        torch.cuda.synchronize()
+
+
+def fingerprint(x, size=FINGERPRINT_SIZE):
+    flat = x.reshape(-1)
+    index = torch.linspace(0, flat.shape[0] - 1, min(size, flat.shape[0]), device=flat.device).long()
+    return flat[index].to(torch.float32)
+
+
+class KeyHasher:
+    '''
+    Hashes the values the model evaluations of a sampling depend on. Tensors are hashed from a fingerprint and their sum,
+    functions from their code, constants and closure, model patchers from their patches and options and a fingerprint
+    of the weights of their model and other objects from their attributes. The fingerprints of all the tensors get
+    copied to the cpu at once in digest().
+    '''
+    def __init__(self):
+        self.h = hashlib.sha256()
+        self.tensors = []
+        self.seen = set()
+
+    def text(self, s):
+        self.h.update(s.encode())
+        self.h.update(b"\0")
+
+    def tensor(self, t):
+        self.text("tensor {} {}".format(t.dtype, tuple(t.shape)))
+        if t.numel() == 0:
+            return
+        if t.is_complex():
+            t = torch.view_as_real(t)
+        flat = t.detach().reshape(-1)
+        total = flat.sum(dtype=torch.float64).reshape(1)
+        self.tensors.append(torch.cat((fingerprint(flat, KEY_FINGERPRINT_SIZE).to(torch.float64), total)))
+
+    def model_weights(self, model_patcher):
+        # the original weights when they are patched, the patches get hashed separately
+        sd = model_patcher.model.state_dict()
+        keys = sorted(sd.keys())
+        step = max(1, len(keys) // KEY_MODEL_TENSORS)
+        for k in keys[::step]:
+            bk = model_patcher.backup.get(k, None)
+            self.text(k)
+            self.tensor(bk.weight if bk is not None else sd[k])
+
+    def update(self, v, depth=0):
+        if isinstance(v, (int, float, str, bytes, bool, type(None))):
+            self.text(repr(v))
+            return
+        if isinstance(v, torch.Tensor):
+            self.tensor(v)
+            return
+        if isinstance(v, (type, types.ModuleType)):
+            self.text("{} {}".format(type(v).__name__, getattr(v, "__qualname__", v.__name__)))
+            return
+        if depth > KEY_MAX_DEPTH or id(v) in self.seen:
+            self.text("<{}>".format(type(v).__qualname__))
+            return
+        self.seen.add(id(v))
+        depth += 1
+
+        if isinstance(v, dict):
+            self.text("dict {}".format(len(v)))
+            for k in sorted(v.keys(), key=repr):
+                if k in KEY_SKIPPED_KEYS:
+                    continue
+                self.update(k, depth)
+                self.update(v[k], depth)
+        elif isinstance(v, (list, tuple)):
+            self.text("{} {}".format(type(v).__name__, len(v)))
+            for x in v:
+                self.update(x, depth)
+        elif isinstance(v, (set, frozenset)):
+            self.text("set {}".format(len(v)))
+            for x in sorted(v, key=repr):
+                self.update(x, depth)
+        elif isinstance(v, types.FunctionType):
+            self.text("function {}.{}".format(v.__module__, v.__qualname__))
+            self.h.update(v.__code__.co_code)
+            self.update([c for c in v.__code__.co_consts if isinstance(c, (int, float, str, bytes, bool, type(None)))], depth)
+            self.update(v.__defaults__, depth)
+            self.update(v.__kwdefaults__, depth)
+            for cell in v.__closure__ or ():
+                try:
+                    self.update(cell.cell_contents, depth)
+                except ValueError: #empty cell
+                    self.text("empty")
+        elif isinstance(v, types.MethodType):
+            self.update(v.__func__, depth)
+            self.update(v.__self__, depth)
+        elif isinstance(v, functools.partial):
+            self.update((v.func, v.args, v.keywords), depth)
+        elif isinstance(v, comfy.model_patcher.ModelPatcher):
+            self.text("ModelPatcher {}".format(type(v.model).__qualname__))
+            self.model_weights(v)
+            self.update((v.patches, v.object_patches, v.weight_wrapper_patches, v.model_options, v.hook_patches,
+                         v.additional_models, v.callbacks, v.wrappers, v.injections), depth)
+        elif isinstance(v, torch.nn.Module):
+            self.text("module {}".format(type(v).__qualname__))
+            for k, t in v.state_dict().items():
+                self.text(k)
+                self.tensor(t)
+        elif hasattr(v, "__dict__"):
+            self.text("object {}".format(type(v).__qualname__))
+            self.update(vars(v), depth)
+        else:
+            self.text("object {}".format(type(v).__qualname__))
+
+    def digest(self):
+        by_device = collections.OrderedDict()
+        for i, t in enumerate(self.tensors):
+            by_device.setdefault(t.device, []).append(i)
+        values = [None] * len(self.tensors)
+        for device, indexes in by_device.items():
+            cpu = torch.cat([self.tensors[i] for i in indexes]).to("cpu")
+            for i, v in zip(indexes, cpu.split([self.tensors[i].shape[0] for i in indexes])):
+                values[i] = v
+        for v in values:
+            self.h.update(memoryview(v.contiguous().view(torch.uint8).numpy()))
+        return self.h.hexdigest()
+
+
+def sampler_name(sampler):
+    function = getattr(sampler, "sampler_function", None)
+    if function is None:
+        return sampler.__class__.__name__
+    options = []
+    for k, v in sorted(getattr(sampler, "extra_options", {}).items()) + sorted(getattr(sampler, "inpaint_options", {}).items()):
+        if not isinstance(v, (int, float, str, bool, type(None))):
+            v = type(v).__name__
+        options.append((k, v))
+    return "{}.{}{}".format(function.__module__, function.__qualname__, options)
+
+
+def sampling_key(model_patcher, conds, model_options, noise, latent_image, sigmas, denoise_mask, sampler, cfg, seed):
+    '''Hash of everything the outputs of the model evaluations of the sampling depend on.'''
+    h = hashlib.sha256()
+    h.update("{} {} {}".format(sampler_name(sampler), cfg, seed).encode())
+    for t in (noise, latent_image, sigmas, denoise_mask):
+        if t is None:
+            h.update(b"None")
+            continue
+        t = t.detach().to("cpu").contiguous()
+        h.update("{}{}".format(t.dtype, tuple(t.shape)).encode())
+        h.update(memoryview(t.reshape(-1).view(torch.uint8).numpy()))
+
+    hasher = KeyHasher()
+    hasher.update(model_patcher)
+    hasher.update(conds)
+    hasher.update(model_options)
+    h.update(hasher.digest().encode())
+    return h.hexdigest()
+
+
+def outputs_match(out, recorded):
+    for a, b in zip(out, recorded):
+        a = a.float()
+        b = b.float()
+        if (a - b).abs().mean() > VALIDATION_TOLERANCE * max(b.abs().mean().item(), 1e-6):
+            return False
+    return True
+
+
+class SamplingCheckpoint:
+    '''
+    The recorded outputs get copied to the cpu without waiting for the device. Once the ones kept in ram reach
+    MAX_CHECKPOINT_MEMORY they get written to a chunk file in the spill directory so the size of a checkpoint in ram
+    doesn't grow with the steps. If a chunk can't be written the recording stops, the recorded steps can still be
+    replayed but the sampling doesn't get preempted anymore.
+    '''
+    def __init__(self, key, fingerprints=None, chunks=None, steps=0):
+        self.key = key
+        self.id = uuid.uuid4().hex[:8]
+        self.fingerprints = fingerprints if fingerprints is not None else []
+        # the outputs that are in ram, None for the ones in the chunks
+        self.outputs = [None] * len(self.fingerprints)
+        # (first call, number of calls, path) of the chunk files
+        self.chunks = chunks if chunks is not None else []
+        self.steps = steps
+        self.memory = 0
+        self.full = False
+        self.restart()
+
+    def restart(self):
+        self.calls = 0
+        self.replay_calls = len(self.fingerprints)
+
+    def spilled_calls(self):
+        if len(self.chunks) == 0:
+            return 0
+        first, count, _ = self.chunks[-1]
+        return first + count
+
+    def recorded(self, call):
+        out = self.outputs[call]
+        if out is not None:
+            return out
+        for first, count, path in self.chunks:
+            if first <= call < first + count:
+                try:
+                    with safetensors.safe_open(path, framework="pt", device="cpu") as f:
+                        outputs = json.loads(f.metadata()["outputs"])[call - first]
+                        return [f.get_tensor("output.{}.{}".format(call, j)) for j in range(outputs)]
+                except Exception as e:
+                    logging.warning("Could not read the sampling checkpoint chunk {}: {}".format(path, e))
+        return None
+
+    def discard_replay(self, call):
+        logging.warning("The sampling checkpoint doesn't match this sampling, continuing without it.")
+        del self.outputs[call:]
+        del self.fingerprints[call:]
+        chunks = []
+        for first, count, path in self.chunks:
+            if first >= call:
+                remove_file(path)
+            else:
+                chunks.append((first, min(count, call - first), path))
+        self.chunks = chunks
+        self.memory = sum(o.nbytes for out in self.outputs if out is not None for o in out)
+        self.replay_calls = call
+
+    def spill(self, directory):
+        '''Writes the outputs that are in ram to a chunk file.'''
+        first = self.spilled_calls()
+        if first == len(self.outputs):
+            return True
+        wait_copies()
+        sd = {}
+        counts = []
+        for i in range(first, len(self.outputs)):
+            counts.append(len(self.outputs[i]))
+            for j, o in enumerate(self.outputs[i]):
+                sd["output.{}.{}".format(i, j)] = o.contiguous()
+        path = os.path.join(directory, "{}.{}.{}.outputs".format(self.key, self.id, len(self.chunks)))
+        try:
+            os.makedirs(directory, exist_ok=True)
+            comfy.utils.save_torch_file(sd, path, metadata={"outputs": json.dumps(counts)})
+        except Exception as e:
+            logging.warning("Could not write the sampling checkpoint to disk, the sampling can't be preempted anymore: {}".format(e))
+            remove_file(path)
+            self.full = True
+            return False
+        self.chunks.append((first, len(counts), path))
+        for i in range(first, len(self.outputs)):
+            self.outputs[i] = None
+        self.memory = 0
+        return True
+
+    def record(self, out, fp):
+        if self.full:
+            return
+        self.outputs.append([to_cpu(o) for o in out])
+        self.fingerprints.append(to_cpu(fp))
+        self.memory += sum(o.nbytes for o in out)
+        if self.memory > MAX_CHECKPOINT_MEMORY:
+            self.spill(store.spill_directory())
+
+    def calc_cond_batch(self, compute, x_in):
+        '''Replays the recorded output of this model evaluation if there is one, runs compute() and records it otherwise.'''
+        call = self.calls
+        self.calls += 1
+        fp = fingerprint(x_in)
+        out = None
+        if call < self.replay_calls:
+            if torch.equal(fp.to("cpu"), self.fingerprints[call]):
+                recorded = self.recorded(call)
+                if recorded is not None:
+                    recorded = [o.to(x_in.device) for o in recorded]
+                    if call > 0:
+                        return recorded
+                    out = compute()
+                    if outputs_match(out, recorded):
+                        return recorded
+            self.discard_replay(call)
+
+        if out is None:
+            out = compute()
+        self.record(out, fp)
+        return out
+
+    def wrap_callback(self, callback):
+        '''Returns the step callback for the sampler, the checkpoint is kept when the sampling gets interrupted.'''
+        def checkpoint_callback(step, x0, x, total_steps):
+            if not self.full:
+                self.steps = max(self.steps, step + 1)
+            try:
+                if callback is not None:
+                    callback(step, x0, x, total_steps)
+            except comfy.model_management.InterruptProcessingException:
+                store.put(self)
+                raise
+            self.step_done()
+        return checkpoint_callback
+
+    def step_done(self):
+        if self.calls >= self.replay_calls and not self.full and take_preemption():
+            store.put(self)
+            logging.info("Sampling preempted at step {}.".format(self.steps))
+            raise SamplingPreempted()
+
+    def close(self):
+        '''Deletes the chunk files, for when the sampling is done.'''
+        for _, _, path in self.chunks:
+            remove_file(path)
+        self.chunks = []
+        self.outputs = []
+        self.fingerprints = []
+        self.memory = 0
+
+    def index_state_dict(self):
+        sd = {"fingerprint.{}".format(i): fp for i, fp in enumerate(self.fingerprints)}
+        chunks = [(first, count, os.path.basename(path)) for first, count, path in self.chunks]
+        metadata = {"key": self.key, "steps": str(self.steps), "calls": str(len(self.fingerprints)), "chunks": json.dumps(chunks)}
+        return sd, metadata
+
+    @classmethod
+    def from_file(cls, key, path):
+        with safetensors.safe_open(path, framework="pt", device="cpu") as f:
+            metadata = f.metadata()
+            if metadata.get("key", None) != key:
+                return None
+            fingerprints = [f.get_tensor("fingerprint.{}".format(i)) for i in range(int(metadata["calls"]))]
+        directory = os.path.dirname(path)
+        chunks = [(first, count, os.path.join(directory, name)) for first, count, name in json.loads(metadata["chunks"])]
+        return cls(key, fingerprints, chunks, int(metadata["steps"]))
+
+
+def remove_file(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+
+class CheckpointStore:
+    '''
+    The checkpoints of the preempted or interrupted samplings. When directory is set all their outputs get written to
+    chunk files there with an index file per checkpoint so they can be resumed after a restart, otherwise the chunks
+    go to a temporary directory.
+    '''
+    def __init__(self, directory=None):
+        self.directory = directory
+        self.temp_directory = None
+        self.checkpoints = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def spill_directory(self):
+        if self.directory is not None:
+            return self.directory
+        with self.lock:
+            if self.temp_directory is None:
+                self.temp_directory = tempfile.mkdtemp(prefix="comfy_sampling_checkpoints_")
+            return self.temp_directory
+
+    def path(self, key):
+        return os.path.join(self.directory, "{}.safetensors".format(key))
+
+    def put(self, checkpoint):
+        wait_copies()
+        evicted = []
+        with self.lock:
+            self.checkpoints[checkpoint.key] = checkpoint
+            self.checkpoints.move_to_end(checkpoint.key)
+            while len(self.checkpoints) > 1 and (len(self.checkpoints) > MAX_CHECKPOINTS or sum(c.memory for c in self.checkpoints.values()) > MAX_STORE_MEMORY):
+                evicted.append(self.checkpoints.popitem(last=False)[1])
+
+        if self.directory is None:
+            for c in evicted:
+                c.close()
+            return
+        if not checkpoint.spill(self.directory):
+            return
+        try:
+            sd, metadata = checkpoint.index_state_dict()
+            temp_path = "{}.tmp".format(self.path(checkpoint.key))
+            comfy.utils.save_torch_file(sd, temp_path, metadata=metadata)
+            os.replace(temp_path, self.path(checkpoint.key))
+            files = sorted((os.path.join(self.directory, f) for f in os.listdir(self.directory) if f.endswith(".safetensors")), key=os.path.getmtime)
+            for f in files[:-MAX_CHECKPOINTS]:
+                self.remove(f)
+        except Exception as e:
+            logging.warning("Could not save the sampling checkpoint: {}".format(e))
+
+    def remove(self, path):
+        '''Removes an index file and the chunk files it uses.'''
+        try:
+            with safetensors.safe_open(path, framework="pt", device="cpu") as f:
+                chunks = json.loads(f.metadata()["chunks"])
+            for _, _, name in chunks:
+                remove_file(os.path.join(self.directory, name))
+        except Exception:
+            pass
+        remove_file(path)
+
+    def pop(self, key):
+        with self.lock:
+            checkpoint = self.checkpoints.pop(key, None)
+        if self.directory is None:
+            return checkpoint
+        path = self.path(key)
+        if os.path.isfile(path):
+            try:
+                if checkpoint is None:
+                    checkpoint = SamplingCheckpoint.from_file(key, path)
+                remove_file(path)
+            except Exception as e:
+                logging.warning("Could not load the sampling checkpoint {}: {}".format(path, e))
+        return checkpoint
+
+
+store = CheckpointStore()
+
+
+def begin(key):
+    '''Returns the checkpoint to record the sampling with, with the recorded evaluations to replay if it was preempted.'''
+    checkpoint = store.pop(key)
+    if checkpoint is None:
+        return SamplingCheckpoint(key)
+    logging.info("Resuming the sampling from step {}.".format(checkpoint.steps))
+    checkpoint.restart()
+    return checkpoint
@@ -4,6 +4,7 @@ from enum import Enum
 import logging
 
 from comfy import model_management
+from comfy.cli_args import args
 from comfy.utils import ProgressBar
 from .ldm.models.autoencoder import AutoencoderKL, AutoencodingEngine
 from .ldm.cascade.stage_a import StageA
@@ -43,6 +44,11 @@ import comfy.text_encoders.wan
 import comfy.model_patcher
 import comfy.lora
 import comfy.lora_convert
+import comfy.lora_cache
+import comfy.weight_delta
+import comfy.shared_models
+import comfy.tensor_intern
+import comfy.ops
 import comfy.hooks
 import comfy.t2i_adapter.adapter
 import comfy.taesd.taesd
@@ -56,8 +62,7 @@ def load_lora_for_models(model, clip, lora, strength_model, strength_clip):
     if clip is not None:
         key_map = comfy.lora.model_lora_keys_clip(clip.cond_stage_model, key_map)
 
-    lora = comfy.lora_convert.convert_lora(lora)
-    loaded = comfy.lora.load_lora(lora, key_map)
+    loaded = comfy.lora_cache.load_lora_patches(lora, key_map)
     if model is not None:
         new_modelpatcher = model.clone()
         k = new_modelpatcher.add_patches(loaded, strength_model)
@@ -80,10 +85,21 @@ def load_lora_for_models(model, clip, lora, strength_model, strength_clip):
     return (new_modelpatcher, new_clip)
 
 
+def weight_quantization_options(model_options):
+    '''Turns the "weight_quantization" model option ("int8" or "int4") into the matching custom operations.'''
+    quantization = model_options.get("weight_quantization", None)
+    if quantization is None or "custom_operations" in model_options:
+        return model_options
+    model_options = model_options.copy()
+    model_options["custom_operations"] = comfy.ops.WEIGHT_QUANTIZATION_OPS[quantization]
+    return model_options
+
+
 class CLIP:
     def __init__(self, target=None, embedding_directory=None, no_init=False, tokenizer_data={}, parameters=0, model_options={}):
         if no_init:
             return
+        model_options = weight_quantization_options(model_options)
         params = target.params.copy()
         clip = target.clip
         tokenizer = target.tokenizer
@@ -230,12 +246,15 @@ class CLIP:
 
     def load_sd(self, sd, full_model=False):
         if full_model:
-            return self.cond_stage_model.load_state_dict(sd, strict=False)
+            out = self.cond_stage_model.load_state_dict(sd, strict=False)
         else:
-            return self.cond_stage_model.load_sd(sd)
+            out = self.cond_stage_model.load_sd(sd)
+        if args.deduplicate_weights:
+            comfy.tensor_intern.intern_weights(self.cond_stage_model)
+        return out
 
     def get_sd(self):
-        sd_clip = self.cond_stage_model.state_dict()
+        sd_clip = comfy.ops.dequantize_state_dict(self.cond_stage_model, self.cond_stage_model.state_dict())
         sd_tokenizer = self.tokenizer.state_dict()
         for k in sd_tokenizer:
             sd_clip[k] = sd_tokenizer[k]
@@ -430,6 +449,8 @@ class VAE:
         self.vae_dtype = dtype
         self.first_stage_model.to(self.vae_dtype)
         self.output_device = model_management.intermediate_device()
+        if args.deduplicate_weights:
+            comfy.tensor_intern.intern_weights(self.first_stage_model)
 
         self.patcher = comfy.model_patcher.ModelPatcher(self.first_stage_model, load_device=self.device, offload_device=offload_device)
         logging.info("VAE load device: {}, offload device: {}, dtype: {}".format(self.device, offload_device, self.vae_dtype))
@@ -495,14 +516,23 @@ class VAE:
             model_management.load_models_gpu([self.patcher], memory_required=memory_used)
             free_memory = model_management.get_free_memory(self.device)
             batch_number = int(free_memory / memory_used)
-            batch_number = max(1, batch_number)
-
-            for x in range(0, samples_in.shape[0], batch_number):
-                samples = samples_in[x:x+batch_number].to(self.vae_dtype).to(self.device)
-                out = self.process_output(self.first_stage_model.decode(samples).to(self.output_device).float())
+            oom_key = ("vae_decode", tuple(samples_in.shape[1:]))
+            batch_number = model_management.get_oom_safe_size(oom_key, max(1, batch_number))
+
+            x = 0
+            while x < samples_in.shape[0]:
+                try:
+                    samples = samples_in[x:x+batch_number].to(self.vae_dtype).to(self.device)
+                    out = self.process_output(self.first_stage_model.decode(samples).to(self.output_device).float())
+                except model_management.OOM_EXCEPTION:
+                    batch_number = model_management.reduce_oom_safe_size(oom_key, batch_number)
+                    if batch_number == 0:
+                        raise
+                    continue
                 if pixel_samples is None:
                     pixel_samples = torch.empty((samples_in.shape[0],) + tuple(out.shape[1:]), device=self.output_device)
                 pixel_samples[x:x+batch_number] = out
+                x += batch_number
         except model_management.OOM_EXCEPTION:
             logging.warning("Warning: Ran out of memory when regular VAE decoding, retrying with tiled VAE decoding.")
             dims = samples_in.ndim - 2
@@ -556,14 +586,23 @@ class VAE:
             model_management.load_models_gpu([self.patcher], memory_required=memory_used)
             free_memory = model_management.get_free_memory(self.device)
             batch_number = int(free_memory / max(1, memory_used))
-            batch_number = max(1, batch_number)
+            oom_key = ("vae_encode", tuple(pixel_samples.shape[1:]))
+            batch_number = model_management.get_oom_safe_size(oom_key, max(1, batch_number))
             samples = None
-            for x in range(0, pixel_samples.shape[0], batch_number):
-                pixels_in = self.process_input(pixel_samples[x:x + batch_number]).to(self.vae_dtype).to(self.device)
-                out = self.first_stage_model.encode(pixels_in).to(self.output_device).float()
+            x = 0
+            while x < pixel_samples.shape[0]:
+                try:
+                    pixels_in = self.process_input(pixel_samples[x:x + batch_number]).to(self.vae_dtype).to(self.device)
+                    out = self.first_stage_model.encode(pixels_in).to(self.output_device).float()
+                except model_management.OOM_EXCEPTION:
+                    batch_number = model_management.reduce_oom_safe_size(oom_key, batch_number)
+                    if batch_number == 0:
+                        raise
+                    continue
                 if samples is None:
                     samples = torch.empty((pixel_samples.shape[0],) + tuple(out.shape[1:]), device=self.output_device)
                 samples[x:x + batch_number] = out
+                x += batch_number
 
         except model_management.OOM_EXCEPTION:
             logging.warning("Warning: Ran out of memory when regular VAE encoding, retrying with tiled VAE encoding.")
@@ -676,6 +715,7 @@ class CLIPType(Enum):
     WAN = 13
 
 
+@comfy.shared_models.shared_load("ckpt_paths")
 def load_clip(ckpt_paths, embedding_directory=None, clip_type=CLIPType.STABLE_DIFFUSION, model_options={}):
     clip_data = []
     for p in ckpt_paths:
@@ -872,7 +912,16 @@ def load_checkpoint(config_path=None, ckpt_path=None, output_vae=True, output_cl
 
     return (model, clip, vae)
 
+@comfy.shared_models.shared_load("ckpt_path")
 def load_checkpoint_guess_config(ckpt_path, output_vae=True, output_clip=True, output_clipvision=False, embedding_directory=None, output_model=True, model_options={}, te_model_options={}):
+    if ckpt_path.lower().endswith((".safetensors", ".sft")):
+        # don't load the whole file if the header already tells us it can't be loaded
+        try:
+            detected = model_detection.model_config_from_file(ckpt_path)[0] is not None
+        except Exception:
+            detected = True # let load_torch_file report what is wrong with the file
+        if not detected:
+            raise RuntimeError("ERROR: Could not detect model type of: {}".format(ckpt_path))
     sd = comfy.utils.load_torch_file(ckpt_path)
     out = load_state_dict_guess_config(sd, output_vae, output_clip, output_clipvision, embedding_directory, output_model, model_options, te_model_options=te_model_options)
     if out is None:
@@ -880,6 +929,7 @@ def load_checkpoint_guess_config(ckpt_path, output_vae=True, output_clip=True, o
     return out
 
 def load_state_dict_guess_config(sd, output_vae=True, output_clip=True, output_clipvision=False, embedding_directory=None, output_model=True, model_options={}, te_model_options={}):
+    model_options = weight_quantization_options(model_options)
     clip = None
     clipvision = None
     vae = None
@@ -912,10 +962,17 @@ def load_state_dict_guess_config(sd, output_vae=True, output_clip=True, output_c
         if output_clipvision:
             clipvision = clip_vision.load_clipvision_from_sd(sd, model_config.clip_vision_prefix, True)
 
-    if output_model:
+    delta_signature = None
+    if output_model and args.checkpoint_delta_swap:
+        delta_signature = comfy.weight_delta.model_signature(model_config, model_config.model_type(sd, diffusion_model_prefix), unet_dtype, manual_cast_dtype)
+        model_patcher = comfy.weight_delta.registry.load_variant(sd, diffusion_model_prefix, model_config, delta_signature)
+
+    if output_model and model_patcher is None:
         inital_load_device = model_management.unet_inital_load_device(parameters, unet_dtype)
         model = model_config.get_model(sd, diffusion_model_prefix, device=inital_load_device)
         model.load_model_weights(sd, diffusion_model_prefix)
+        if args.deduplicate_weights:
+            comfy.tensor_intern.intern_weights(model)
 
     if output_vae:
         vae_sd = comfy.utils.state_dict_prefix_replace(sd, {k: "" for k in model_config.vae_key_prefix}, filter_keys=True)
@@ -946,8 +1003,10 @@ def load_state_dict_guess_config(sd, output_vae=True, output_clip=True, output_c
     if len(left_over) > 0:
         logging.debug("left over keys: {}".format(left_over))
 
-    if output_model:
+    if output_model and model is not None:
         model_patcher = comfy.model_patcher.ModelPatcher(model, load_device=load_device, offload_device=model_management.unet_offload_device())
+        if delta_signature is not None:
+            comfy.weight_delta.registry.register(model_patcher, delta_signature)
         if inital_load_device != torch.device("cpu"):
             logging.info("loaded diffusion model directly to GPU")
             model_management.load_models_gpu([model_patcher], force_full_load=True)
@@ -956,6 +1015,7 @@ def load_state_dict_guess_config(sd, output_vae=True, output_clip=True, output_c
 
 
 def load_diffusion_model_state_dict(sd, model_options={}): #load unet in diffusers or regular format
+    model_options = weight_quantization_options(model_options)
     dtype = model_options.get("dtype", None)
 
     #Allow loading unets from checkpoint files
@@ -1011,12 +1071,15 @@ def load_diffusion_model_state_dict(sd, model_options={}): #load unet in diffuse
     model = model_config.get_model(new_sd, "")
     model = model.to(offload_device)
     model.load_model_weights(new_sd, "")
+    if args.deduplicate_weights:
+        comfy.tensor_intern.intern_weights(model)
     left_over = sd.keys()
     if len(left_over) > 0:
         logging.info("left over keys in unet: {}".format(left_over))
     return comfy.model_patcher.ModelPatcher(model, load_device=load_device, offload_device=offload_device)
 
 
+@comfy.shared_models.shared_load("unet_path")
 def load_diffusion_model(unet_path, model_options={}):
     sd = comfy.utils.load_torch_file(unet_path)
     model = load_diffusion_model_state_dict(sd, model_options=model_options)
@@ -1033,7 +1096,7 @@ def load_unet_state_dict(sd, dtype=None):
     logging.warning("The load_unet_state_dict function has been deprecated and will be removed please switch to: load_diffusion_model_state_dict")
     return load_diffusion_model_state_dict(sd, model_options={"dtype": dtype})
 
-def save_checkpoint(output_path, model, clip=None, vae=None, clip_vision=None, metadata=None, extra_keys={}):
+def save_checkpoint(output_path, model, clip=None, vae=None, clip_vision=None, metadata=None, extra_keys={}, scaled_fp8=None):
     clip_sd = None
     load_models = [model]
     if clip is not None:
@@ -1045,7 +1108,7 @@ def save_checkpoint(output_path, model, clip=None, vae=None, clip_vision=None, m
 
     model_management.load_models_gpu(load_models, force_patch_weights=True)
     clip_vision_sd = clip_vision.get_sd() if clip_vision is not None else None
-    sd = model.model.state_dict_for_saving(clip_sd, vae_sd, clip_vision_sd)
+    sd = model.model.state_dict_for_saving(clip_sd, vae_sd, clip_vision_sd, scaled_fp8=scaled_fp8)
     for k in extra_keys:
         sd[k] = extra_keys[k]
 
@@ -0,0 +1,101 @@
+import functools
+import inspect
+import logging
+import os
+import threading
+import weakref
+
+from comfy.cli_args import args
+
+# With --parallel-prompts every prompt worker has its own node cache. The models loaded from the same files with the
+# same options get shared between the workers so the prompts that use the same checkpoint use one copy of the model
+# and their sampling steps get batched together. The loads are only kept while a node cache still holds them.
+
+
+def enabled():
+    return args.parallel_prompts > 1
+
+
+def options_key(v):
+    if isinstance(v, dict):
+        return tuple(sorted((k, options_key(x)) for k, x in v.items()))
+    if isinstance(v, (list, tuple)):
+        return tuple(options_key(x) for x in v)
+    if v is None or isinstance(v, (str, int, float, bool)):
+        return v
+    return (type(v).__qualname__, id(v))
+
+
+def files_key(paths):
+    if isinstance(paths, (str, os.PathLike)):
+        paths = [paths]
+    out = []
+    for p in paths:
+        stat = os.stat(p)
+        out.append((os.path.realpath(p), stat.st_size, stat.st_mtime_ns))
+    return tuple(out)
+
+
+class SharedModels:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.loads = {}
+        self.key_locks = {}
+
+    def get(self, key):
+        entry = self.loads.get(key, None)
+        if entry is None:
+            return None
+        single, refs = entry
+        out = tuple(r() if r is not None else None for r in refs)
+        if any(o is None and r is not None for o, r in zip(out, refs)):
+            del self.loads[key]
+            return None
+        return out[0] if single else out
+
+    def put(self, key, out):
+        single = not isinstance(out, tuple)
+        items = (out,) if single else out
+        try:
+            refs = tuple(weakref.ref(o) if o is not None else None for o in items)
+        except TypeError:
+            return
+        for k in [k for k, (_, r) in self.loads.items() if any(x is not None and x() is None for x in r)]:
+            del self.loads[k]
+        self.loads[key] = (single, refs)
+
+    def load(self, key, load):
+        with self.lock:
+            key_lock = self.key_locks.setdefault(key, threading.Lock())
+        with key_lock:
+            with self.lock:
+                out = self.get(key)
+            if out is not None:
+                logging.info("Using the model that another prompt loaded from the same files.")
+                return out
+            out = load()
+            with self.lock:
+                self.put(key, out)
+                self.key_locks.pop(key, None)
+            return out
+
+
+models = SharedModels()
+
+
+def shared_load(path_arg):
+    '''Decorator for the model loading functions, path_arg is the name of their argument with the file path(s).'''
+    def decorator(load):
+        signature = inspect.signature(load)
+
+        @functools.wraps(load)
+        def wrapper(*args, **kwargs):
+            if not enabled():
+                return load(*args, **kwargs)
+            bound = signature.bind(*args, **kwargs)
+            bound.apply_defaults()
+            options = {k: v for k, v in bound.arguments.items() if k != path_arg}
+            key = (load.__qualname__, files_key(bound.arguments[path_arg]), options_key(options))
+            return models.load(key, functools.partial(load, *args, **kwargs))
+        return wrapper
+    return decorator
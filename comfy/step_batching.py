@@ -0,0 +1,392 @@
+import contextlib
+import threading
+import time
+import weakref
+
+import torch
+
+import comfy.model_management
+from comfy.cli_args import args
+
+# When prompts are executed in parallel (--parallel-prompts) the samplings that run on the same model at the same time
+# get their model evaluations merged into one batched call per step. Samplings join and leave at step boundaries and
+# can use different samplers, step counts and sigmas: an evaluation waits at most BATCH_WAIT for the evaluations of the
+# other samplings before it runs with the ones that are there. Only samplings with the same weight and object patches
+# can use a model at the same time, the other ones wait for the model to be free before loading it.
+
+BATCH_WAIT = 0.05
+TRANSFORMER_OPTIONS_BATCH_KEYS = ("cond_or_uncond", "uuids")
+TRANSFORMER_OPTIONS_SAMPLING_KEYS = ("sigmas", "sample_sigmas")
+
+
+def enabled():
+    return args.parallel_prompts > 1
+
+
+class ExecutionLock:
+    '''
+    Held by the prompt workers while they execute a prompt and released while the sampling loop of the prompt runs so
+    the other workers can execute their prompts up to their own sampling. save_state/restore_state are set by the
+    server to keep its per prompt state (client id, prompt id, node id) of the thread that releases the lock.
+    '''
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.save_state = None
+        self.restore_state = None
+
+    def __enter__(self):
+        self.lock.acquire()
+        self.local.held = True
+        return self
+
+    def __exit__(self, *args):
+        self.local.held = False
+        self.lock.release()
+
+    def release(self):
+        '''Releases the lock if the current thread holds it, returns True if it did.'''
+        if not getattr(self.local, "held", False):
+            return False
+        self.local.state = self.save_state() if self.save_state is not None else None
+        self.local.held = False
+        self.lock.release()
+        return True
+
+    def reacquire(self):
+        self.lock.acquire()
+        self.local.held = True
+        if self.restore_state is not None and self.local.state is not None:
+            self.restore_state(self.local.state)
+        self.local.state = None
+
+    def released_state(self):
+        '''The state saved when the current thread released the lock, None if it holds it or never did.'''
+        return getattr(self.local, "state", None)
+
+
+execution_lock = ExecutionLock()
+
+
+def same_tensor(a, b):
+    return a.shape == b.shape and torch.equal(a, b)
+
+
+def has_content(v):
+    if isinstance(v, dict):
+        return any(has_content(x) for x in v.values())
+    if isinstance(v, (list, tuple)):
+        return len(v) > 0
+    return v is not None
+
+
+def same_value(a, b):
+    if a is b:
+        return True
+    if isinstance(a, torch.Tensor) or isinstance(b, torch.Tensor):
+        return False
+    if isinstance(a, dict):
+        return isinstance(b, dict) and a.keys() == b.keys() and all(same_value(a[k], b[k]) for k in a)
+    if isinstance(a, (list, tuple)):
+        return type(a) is type(b) and len(a) == len(b) and all(same_value(x, y) for x, y in zip(a, b))
+    try:
+        return bool(a == b)
+    except Exception:
+        return False
+
+
+class EvalRequest:
+    def __init__(self, input_x, timestep, c):
+        self.input_x = input_x
+        self.timestep = timestep
+        self.c = c
+        self.rows = input_x.shape[0]
+        chunks = len(c.get("transformer_options", {}).get("cond_or_uncond", [None]))
+        self.chunk_rows = self.rows // max(chunks, 1)
+        self.ready = False
+        self.done = False
+        self.output = None
+        self.error = None
+
+    def is_batch_tensor(self, v):
+        return isinstance(v, torch.Tensor) and v.ndim > 0 and v.shape[0] == self.rows
+
+    def can_merge(self, other):
+        x, y = self.input_x, other.input_x
+        if x.shape[1:] != y.shape[1:] or x.dtype != y.dtype or x.device != y.device or self.chunk_rows != other.chunk_rows:
+            return False
+        if self.c.keys() != other.c.keys():
+            return False
+        for k in self.c:
+            a = self.c[k]
+            b = other.c[k]
+            if k == "transformer_options":
+                if a.keys() != b.keys():
+                    return False
+                extra = [o for o in a if o not in TRANSFORMER_OPTIONS_BATCH_KEYS + TRANSFORMER_OPTIONS_SAMPLING_KEYS]
+                if not all(same_value(a[o], b[o]) for o in extra):
+                    return False
+                # patches can depend on the sigmas so they only get merged at the same ones
+                if any(has_content(a[o]) for o in extra) and not all(same_tensor(a[o], b[o]) for o in TRANSFORMER_OPTIONS_SAMPLING_KEYS if o in a):
+                    return False
+            elif self.is_batch_tensor(a):
+                if not other.is_batch_tensor(b) or a.shape[1:] != b.shape[1:] or a.dtype != b.dtype:
+                    return False
+            elif not same_value(a, b):
+                return False
+        return True
+
+
+def merge_requests(batch):
+    first = batch[0]
+    c = {}
+    for k in first.c:
+        if k == "transformer_options":
+            transformer_options = first.c[k].copy()
+            for o in TRANSFORMER_OPTIONS_BATCH_KEYS:
+                if o in transformer_options:
+                    transformer_options[o] = sum([list(r.c[k][o]) for r in batch], [])
+            if "sigmas" in transformer_options:
+                sigmas = [r.c[k]["sigmas"] for r in batch]
+                if not all(same_tensor(s, sigmas[0]) for s in sigmas[1:]):
+                    transformer_options["sigmas"] = torch.cat(sigmas)
+            c[k] = transformer_options
+        elif first.is_batch_tensor(first.c[k]):
+            c[k] = torch.cat([r.c[k] for r in batch])
+        else:
+            c[k] = first.c[k]
+    return torch.cat([r.input_x for r in batch]), torch.cat([r.timestep for r in batch]), c
+
+
+class ModelScheduler:
+    '''Schedules the model evaluations of the samplings that use the same model at the same time.'''
+    def __init__(self):
+        self.cond = threading.Condition()
+        self.model_lock = threading.RLock()
+        self.users = 0
+        self.waiting = 0
+        self.state = None
+        self.patchers = []
+        self.pending = []
+
+    def acquire(self, state):
+        '''Waits until the model can be used with the weight state, None for exclusive use.'''
+        with self.cond:
+            self.waiting += 1
+            while not (self.users == 0 or (state is not None and state == self.state and self.waiting == 1)):
+                self.cond.wait()
+            self.waiting -= 1
+            self.users += 1
+            self.state = state
+
+    def release(self):
+        with self.cond:
+            self.users -= 1
+            if self.users == 0:
+                self.state = None
+            self.cond.notify_all()
+
+    def join(self, patcher):
+        with self.cond:
+            self.patchers.append(patcher)
+            self.cond.notify_all()
+
+    def leave(self, patcher):
+        with self.cond:
+            self.patchers.remove(patcher)
+            self.cond.notify_all()
+
+    def take_batch(self, model, request):
+        batch = [request]
+        rows = request.rows
+        free_memory = comfy.model_management.get_free_memory(request.input_x.device)
+        for r in self.pending:
+            if r is request or not request.can_merge(r):
+                continue
+            input_shape = [rows + r.rows] + list(request.input_x.shape[1:])
+            if model.memory_required(input_shape) * 1.5 > free_memory:
+                continue
+            batch.append(r)
+            rows += r.rows
+
+        self.pending = [r for r in self.pending if r not in batch]
+        for r in self.pending:
+            r.ready = True
+        return batch
+
+    def run(self, model, batch):
+        with self.model_lock:
+            try:
+                if len(batch) > 1:
+                    try:
+                        input_x, timestep, c = merge_requests(batch)
+                        output = model.apply_model(input_x, timestep, **c)
+                        for r, o in zip(batch, output.split([r.rows for r in batch])):
+                            r.output = o
+                    except comfy.model_management.OOM_EXCEPTION:
+                        # run them one by one instead
+                        comfy.model_management.soft_empty_cache()
+
+                for r in batch:
+                    if r.output is None:
+                        r.output = model.apply_model(r.input_x, r.timestep, **r.c)
+            except Exception as e:
+                for r in batch:
+                    r.error = e
+
+        with self.cond:
+            for r in batch:
+                r.done = True
+            self.cond.notify_all()
+
+    def apply_model(self, model, input_x, timestep, c):
+        request = EvalRequest(input_x, timestep, c)
+        batch = None
+        with self.cond:
+            if len(self.patchers) <= 1:
+                batch = [request]
+            else:
+                self.pending.append(request)
+                self.cond.notify_all()
+                deadline = time.monotonic() + BATCH_WAIT
+                while not request.done:
+                    if request in self.pending:
+                        remaining = deadline - time.monotonic()
+                        if request.ready or remaining <= 0 or len(self.pending) >= len(self.patchers):
+                            batch = self.take_batch(model, request)
+                            break
+                        self.cond.wait(remaining)
+                    else:
+                        self.cond.wait()
+
+        if batch is not None:
+            self.run(model, batch)
+        if request.error is not None:
+            raise request.error
+        return request.output
+
+
+schedulers = weakref.WeakKeyDictionary()
+schedulers_lock = threading.Lock()
+
+
+def get_scheduler(model, create=False):
+    if not enabled():
+        return None
+    with schedulers_lock:
+        scheduler = schedulers.get(model, None)
+        if scheduler is None and create:
+            scheduler = ModelScheduler()
+            schedulers[model] = scheduler
+        return scheduler
+
+
+def weight_state(model_patcher):
+    return (model_patcher.patches_uuid, tuple(sorted((k, id(v)) for k, v in model_patcher.object_patches.items())))
+
+
+models_in_use = weakref.WeakKeyDictionary()
+models_in_use_lock = threading.Lock()
+
+
+class SamplingSession:
+    '''
+    Wraps a sampling: the model is acquired when entering it and the execution lock is released while running() so
+    the model evaluations get merged with the ones of the other samplings of the model.
+    Samplings that aren't shareable (hooks, injections, lora adapters, etc...) get exclusive use of the model.
+    '''
+    def __init__(self, model_patcher, shareable=True):
+        self.model_patcher = model_patcher
+        self.state = weight_state(model_patcher) if shareable else None
+        self.scheduler = get_scheduler(model_patcher.model, create=True)
+        self.released = False
+        self.models = []
+
+    def __enter__(self):
+        if self.scheduler is not None:
+            self.scheduler.acquire(self.state)
+        return self
+
+    def __exit__(self, *args):
+        with models_in_use_lock:
+            for m in self.models:
+                models_in_use[m] -= 1
+                if models_in_use[m] == 0:
+                    del models_in_use[m]
+        self.models = []
+        if self.scheduler is not None:
+            self.scheduler.release()
+        if self.released:
+            self.released = False
+            execution_lock.reacquire()
+
+    def use(self, model_patchers):
+        '''Keeps the models (controlnets, gligen, hook models, etc...) from being unloaded by the other samplings.'''
+        if self.scheduler is None:
+            return
+        with models_in_use_lock:
+            for p in model_patchers:
+                models_in_use[p.model] = models_in_use.get(p.model, 0) + 1
+                self.models.append(p.model)
+
+    def loading(self):
+        '''Held while the model is loaded so it doesn't happen during an evaluation of the other samplings.'''
+        if self.scheduler is None:
+            return contextlib.nullcontext()
+        return self.scheduler.model_lock
+
+    @contextlib.contextmanager
+    def running(self):
+        if self.scheduler is None:
+            yield
+            return
+        self.released = execution_lock.release() or self.released
+        self.scheduler.join(self.model_patcher)
+        try:
+            yield
+        finally:
+            self.scheduler.leave(self.model_patcher)
+
+
+def apply_model(model, input_x, timestep, c, mergeable=True):
+    scheduler = get_scheduler(model)
+    if scheduler is None:
+        return model.apply_model(input_x, timestep, **c)
+    if not mergeable:
+        with scheduler.model_lock:
+            return model.apply_model(input_x, timestep, **c)
+    return scheduler.apply_model(model, input_x, timestep, c)
+
+
+def evaluation(model):
+    '''Held around the model evaluations that don't go through apply_model.'''
+    scheduler = get_scheduler(model)
+    if scheduler is None:
+        return contextlib.nullcontext()
+    return scheduler.model_lock
+
+
+def concurrent(model):
+    '''True if other samplings are running on the model.'''
+    scheduler = get_scheduler(model)
+    return scheduler is not None and len(scheduler.patchers) > 1
+
+
+def in_use(model):
+    scheduler = get_scheduler(model)
+    if scheduler is not None and scheduler.users > 0:
+        return True
+    with models_in_use_lock:
+        return model in models_in_use
+
+
+def running_patcher(model, exclude=None):
+    '''A patcher of a sampling that is still running on the model, what model.current_patcher gets set to on cleanup.'''
+    scheduler = get_scheduler(model)
+    if scheduler is None:
+        return None
+    with scheduler.cond:
+        for p in reversed(scheduler.patchers):
+            if p is not exclude:
+                return p
+    return None
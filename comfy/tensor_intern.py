@@ -0,0 +1,151 @@
+import hashlib
+import logging
+import weakref
+
+import torch
+
+import comfy.utils
+
+# Identical weights of different models (the same VAE or text encoder in multiple checkpoints, a text encoder loaded
+# both from a checkpoint and with a CLIPLoader, etc...) share the same ram. Shared weights must never be modified in
+# place, make_private gives a model its own copy of a weight before that. Sharing only applies to weights in ram,
+# when a model is loaded to the GPU it gets its own copy and when it gets offloaded the weights that are identical to
+# an interned one are replaced by it again. Only weak references to the interned weights are kept so the ram of a
+# weight gets freed once no model uses it.
+
+MIN_SIZE = 64 * 1024
+SAMPLE_COUNT = 16
+SAMPLE_SIZE = 4096
+
+
+def tensor_bytes(tensor):
+    return tensor.reshape(-1).view(torch.uint8)
+
+
+def sampled_digest(tensor):
+    '''Cheap digest of the dtype, shape and a few evenly spaced ranges of the data, collisions are handled by comparing the full tensors.'''
+    data = tensor_bytes(tensor)
+    h = hashlib.blake2b(digest_size=16)
+    h.update("{}{}".format(tensor.dtype, tuple(tensor.shape)).encode())
+    size = data.shape[0]
+    if size <= SAMPLE_COUNT * SAMPLE_SIZE:
+        h.update(memoryview(data.numpy()))
+    else:
+        step = (size - SAMPLE_SIZE) // (SAMPLE_COUNT - 1)
+        for i in range(SAMPLE_COUNT):
+            h.update(memoryview(data[i * step:i * step + SAMPLE_SIZE].numpy()))
+    return h.digest()
+
+
+class TensorRef:
+    '''Weak reference to the data of a tensor, valid as long as any tensor uses its storage.'''
+    def __init__(self, tensor):
+        self.storage = weakref.ref(tensor.untyped_storage())
+        self.dtype = tensor.dtype
+        self.shape = tensor.shape
+        self.stride = tensor.stride()
+        self.offset = tensor.storage_offset()
+
+    def __call__(self):
+        storage = self.storage()
+        if storage is None:
+            return None
+        return torch.empty(0, dtype=self.dtype).set_(storage, self.offset, self.shape, self.stride)
+
+    def uses(self, tensor):
+        '''True if tensor is the referenced one (same data).'''
+        storage = self.storage()
+        return storage is not None and tensor.untyped_storage().data_ptr() == storage.data_ptr() and tensor.storage_offset() == self.offset and tensor.dtype == self.dtype and tensor.shape == self.shape
+
+
+class TensorInterner:
+    def __init__(self):
+        self.tensors = {}
+
+    def intern(self, tensor):
+        '''Returns the already interned tensor with the same content as tensor or interns tensor and returns it.'''
+        digest = sampled_digest(tensor)
+        refs = [r for r in self.tensors.get(digest, []) if r.storage() is not None]
+        for r in refs:
+            t = r()
+            if t is not None and t.dtype == tensor.dtype and t.shape == tensor.shape and torch.equal(tensor_bytes(t), tensor_bytes(tensor)):
+                return t
+        refs.append(TensorRef(tensor))
+        self.tensors[digest] = refs
+        return tensor
+
+
+interner = TensorInterner()
+
+
+def can_intern(tensor):
+    return tensor.device.type == "cpu" and tensor.is_contiguous() and tensor.nbytes >= MIN_SIZE
+
+
+def intern_weight(model, interned, name, weight):
+    '''Replaces the weight name of model by the interned one if they are identical, returns the bytes saved.'''
+    tensor = weight.detach()
+    t = interner.intern(tensor)
+    saved = 0
+    if t is not tensor:
+        comfy.utils.set_attr_param(model, name, t)
+        saved = t.nbytes
+    interned[name] = TensorRef(t)
+    return saved
+
+
+def intern_weights(model):
+    '''
+    Replaces the weights of model that are identical to weights of other interned models with the shared ones.
+    model.interned_weights keeps weak references to the interned weights of the model.
+    '''
+    interned = getattr(model, "interned_weights", {})
+    saved = 0
+    for name, param in list(model.named_parameters()):
+        if not can_intern(param):
+            continue
+        r = interned.get(name, None)
+        if r is not None and r.uses(param):
+            continue
+        saved += intern_weight(model, interned, name, param)
+
+    model.interned_weights = interned
+    if saved > 0:
+        logging.info("Shared {:.2f} MB of weights with other loaded models.".format(saved / (1024 * 1024)))
+    return saved
+
+
+def is_shared(model, key):
+    interned = getattr(model, "interned_weights", None)
+    if interned is None:
+        return False
+    r = interned.get(key, None)
+    if r is None:
+        return False
+    return r.uses(comfy.utils.get_attr(model, key))
+
+
+def make_private(model, key):
+    '''Gives model its own copy of the weight key if it is shared so it can be modified in place.'''
+    if is_shared(model, key):
+        comfy.utils.set_attr_param(model, key, comfy.utils.get_attr(model, key).detach().clone())
+
+
+def restore_shared(model, keys=None):
+    '''
+    Called after the weights (keys or all the interned ones) of model got moved back to the cpu: the ones that have the
+    same content as an interned weight get replaced by it.
+    '''
+    interned = getattr(model, "interned_weights", None)
+    if interned is None:
+        return
+    if keys is None:
+        keys = list(interned.keys())
+    for k in keys:
+        r = interned.get(k, None)
+        if r is None:
+            continue
+        weight = comfy.utils.get_attr(model, k)
+        if not can_intern(weight) or r.uses(weight):
+            continue
+        intern_weight(model, interned, k, weight)
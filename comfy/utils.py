@@ -19,6 +19,9 @@
 
 import torch
 import math
+import os
+import hashlib
+import json
 import struct
 import comfy.checkpoint_pickle
 import safetensors.torch
@@ -28,6 +31,7 @@ import logging
 import itertools
 from torch.nn.functional import interpolate
 from einops import rearrange
+from comfy.cli_args import args
 
 ALWAYS_SAFE_LOAD = False
 if hasattr(torch.serialization, "add_safe_globals"):  # TODO: this was added in pytorch 2.4, the unsafe path should be removed once earlier versions are deprecated
@@ -46,9 +50,55 @@ if hasattr(torch.serialization, "add_safe_globals"):  # TODO: this was added in
 else:
     logging.info("Warning, you are using an old pytorch version and some ckpt/pt files might be loaded unsafely. Upgrading to 2.4 or above is recommended.")
 
+def converted_ckpt_path(ckpt):
+    '''Returns the path of the safetensors copy of a pickled checkpoint in the conversion cache and the prefix shared by all the copies of that file.'''
+    stat = os.stat(ckpt)
+    path_key = hashlib.sha256(os.path.abspath(ckpt).encode()).hexdigest()[:16]
+    file_key = hashlib.sha256("{}:{}".format(stat.st_size, stat.st_mtime_ns).encode()).hexdigest()[:16]
+    prefix = "{}_{}_".format(os.path.splitext(os.path.basename(ckpt))[0], path_key)
+    return os.path.join(args.ckpt_conversion_cache, "{}{}.safetensors".format(prefix, file_key)), prefix
+
+def save_converted_ckpt(sd, ckpt, path, prefix):
+    if len(sd) == 0 or not all(isinstance(k, str) and isinstance(v, torch.Tensor) for k, v in sd.items()):
+        return
+    out = {}
+    storages = set()
+    for k, v in sd.items():
+        # safetensors can't store tensors that share memory
+        ptr = (v.untyped_storage().data_ptr(), v.device)
+        if ptr in storages or not v.is_contiguous():
+            v = v.clone(memory_format=torch.contiguous_format)
+        storages.add(ptr)
+        out[k] = v
+
+    temp_path = None
+    try:
+        cache_dir = os.path.dirname(path)
+        os.makedirs(cache_dir, exist_ok=True)
+        temp_path = "{}.tmp{}".format(path, os.getpid())
+        safetensors.torch.save_file(out, temp_path, metadata={"format": "pt", "source": os.path.abspath(ckpt)})
+        os.replace(temp_path, path)
+        for f in os.listdir(cache_dir):
+            if f.startswith(prefix) and os.path.join(cache_dir, f) != path:
+                os.remove(os.path.join(cache_dir, f))
+        logging.info("Saved a safetensors copy of {} to {}".format(ckpt, path))
+    except Exception as e:
+        logging.warning("Could not save a safetensors copy of {}: {}".format(ckpt, e))
+        if temp_path is not None and os.path.exists(temp_path):
+            os.remove(temp_path)
+
 def load_torch_file(ckpt, safe_load=False, device=None):
     if device is None:
         device = torch.device("cpu")
+    converted_path = None
+    if args.ckpt_conversion_cache is not None and not (ckpt.lower().endswith(".safetensors") or ckpt.lower().endswith(".sft")):
+        converted_path, converted_prefix = converted_ckpt_path(ckpt)
+        if os.path.isfile(converted_path):
+            try:
+                return load_torch_file(converted_path, device=device)
+            except Exception as e:
+                logging.warning("Could not load the cached safetensors copy of {}, loading the original file: {}".format(ckpt, e))
+
     if ckpt.lower().endswith(".safetensors") or ckpt.lower().endswith(".sft"):
         try:
             sd = safetensors.torch.load_file(ckpt, device=device.type)
@@ -77,6 +127,8 @@ def load_torch_file(ckpt, safe_load=False, device=None):
                     sd = pl_sd
             else:
                 sd = pl_sd
+        if converted_path is not None:
+            save_converted_ckpt(sd, ckpt, converted_path, converted_prefix)
     return sd
 
 def save_torch_file(sd, ckpt, metadata=None):
@@ -696,6 +748,23 @@ def safetensors_header(safetensors_path, max_size=100*1024*1024):
             return None
         return f.read(length_of_header)
 
+SAFETENSORS_DTYPES = {"F64": torch.float64, "F32": torch.float32, "F16": torch.float16, "BF16": torch.bfloat16,
+                      "I64": torch.int64, "I32": torch.int32, "I16": torch.int16, "I8": torch.int8, "U8": torch.uint8, "BOOL": torch.bool,
+                      "F8_E4M3": getattr(torch, "float8_e4m3fn", None), "F8_E5M2": getattr(torch, "float8_e5m2", None)}
+
+def safetensors_header_state_dict(header):
+    '''Returns a state dict of meta tensors with the shapes and dtypes of the tensors in a safetensors header, useful to inspect a file without loading it.'''
+    header = json.loads(header)
+    sd = {}
+    for k, v in header.items():
+        if k == "__metadata__":
+            continue
+        dtype = SAFETENSORS_DTYPES.get(v["dtype"], None)
+        if dtype is None:
+            dtype = torch.uint8
+        sd[k] = torch.empty(v["shape"], dtype=dtype, device="meta")
+    return sd
+
 def set_attr(obj, attr, value):
     attrs = attr.split(".")
     for name in attrs[:-1]:
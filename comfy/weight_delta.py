@@ -0,0 +1,119 @@
+import concurrent.futures
+import hashlib
+import logging
+import os
+import weakref
+
+import torch
+
+# Checkpoints that are fine-tunes of an already loaded checkpoint (same model config, dtype and keys) get loaded as a
+# clone of the loaded model with the tensors that differ as patches instead of as a separate model. Switching between
+# them only has to apply or remove those patches on the model that is already in memory.
+
+HASH_THREADS = min(8, os.cpu_count() or 1)
+
+
+def tensor_hash(tensor):
+    tensor = tensor.detach().to("cpu").contiguous()
+    h = hashlib.blake2b(digest_size=16)
+    h.update("{}{}".format(tensor.dtype, tuple(tensor.shape)).encode())
+    h.update(memoryview(tensor.reshape(-1).view(torch.uint8).numpy()))
+    return h.digest()
+
+
+def state_dict_hashes(sd, dtypes=None):
+    def hash_key(k):
+        t = sd[k]
+        if dtypes is not None and k in dtypes:
+            t = t.to(dtypes[k])
+        return k, tensor_hash(t)
+
+    # hashlib releases the GIL for large buffers
+    with concurrent.futures.ThreadPoolExecutor(max_workers=HASH_THREADS) as executor:
+        return dict(executor.map(hash_key, list(sd.keys())))
+
+
+def model_signature(model_config, model_type, dtype, manual_cast_dtype):
+    return (model_config.__class__.__name__, repr(model_config.unet_config), str(model_type), model_config.inpaint_model(), str(dtype), str(manual_cast_dtype), id(model_config.custom_operations))
+
+
+def weight_delta(base, new):
+    '''Returns the patch that turns base into new: a sparse diff if few values changed, the new tensor otherwise.'''
+    new = new.to(base.dtype)
+    changed = (new != base).reshape(-1).nonzero().reshape(-1)
+    if changed.shape[0] == 0:
+        return None
+
+    index_dtype = torch.int32 if base.numel() < 2 ** 31 else torch.int64
+    sparse_size = changed.shape[0] * (torch.tensor([], dtype=index_dtype).element_size() + 4)
+    if sparse_size < new.nbytes:
+        values = new.reshape(-1)[changed].to(torch.float32) - base.reshape(-1)[changed].to(torch.float32)
+        return ("sparse_diff", (changed.to(index_dtype), values))
+    return ("set", (new,))
+
+
+class DeltaBase:
+    def __init__(self, model_patcher, hashes):
+        self.model_patcher = weakref.ref(model_patcher)
+        self.hashes = hashes
+
+
+class DeltaRegistry:
+    def __init__(self):
+        self.bases = {}
+
+    def register(self, model_patcher, signature):
+        if self.get(signature) is not None:
+            return
+        sd = model_patcher.model.diffusion_model.state_dict()
+        self.bases[signature] = DeltaBase(model_patcher, state_dict_hashes(sd))
+
+    def get(self, signature):
+        base = self.bases.get(signature, None)
+        if base is None:
+            return None
+        if base.model_patcher() is None:
+            self.bases.pop(signature)
+            return None
+        return base
+
+    def load_variant(self, sd, unet_prefix, model_config, signature):
+        '''
+        Returns a clone of the registered base model for signature with the diffusion model weights in sd that differ
+        from it added as patches, or None if there is no base or sd doesn't have exactly the same keys.
+        The diffusion model keys are removed from sd when a variant is returned.
+        '''
+        base = self.get(signature)
+        if base is None:
+            return None
+        base_patcher = base.model_patcher()
+
+        to_load = {k[len(unet_prefix):]: sd[k] for k in sd if k.startswith(unet_prefix)}
+        to_load = model_config.process_unet_state_dict(to_load)
+        if to_load.keys() != base.hashes.keys():
+            return None
+
+        base_sd = base_patcher.model.diffusion_model.state_dict()
+        hashes = state_dict_hashes(to_load, dtypes={k: base_sd[k].dtype for k in base_sd})
+        patches = {}
+        for k in to_load:
+            if hashes[k] == base.hashes[k]:
+                continue
+            key = "diffusion_model.{}".format(k)
+            bk = base_patcher.backup.get(key, None)
+            base_weight = bk.weight if bk is not None else base_sd[k]
+            patch = weight_delta(base_weight.to("cpu"), to_load[k])
+            if patch is not None:
+                patches[key] = patch
+
+        for k in [k for k in sd if k.startswith(unet_prefix)]:
+            sd.pop(k)
+
+        model_patcher = base_patcher.clone()
+        if len(patches) > 0:
+            model_patcher.add_patches(patches, 1.0)
+        logging.info("loaded checkpoint as a variant of an already loaded model, {} of {} diffusion model weights differ".format(len(patches), len(to_load)))
+        return model_patcher
+
+
+registry = DeltaRegistry()
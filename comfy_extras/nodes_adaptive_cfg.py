@@ -0,0 +1,27 @@
+class AdaptiveCFG:
+    @classmethod
+    def INPUT_TYPES(s):
+        return {"required": {"model": ("MODEL",),
+                             "threshold": ("FLOAT", {"default": 0.05, "min": 0.0, "max": 1.0, "step": 0.001, "tooltip": "Relative difference between the cond and uncond predictions under which the uncond stops being evaluated. Higher skips more steps."}),
+                             "start_percent": ("FLOAT", {"default": 0.3, "min": 0.0, "max": 1.0, "step": 0.001}),
+                             "end_percent": ("FLOAT", {"default": 1.0, "min": 0.0, "max": 1.0, "step": 0.001}),
+                             }}
+    RETURN_TYPES = ("MODEL",)
+    FUNCTION = "patch"
+
+    DESCRIPTION = "Stops evaluating the negative prompt once the positive and negative predictions are close enough, the guidance of the last step where both were evaluated keeps getting applied. Only happens between start_percent and end_percent."
+
+    CATEGORY = "advanced/guidance"
+
+    def patch(self, model, threshold, start_percent, end_percent):
+        model_sampling = model.get_model_object("model_sampling")
+        m = model.clone()
+        m.model_options["adaptive_cfg"] = {"threshold": threshold,
+                                           "sigma_start": model_sampling.percent_to_sigma(start_percent),
+                                           "sigma_end": model_sampling.percent_to_sigma(end_percent)}
+        return (m, )
+
+
+NODE_CLASS_MAPPINGS = {
+    "AdaptiveCFG": AdaptiveCFG,
+}
@@ -1,3 +1,7 @@
+import folder_paths
+import node_helpers
+import comfy.lora_cache
+import comfy.multi_lora
 
 
 class CLIPTextEncodeControlnet:
@@ -20,6 +24,29 @@ class CLIPTextEncodeControlnet:
             c.append(n)
         return (c, )
 
+class ConditioningSetLoraAdapter:
+    @classmethod
+    def INPUT_TYPES(s):
+        return {"required": {"conditioning": ("CONDITIONING", ),
+                             "lora_name": (folder_paths.get_filename_list("loras"), ),
+                             "strength": ("FLOAT", {"default": 1.0, "min": -20.0, "max": 20.0, "step": 0.01}),
+                             }}
+    RETURN_TYPES = ("CONDITIONING",)
+    FUNCTION = "append"
+
+    CATEGORY = "advanced/conditioning"
+    DESCRIPTION = "Applies the diffusion model part of a LoRA only to the batch elements sampled with this conditioning. Unlike LoraLoader, conditionings with different LoRAs can still run in the same batch."
+
+    def append(self, conditioning, lora_name, strength):
+        lora_path = folder_paths.get_full_path_or_raise("loras", lora_name)
+        adapter = comfy.multi_lora.LoraAdapter(comfy.lora_cache.load_lora_file(lora_path), strength, name=lora_name)
+        c = []
+        for t in conditioning:
+            adapters = t[1].get("lora_adapters", ()) + (adapter,)
+            c += node_helpers.conditioning_set_values([t], {"lora_adapters": adapters})
+        return (c, )
+
 NODE_CLASS_MAPPINGS = {
-    "CLIPTextEncodeControlnet": CLIPTextEncodeControlnet
+    "CLIPTextEncodeControlnet": CLIPTextEncodeControlnet,
+    "ConditioningSetLoraAdapter": ConditioningSetLoraAdapter,
 }
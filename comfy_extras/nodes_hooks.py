@@ -8,6 +8,7 @@ if TYPE_CHECKING:
     from comfy.sd import CLIP
 
 import comfy.hooks
+import comfy.lora_cache
 import comfy.sd
 import comfy.utils
 import folder_paths
@@ -328,7 +329,7 @@ class CreateHookLora:
                 del temp
 
         if lora is None:
-            lora = comfy.utils.load_torch_file(lora_path, safe_load=True)
+            lora = comfy.lora_cache.load_lora_file(lora_path)
             self.loaded_lora = (lora_path, lora)
 
         hooks = comfy.hooks.create_hook_lora(lora=lora, strength_model=strength_model, strength_clip=strength_clip)
@@ -165,7 +165,9 @@ class ModelMergeBlocks:
             m.add_patches({k: kp[k]}, 1.0 - ratio, ratio)
         return (m, )
 
-def save_checkpoint(model, clip=None, vae=None, clip_vision=None, filename_prefix=None, output_dir=None, prompt=None, extra_pnginfo=None):
+SAVE_WEIGHT_DTYPES = {"default": None, "fp8_e4m3fn_scaled": torch.float8_e4m3fn, "fp8_e5m2_scaled": torch.float8_e5m2}
+
+def save_checkpoint(model, clip=None, vae=None, clip_vision=None, filename_prefix=None, output_dir=None, prompt=None, extra_pnginfo=None, weight_dtype="default"):
     full_output_folder, filename, counter, subfolder, filename_prefix = folder_paths.get_save_image_path(filename_prefix, output_dir)
     prompt_info = ""
     if prompt is not None:
@@ -219,7 +221,7 @@ def save_checkpoint(model, clip=None, vae=None, clip_vision=None, filename_prefi
     output_checkpoint = f"{filename}_{counter:05}_.safetensors"
     output_checkpoint = os.path.join(full_output_folder, output_checkpoint)
 
-    comfy.sd.save_checkpoint(output_checkpoint, model, clip, vae, clip_vision, metadata=metadata, extra_keys=extra_keys)
+    comfy.sd.save_checkpoint(output_checkpoint, model, clip, vae, clip_vision, metadata=metadata, extra_keys=extra_keys, scaled_fp8=SAVE_WEIGHT_DTYPES[weight_dtype])
 
 class CheckpointSave:
     def __init__(self):
@@ -231,6 +233,7 @@ class CheckpointSave:
                               "clip": ("CLIP",),
                               "vae": ("VAE",),
                               "filename_prefix": ("STRING", {"default": "checkpoints/ComfyUI"}),},
+                "optional": {"weight_dtype": (list(SAVE_WEIGHT_DTYPES.keys()), {"tooltip": "Save the weights of the linear layers of the diffusion model quantized to fp8 with a scale per weight. These files load without any conversion."}),},
                 "hidden": {"prompt": "PROMPT", "extra_pnginfo": "EXTRA_PNGINFO"},}
     RETURN_TYPES = ()
     FUNCTION = "save"
@@ -238,8 +241,8 @@ class CheckpointSave:
 
     CATEGORY = "advanced/model_merging"
 
-    def save(self, model, clip, vae, filename_prefix, prompt=None, extra_pnginfo=None):
-        save_checkpoint(model, clip=clip, vae=vae, filename_prefix=filename_prefix, output_dir=self.output_dir, prompt=prompt, extra_pnginfo=extra_pnginfo)
+    def save(self, model, clip, vae, filename_prefix, weight_dtype="default", prompt=None, extra_pnginfo=None):
+        save_checkpoint(model, clip=clip, vae=vae, filename_prefix=filename_prefix, output_dir=self.output_dir, prompt=prompt, extra_pnginfo=extra_pnginfo, weight_dtype=weight_dtype)
         return {}
 
 class CLIPSave:
@@ -341,6 +344,7 @@ class ModelSave:
     def INPUT_TYPES(s):
         return {"required": { "model": ("MODEL",),
                               "filename_prefix": ("STRING", {"default": "diffusion_models/ComfyUI"}),},
+                "optional": {"weight_dtype": (list(SAVE_WEIGHT_DTYPES.keys()), {"tooltip": "Save the weights of the linear layers quantized to fp8 with a scale per weight. These files load without any conversion."}),},
                 "hidden": {"prompt": "PROMPT", "extra_pnginfo": "EXTRA_PNGINFO"},}
     RETURN_TYPES = ()
     FUNCTION = "save"
@@ -348,8 +352,8 @@ class ModelSave:
 
     CATEGORY = "advanced/model_merging"
 
-    def save(self, model, filename_prefix, prompt=None, extra_pnginfo=None):
-        save_checkpoint(model, filename_prefix=filename_prefix, output_dir=self.output_dir, prompt=prompt, extra_pnginfo=extra_pnginfo)
+    def save(self, model, filename_prefix, weight_dtype="default", prompt=None, extra_pnginfo=None):
+        save_checkpoint(model, filename_prefix=filename_prefix, output_dir=self.output_dir, prompt=prompt, extra_pnginfo=extra_pnginfo, weight_dtype=weight_dtype)
         return {}
 
 NODE_CLASS_MAPPINGS = {
@@ -5,6 +5,7 @@
 
 import comfy.model_patcher
 import comfy.samplers
+from comfy.ldm.modules.attention import optimized_attention
 
 class PerturbedAttentionGuidance:
     @classmethod
@@ -27,7 +28,20 @@ class PerturbedAttentionGuidance:
         m = model.clone()
 
         def perturbed_attention(q, k, v, extra_options, mask=None):
-            return v
+            # only the rows of the PAG pass get the perturbed attention, it's batched with the cond and uncond
+            rows = comfy.samplers.guidance_rows(extra_options, pag_pass, q.shape[0])
+            if rows is not None and len(rows) == q.shape[0]:
+                return v
+            out = optimized_attention(q, k, v, extra_options["n_heads"], mask, attn_precision=extra_options.get("attn_precision", None))
+            if rows is not None:
+                out[rows] = v[rows].to(out.dtype)
+            return out
+
+        def patch_model_options(model_options):
+            # Replace Self-attention with PAG
+            return comfy.model_patcher.set_model_options_patch_replace(model_options, perturbed_attention, "attn1", unet_block, unet_block_id)
+
+        pag_pass = comfy.samplers.GuidancePass(patch_model_options)
 
         def post_cfg_function(args):
             model = args["model"]
@@ -35,19 +49,20 @@ class PerturbedAttentionGuidance:
             cond = args["cond"]
             cfg_result = args["denoised"]
             sigma = args["sigma"]
-            model_options = args["model_options"].copy()
             x = args["input"]
 
             if scale == 0:
                 return cfg_result
 
-            # Replace Self-attention with PAG
-            model_options = comfy.model_patcher.set_model_options_patch_replace(model_options, perturbed_attention, "attn1", unet_block, unet_block_id)
-            (pag,) = comfy.samplers.calc_cond_batch(model, [cond], x, sigma, model_options)
+            pag = args.get("guidance_outputs", {}).get(pag_pass, None)
+            if pag is None:
+                pag = comfy.samplers.run_guidance_pass(pag_pass, model, cond, x, sigma, args["model_options"])
 
             return cfg_result + (cond_pred - pag) * scale
 
         m.set_model_sampler_post_cfg_function(post_cfg_function)
+        if scale != 0:
+            m.model_options = comfy.samplers.set_model_options_guidance_pass(m.model_options, pag_pass)
 
         return (m,)
 
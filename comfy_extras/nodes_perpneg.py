@@ -31,6 +31,17 @@ class PerpNeg:
     def patch(self, model, empty_conditioning, neg_scale):
         m = model.clone()
         nocond = comfy.sampler_helpers.convert_cond(empty_conditioning)
+        nocond_cache = {}
+
+        def nocond_conds(model, x, cond, uncond):
+            # the processed nocond is kept so it's the same object on every step
+            key = (tuple(x.shape), x.device)
+            if key not in nocond_cache:
+                nocond_cache.clear()
+                nocond_cache[key] = comfy.samplers.encode_model_conds(model.extra_conds, list(nocond), x, x.device, "negative")
+            return nocond_cache[key]
+
+        nocond_pass = comfy.samplers.GuidancePass(conds=nocond_conds)
 
         def cfg_function(args):
             model = args["model"]
@@ -40,14 +51,16 @@ class PerpNeg:
             x = args["input"]
             sigma = args["sigma"]
             model_options = args["model_options"]
-            nocond_processed = comfy.samplers.encode_model_conds(model.extra_conds, nocond, x, x.device, "negative")
 
-            (noise_pred_nocond,) = comfy.samplers.calc_cond_batch(model, [nocond_processed], x, sigma, model_options)
+            noise_pred_nocond = args.get("guidance_outputs", {}).get(nocond_pass, None)
+            if noise_pred_nocond is None:
+                noise_pred_nocond = comfy.samplers.run_guidance_pass(nocond_pass, model, None, x, sigma, model_options)
 
             cfg_result = x - perp_neg(x, noise_pred_pos, noise_pred_neg, noise_pred_nocond, neg_scale, cond_scale)
             return cfg_result
 
         m.set_model_sampler_cfg_function(cfg_function)
+        m.model_options = comfy.samplers.set_model_options_guidance_pass(m.model_options, nocond_pass)
 
         return (m, )
 
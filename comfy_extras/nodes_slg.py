@@ -30,7 +30,20 @@ class SkipLayerGuidanceDiT:
     def skip_guidance(self, model, scale, start_percent, end_percent, double_layers="", single_layers="", rescaling_scale=0):
         # check if layer is comma separated integers
         def skip(args, extra_args):
-            return args
+            # only the rows of the SLG pass skip the layer, it's batched with the cond and uncond
+            rows = comfy.samplers.guidance_rows(args.get("transformer_options", {}), slg_pass, args["img"].shape[0])
+            if rows is not None and len(rows) == args["img"].shape[0]:
+                return args
+            # indexing copies the rows, some blocks change their inputs in place
+            skipped = {}
+            if rows is not None:
+                skipped = {k: args[k][rows] for k in ("img", "txt") if k in args}
+            out = extra_args["original_block"](args)
+            for k in out:
+                # the last joint block of SD3 is pre_only and returns no txt
+                if k in skipped and out[k] is not None:
+                    out[k][rows] = skipped[k]
+            return out
 
         model_sampling = model.get_model_object("model_sampling")
         sigma_start = model_sampling.percent_to_sigma(start_percent)
@@ -45,6 +58,16 @@ class SkipLayerGuidanceDiT:
         if len(double_layers) == 0 and len(single_layers) == 0:
             return (model, )
 
+        def patch_model_options(model_options):
+            for layer in double_layers:
+                model_options = comfy.model_patcher.set_model_options_patch_replace(model_options, skip, "dit", "double_block", layer)
+
+            for layer in single_layers:
+                model_options = comfy.model_patcher.set_model_options_patch_replace(model_options, skip, "dit", "single_block", layer)
+            return model_options
+
+        slg_pass = comfy.samplers.GuidancePass(patch_model_options, sigma_start=sigma_start, sigma_end=sigma_end)
+
         def post_cfg_function(args):
             model = args["model"]
             cond_pred = args["cond_denoised"]
@@ -52,19 +75,11 @@ class SkipLayerGuidanceDiT:
             cfg_result = args["denoised"]
             sigma = args["sigma"]
             x = args["input"]
-            model_options = args["model_options"].copy()
-
-            for layer in double_layers:
-                model_options = comfy.model_patcher.set_model_options_patch_replace(model_options, skip, "dit", "double_block", layer)
-
-            for layer in single_layers:
-                model_options = comfy.model_patcher.set_model_options_patch_replace(model_options, skip, "dit", "single_block", layer)
-
-            model_sampling.percent_to_sigma(start_percent)
 
-            sigma_ = sigma[0].item()
-            if scale > 0 and sigma_ >= sigma_end and sigma_ <= sigma_start:
-                (slg,) = comfy.samplers.calc_cond_batch(model, [cond], x, sigma, model_options)
+            if scale > 0 and slg_pass.active(sigma):
+                slg = args.get("guidance_outputs", {}).get(slg_pass, None)
+                if slg is None:
+                    slg = comfy.samplers.run_guidance_pass(slg_pass, model, cond, x, sigma, args["model_options"])
                 cfg_result = cfg_result + (cond_pred - slg) * scale
                 if rescaling_scale != 0:
                     factor = cond_pred.std() / cfg_result.std()
@@ -75,6 +90,8 @@ class SkipLayerGuidanceDiT:
 
         m = model.clone()
         m.set_model_sampler_post_cfg_function(post_cfg_function)
+        if scale > 0:
+            m.model_options = comfy.samplers.set_model_options_guidance_pass(m.model_options, slg_pass)
 
         return (m, )
 
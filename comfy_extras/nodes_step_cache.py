@@ -0,0 +1,218 @@
+import logging
+
+import comfy.patcher_extension
+from comfy.ldm.flux.model import Flux
+from comfy.ldm.modules.diffusionmodules.openaimodel import UNetModel
+from comfy.ldm.wan.model import WanModel
+
+# number of input and output blocks of the UNet that still run on the skipped steps
+UNET_SHALLOW_BLOCKS = 1
+DIT_STREAMS = ("img", "txt")
+
+
+class CacheEntry:
+    def __init__(self):
+        self.probe = None
+        self.accumulated = 0.0
+        self.skipped = 0
+        self.ready = False
+        self.skip = False
+        self.start = {}
+        self.data = {}
+
+
+class StepCache:
+    '''
+    Consecutive steps barely change the features of the deep blocks of the model. The output of the first blocks is
+    compared to the one of the previous step and while the accumulated relative change stays under the threshold the
+    deep blocks are skipped: the UNet reuses the features of its deep blocks from the last full step and DiT models add
+    the residual of their other blocks from the last full step.
+    There is one entry per batch of conds since they get evaluated separately.
+    '''
+    def __init__(self, threshold, sigma_start, sigma_end, max_skipped_steps):
+        self.threshold = threshold
+        self.sigma_start = sigma_start
+        self.sigma_end = sigma_end
+        self.max_skipped_steps = max_skipped_steps
+        self.current = None
+        self.reset()
+
+    def reset(self):
+        self.entries = {}
+        self.calls = 0
+        self.skipped = 0
+
+    def entry(self, x, transformer_options):
+        sigmas = transformer_options.get("sigmas", None)
+        if sigmas is None:
+            return None
+        sigma = sigmas[0].item()
+        if sigma > self.sigma_start or sigma < self.sigma_end:
+            return None
+        key = (tuple(transformer_options.get("uuids", [])), tuple(x.shape))
+        entry = self.entries.get(key, None)
+        if entry is None:
+            entry = CacheEntry()
+            self.entries[key] = entry
+        return entry
+
+    def check(self, entry, probe):
+        '''Returns True if the step can be skipped, probe is the output of the blocks that always run.'''
+        self.calls += 1
+        skip = False
+        if entry.ready and entry.probe is not None and entry.probe.shape == probe.shape and entry.skipped < self.max_skipped_steps:
+            entry.accumulated += ((probe - entry.probe).abs().mean() / entry.probe.abs().mean().clamp(min=1e-6)).item()
+            skip = entry.accumulated < self.threshold
+        entry.probe = probe.detach().clone()
+        if skip:
+            entry.skipped += 1
+            self.skipped += 1
+        else:
+            entry.accumulated = 0.0
+            entry.skipped = 0
+        entry.skip = skip
+        return skip
+
+
+class UNetDeepBlocksSkip:
+    '''The "deep_blocks_skip" transformer option of UNetModel._forward for one cache entry.'''
+    shallow_blocks = UNET_SHALLOW_BLOCKS
+
+    def __init__(self, cache, entry):
+        self.cache = cache
+        self.entry = entry
+
+    def check(self, h):
+        return self.cache.check(self.entry, h)
+
+    def store(self, h, transformer_index):
+        self.entry.data["h"] = h
+        self.entry.data["transformer_index"] = transformer_index
+
+    def restore(self):
+        return self.entry.data["h"], self.entry.data["transformer_index"]
+
+
+def dit_block_patch(cache, segments, key):
+    segment = [s for s in segments if key in s][0]
+    probe = segments[0][0]
+    start = [k for k in segment if k != probe]
+
+    def block_patch(args, extra_args):
+        entry = cache.current
+        if entry is None:
+            return extra_args["original_block"](args)
+        if key == probe:
+            out = extra_args["original_block"](args)
+            cache.check(entry, out["img"])
+            return out
+
+        if entry.skip:
+            if key != segment[-1]:
+                return args
+            out = dict(args)
+            for k, residual in entry.data[key].items():
+                out[k] = args[k] + residual
+            return out
+
+        if key == start[0]:
+            entry.start[key] = {k: args[k] for k in DIT_STREAMS if k in args}
+        out = extra_args["original_block"](args)
+        if key == segment[-1]:
+            entry.data[key] = {k: out[k] - v for k, v in entry.start[start[0]].items() if k in out}
+        return out
+    return block_patch
+
+
+class StepCacheNode:
+    @classmethod
+    def INPUT_TYPES(s):
+        return {"required": {"model": ("MODEL",),
+                             "threshold": ("FLOAT", {"default": 0.1, "min": 0.0, "max": 2.0, "step": 0.005, "tooltip": "How much the output of the first blocks can change before the full model has to run again. Higher is faster with lower quality, 0 disables the caching."}),
+                             "start_percent": ("FLOAT", {"default": 0.15, "min": 0.0, "max": 1.0, "step": 0.001}),
+                             "end_percent": ("FLOAT", {"default": 0.95, "min": 0.0, "max": 1.0, "step": 0.001}),
+                             "max_skipped_steps": ("INT", {"default": 3, "min": 1, "max": 100, "tooltip": "Maximum number of steps in a row that reuse the cached features."}),
+                              }}
+    RETURN_TYPES = ("MODEL",)
+    FUNCTION = "patch"
+    EXPERIMENTAL = True
+
+    DESCRIPTION = "Skips the deep blocks of the model on the steps where the output of its first blocks barely changes and reuses their features from the last full step. Supports UNet models (SD1.x, SDXL, etc...), Flux and Wan."
+
+    CATEGORY = "advanced/model"
+
+    def patch(self, model, threshold, start_percent, end_percent, max_skipped_steps):
+        diffusion_model = model.get_model_object("diffusion_model")
+        model_sampling = model.get_model_object("model_sampling")
+        cache = StepCache(threshold, model_sampling.percent_to_sigma(start_percent), model_sampling.percent_to_sigma(end_percent), max_skipped_steps)
+
+        if isinstance(diffusion_model, UNetModel):
+            if diffusion_model.use_temporal_resblocks or diffusion_model.predict_codebook_ids:
+                logging.warning("StepCache: unsupported model, not patching.")
+                return (model, )
+            segments = None
+            residual_segments = 0
+        elif isinstance(diffusion_model, Flux):
+            segments = [[("double_block", i) for i in range(len(diffusion_model.double_blocks))],
+                        [("single_block", i) for i in range(len(diffusion_model.single_blocks))]]
+        elif isinstance(diffusion_model, WanModel):
+            segments = [[("double_block", i) for i in range(len(diffusion_model.blocks))]]
+        else:
+            logging.warning("StepCache: unsupported model, not patching.")
+            return (model, )
+        if segments is not None:
+            residual_segments = len([s for s in segments if any(k != segments[0][0] for k in s)])
+
+        def outer_sample_wrapper(executor, *args, **kwargs):
+            cache.reset()
+            try:
+                return executor(*args, **kwargs)
+            finally:
+                if cache.calls > 0:
+                    logging.info("StepCache: skipped the deep blocks for {} of {} model calls.".format(cache.skipped, cache.calls))
+                cache.reset()
+
+        def unet_wrapper(executor, x, timesteps=None, context=None, y=None, control=None, transformer_options={}, **kwargs):
+            entry = None
+            if control is None:
+                entry = cache.entry(x, transformer_options)
+            if entry is None:
+                return executor(x, timesteps, context, y, control, transformer_options, **kwargs)
+            transformer_options = transformer_options.copy()
+            transformer_options["deep_blocks_skip"] = UNetDeepBlocksSkip(cache, entry)
+            out = executor(x, timesteps, context, y, control, transformer_options, **kwargs)
+            entry.ready = True
+            return out
+
+        def dit_wrapper(executor, *args, **kwargs):
+            # the transformer options are the last positional argument, flux has control before them
+            transformer_options = args[-1]
+            entry = None
+            if len(args) < 7 or args[5] is None:
+                entry = cache.entry(args[0], transformer_options)
+            cache.current = entry
+            try:
+                out = executor(*args, **kwargs)
+            finally:
+                cache.current = None
+            if entry is not None and not entry.skip:
+                entry.ready = len(entry.data) == residual_segments
+            return out
+
+        m = model.clone()
+        if threshold <= 0:
+            return (m, )
+        m.add_wrapper_with_key(comfy.patcher_extension.WrappersMP.OUTER_SAMPLE, "step_cache", outer_sample_wrapper)
+        if segments is None:
+            m.add_wrapper_with_key(comfy.patcher_extension.WrappersMP.DIFFUSION_MODEL, "step_cache", unet_wrapper)
+        else:
+            m.add_wrapper_with_key(comfy.patcher_extension.WrappersMP.DIFFUSION_MODEL, "step_cache", dit_wrapper)
+            for segment in segments:
+                for key in segment:
+                    m.set_model_patch_replace(dit_block_patch(cache, segments, key), "dit", key[0], key[1])
+        return (m, )
+
+
+NODE_CLASS_MAPPINGS = {
+    "StepCache": StepCacheNode,
+}
@@ -58,7 +58,8 @@ class ImageUpscaleWithModel:
         upscale_model.to(device)
         in_img = image.movedim(-1,-3).to(device)
 
-        tile = 512
+        oom_key = ("upscale_model_tile", upscale_model.model.__class__.__name__, upscale_model.scale)
+        tile = model_management.get_oom_safe_size(oom_key, 512)
         overlap = 32
 
         oom = True
@@ -69,8 +70,8 @@ class ImageUpscaleWithModel:
                 s = comfy.utils.tiled_scale(in_img, lambda a: upscale_model(a), tile_x=tile, tile_y=tile, overlap=overlap, upscale_amount=upscale_model.scale, pbar=pbar)
                 oom = False
             except model_management.OOM_EXCEPTION as e:
-                tile //= 2
-                if tile < 128:
+                tile = model_management.reduce_oom_safe_size(oom_key, tile, minimum=128)
+                if tile == 0:
                     raise e
 
         upscale_model.to("cpu")
@@ -13,6 +13,8 @@ import torch
 import nodes
 
 import comfy.model_management
+import comfy.sampling_checkpoint
+import comfy.sampler_helpers
 from comfy_execution.graph import get_input_info, ExecutionList, DynamicPrompt, ExecutionBlocker
 from comfy_execution.graph_utils import is_link, GraphBuilder
 from comfy_execution.caching import HierarchicalCache, LRUCache, CacheKeySetInputSignature, CacheKeySetID
@@ -423,6 +425,7 @@ class PromptExecutor:
         self.caches = CacheSet(self.lru_size)
         self.status_messages = []
         self.success = True
+        self.preempted = False
 
     def add_message(self, event, data: dict, broadcast: bool):
         data = {
@@ -439,7 +442,16 @@ class PromptExecutor:
 
         # First, send back the status to the frontend depending
         # on the exception type
-        if isinstance(ex, comfy.model_management.InterruptProcessingException):
+        if isinstance(ex, comfy.sampling_checkpoint.SamplingPreempted):
+            self.preempted = True
+            mes = {
+                "prompt_id": prompt_id,
+                "node_id": node_id,
+                "node_type": class_type,
+                "executed": list(executed),
+            }
+            self.add_message("execution_preempted", mes, broadcast=True)
+        elif isinstance(ex, comfy.model_management.InterruptProcessingException):
             mes = {
                 "prompt_id": prompt_id,
                 "node_id": node_id,
@@ -462,7 +474,17 @@ class PromptExecutor:
             self.add_message("execution_error", mes, broadcast=False)
 
     def execute(self, prompt, prompt_id, extra_data={}, execute_outputs=[]):
-        nodes.interrupt_processing(False)
+        comfy.model_management.begin_prompt(prompt_id)
+        comfy.sampling_checkpoint.clear_preemption()
+        try:
+            self.execute_prompt(prompt, prompt_id, extra_data, execute_outputs)
+        finally:
+            comfy.sampling_checkpoint.clear_preemption()
+            comfy.model_management.end_prompt()
+
+    def execute_prompt(self, prompt, prompt_id, extra_data, execute_outputs):
+        comfy.sampler_helpers.prepared.reset()
+        self.preempted = False
 
         if "client_id" in extra_data:
             self.server.client_id = extra_data["client_id"]
@@ -527,6 +549,7 @@ class PromptExecutor:
                 "meta": meta_outputs,
             }
             self.server.last_node_id = None
+            comfy.sampler_helpers.prepared.reset()
             if comfy.model_management.DISABLE_SMART_MEMORY:
                 comfy.model_management.unload_all_models()
 
@@ -923,6 +946,14 @@ class PromptQueue:
             self.history[prompt[1]].update(history_result)
             self.server.queue_updated()
 
+    def task_requeue(self, item_id):
+        '''Puts a running prompt back in the queue, for prompts that got preempted.'''
+        with self.mutex:
+            item = self.currently_running.pop(item_id)
+            heapq.heappush(self.queue, item)
+            self.server.queue_updated()
+            self.not_empty.notify()
+
     def get_current_queue(self):
         with self.mutex:
             out = []
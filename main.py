@@ -103,6 +103,7 @@ import asyncio
 import shutil
 import threading
 import gc
+import contextlib
 
 
 if os.name == "nt":
@@ -138,6 +139,10 @@ import server
 from server import BinaryEventTypes
 import nodes
 import comfy.model_management
+import comfy.memory_estimator
+import comfy.step_batching
+import comfy.sampling_checkpoint
+import app.model_hashes
 import comfyui_version
 
 
@@ -159,6 +164,9 @@ def prompt_worker(q, server_instance):
     last_gc_collect = 0
     need_gc = False
     gc_collect_interval = 10.0
+    execution_lock = contextlib.nullcontext()
+    if args.parallel_prompts > 1:
+        execution_lock = comfy.step_batching.execution_lock
 
     while True:
         timeout = 1000.0
@@ -166,39 +174,45 @@ def prompt_worker(q, server_instance):
             timeout = max(gc_collect_interval - (current_time - last_gc_collect), 0.0)
 
         queue_item = q.get(timeout=timeout)
-        if queue_item is not None:
-            item, item_id = queue_item
-            execution_start_time = time.perf_counter()
-            prompt_id = item[1]
-            server_instance.last_prompt_id = prompt_id
-
-            e.execute(item[2], prompt_id, item[3], item[4])
-            need_gc = True
-            q.task_done(item_id,
-                        e.history_result,
-                        status=execution.PromptQueue.ExecutionStatus(
-                            status_str='success' if e.success else 'error',
-                            completed=e.success,
-                            messages=e.status_messages))
-            if server_instance.client_id is not None:
-                server_instance.send_sync("executing", {"node": None, "prompt_id": prompt_id}, server_instance.client_id)
-
-            current_time = time.perf_counter()
-            execution_time = current_time - execution_start_time
-            logging.info("Prompt executed in {:.2f} seconds".format(execution_time))
-
-        flags = q.get_flags()
-        free_memory = flags.get("free_memory", False)
-
-        if flags.get("unload_models", free_memory):
-            comfy.model_management.unload_all_models()
-            need_gc = True
-            last_gc_collect = 0
-
-        if free_memory:
-            e.reset()
-            need_gc = True
-            last_gc_collect = 0
+        with execution_lock:
+            if queue_item is not None:
+                item, item_id = queue_item
+                execution_start_time = time.perf_counter()
+                prompt_id = item[1]
+                server_instance.last_prompt_id = prompt_id
+
+                e.execute(item[2], prompt_id, item[3], item[4])
+                comfy.memory_estimator.save()
+                need_gc = True
+                if e.preempted:
+                    logging.info("Prompt preempted, it will resume after the prompts queued before it.")
+                    q.task_requeue(item_id)
+                else:
+                    q.task_done(item_id,
+                                e.history_result,
+                                status=execution.PromptQueue.ExecutionStatus(
+                                    status_str='success' if e.success else 'error',
+                                    completed=e.success,
+                                    messages=e.status_messages))
+                if server_instance.client_id is not None:
+                    server_instance.send_sync("executing", {"node": None, "prompt_id": prompt_id}, server_instance.client_id)
+
+                current_time = time.perf_counter()
+                execution_time = current_time - execution_start_time
+                logging.info("Prompt executed in {:.2f} seconds".format(execution_time))
+
+            flags = q.get_flags()
+            free_memory = flags.get("free_memory", False)
+
+            if flags.get("unload_models", free_memory):
+                comfy.model_management.unload_all_models()
+                need_gc = True
+                last_gc_collect = 0
+
+            if free_memory:
+                e.reset()
+                need_gc = True
+                last_gc_collect = 0
 
         if need_gc:
             current_time = time.perf_counter()
@@ -219,13 +233,24 @@ async def run(server_instance, address='', port=8188, verbose=True, call_on_star
 
 
 def hijack_progress(server_instance):
+    def save_state():
+        return (server_instance.client_id, server_instance.last_prompt_id, server_instance.last_node_id)
+
+    def restore_state(state):
+        server_instance.client_id, server_instance.last_prompt_id, server_instance.last_node_id = state
+
+    comfy.step_batching.execution_lock.save_state = save_state
+    comfy.step_batching.execution_lock.restore_state = restore_state
+
     def hook(value, total, preview_image):
         comfy.model_management.throw_exception_if_processing_interrupted()
-        progress = {"value": value, "max": total, "prompt_id": server_instance.last_prompt_id, "node": server_instance.last_node_id}
+        # while a prompt samples in parallel with others the server state is the one of the prompt that runs its nodes
+        client_id, prompt_id, node_id = comfy.step_batching.execution_lock.released_state() or save_state()
+        progress = {"value": value, "max": total, "prompt_id": prompt_id, "node": node_id}
 
-        server_instance.send_sync("progress", progress, server_instance.client_id)
+        server_instance.send_sync("progress", progress, client_id)
         if preview_image is not None:
-            server_instance.send_sync(BinaryEventTypes.UNENCODED_PREVIEW_IMAGE, preview_image, server_instance.client_id)
+            server_instance.send_sync(BinaryEventTypes.UNENCODED_PREVIEW_IMAGE, preview_image, client_id)
 
     comfy.utils.set_progress_bar_global_hook(hook)
 
@@ -260,6 +285,17 @@ def start_comfyui(asyncio_loop=None):
     prompt_server = server.PromptServer(asyncio_loop)
     q = execution.PromptQueue(prompt_server)
 
+    if args.memory_calibration:
+        comfy.memory_estimator.enable(os.path.join(folder_paths.get_user_directory(), "memory_estimates.json"))
+
+    if args.preemptible_sampling:
+        comfy.sampling_checkpoint.store.directory = os.path.join(folder_paths.get_user_directory(), "sampling_checkpoints")
+
+    if args.model_hash_index:
+        app.model_hashes.index.load(os.path.join(folder_paths.get_user_directory(), "model_hashes.json"))
+        app.model_hashes.index.busy = lambda: q.get_tasks_remaining() > 0
+        app.model_hashes.index.start()
+
     nodes.init_extra_nodes(init_custom_nodes=not args.disable_all_custom_nodes)
 
     cuda_malloc_warning()
@@ -267,7 +303,8 @@ def start_comfyui(asyncio_loop=None):
     prompt_server.add_routes()
     hijack_progress(prompt_server)
 
-    threading.Thread(target=prompt_worker, daemon=True, args=(q, prompt_server,)).start()
+    for i in range(max(1, args.parallel_prompts)):
+        threading.Thread(target=prompt_worker, daemon=True, args=(q, prompt_server,)).start()
 
     if args.quick_test_for_ci:
         exit(0)
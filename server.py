@@ -31,11 +31,13 @@ import mimetypes
 from comfy.cli_args import args
 import comfy.utils
 import comfy.model_management
+import comfy.sampling_checkpoint
 import node_helpers
 from comfyui_version import __version__
 from app.frontend_management import FrontendManager
 from app.user_manager import UserManager
 from app.model_manager import ModelFileManager
+import app.model_hashes
 from app.custom_node_manager import CustomNodeManager
 from typing import Optional
 from api_server.routes.internal.internal_routes import InternalRoutes
@@ -249,8 +251,16 @@ class PromptServer():
             if not folder in folder_paths.folder_names_and_paths:
                 return web.Response(status=404)
             files = folder_paths.get_filename_list(folder)
+            if request.rel_url.query.get("hashes", "false").lower() in ("true", "1"):
+                files = [app.model_hashes.index.file_info(folder, f) for f in files]
             return web.json_response(files)
 
+        @routes.get("/models/hashes/{sha256}")
+        async def get_models_by_hash(request):
+            sha256 = request.match_info.get("sha256", "")
+            models = app.model_hashes.find_models_by_hash(sha256)
+            return web.json_response([{"folder": folder, "name": name} for folder, name in models])
+
         @routes.get("/extensions")
         async def get_extensions(request):
             files = glob.glob(os.path.join(
@@ -659,6 +669,12 @@ class PromptServer():
                     prompt_id = str(uuid.uuid4())
                     outputs_to_execute = valid[2]
                     self.prompt_queue.put((number, prompt_id, prompt, extra_data, outputs_to_execute))
+                    if json_data.get("front", False):
+                        with self.prompt_queue.mutex:
+                            running = list(self.prompt_queue.currently_running.values())
+                        if len(running) >= args.parallel_prompts:
+                            # the prompt queued last among the running ones makes room for it
+                            comfy.sampling_checkpoint.request_preemption(max(running, key=lambda x: x[0])[1])
                     response = {"prompt_id": prompt_id, "number": number, "node_errors": valid[3]}
                     return web.json_response(response)
                 else:
@@ -683,7 +699,12 @@ class PromptServer():
 
         @routes.post("/interrupt")
         async def post_interrupt(request):
-            nodes.interrupt_processing()
+            try:
+                json_data = await request.json()
+            except json.JSONDecodeError:
+                json_data = {}
+            prompt_id = json_data.get("prompt_id", None) if isinstance(json_data, dict) else None
+            nodes.interrupt_processing(prompt_id=prompt_id)
             return web.Response(status=200)
 
         @routes.post("/free")
@@ -0,0 +1,60 @@
+import hashlib
+import json
+import os
+import struct
+import pytest
+from unittest.mock import patch
+from app.model_hashes import ModelHashIndex
+
+
+@pytest.fixture
+def model_dir(tmp_path):
+    models = tmp_path / "models"
+    models.mkdir()
+    (models / "a.ckpt").write_bytes(b"a" * 1000)
+    header = json.dumps({"w": {"dtype": "F32", "shape": [1], "data_offsets": [0, 4]}}).encode("utf-8")
+    (models / "b.safetensors").write_bytes(struct.pack("<Q", len(header)) + header + b"\0" * 4)
+    with patch("folder_paths.folder_names_and_paths", {"checkpoints": ([str(models)], {".ckpt", ".safetensors"})}), patch("folder_paths.filename_list_cache", {}):
+        yield models
+
+
+def test_scan_hashes_files(model_dir, tmp_path):
+    index = ModelHashIndex(str(tmp_path / "index.json"))
+    assert index.scan() == 2
+    assert index.get_hash(str(model_dir / "a.ckpt")) == hashlib.sha256(b"a" * 1000).hexdigest()
+    assert index.get_entry(str(model_dir / "b.safetensors"))["header_sha256"] is not None
+    assert index.get_entry(str(model_dir / "a.ckpt"))["header_sha256"] is None
+    assert index.find(hashlib.sha256(b"a" * 1000).hexdigest()) == [("checkpoints", "a.ckpt")]
+
+
+def test_index_is_persistent_and_incremental(model_dir, tmp_path):
+    index = ModelHashIndex(str(tmp_path / "index.json"))
+    index.scan()
+
+    index = ModelHashIndex(str(tmp_path / "index.json"))
+    assert index.scan() == 0
+
+    path = model_dir / "a.ckpt"
+    path.write_bytes(b"b" * 1000)
+    os.utime(path, ns=(0, 1))
+    assert index.get_hash(str(path)) is None
+    assert index.scan() == 1
+    assert index.get_hash(str(path)) == hashlib.sha256(b"b" * 1000).hexdigest()
+
+
+def test_removed_files_are_dropped(model_dir, tmp_path):
+    index = ModelHashIndex(str(tmp_path / "index.json"))
+    index.scan()
+    os.remove(model_dir / "a.ckpt")
+    index.scan()
+    assert str(model_dir / "a.ckpt") not in index.entries
+    assert len(index.entries) == 1
+
+
+def test_get_hash_compute(tmp_path):
+    path = tmp_path / "c.pt"
+    path.write_bytes(b"c" * 10)
+    index = ModelHashIndex()
+    assert index.get_hash(str(path)) is None
+    assert index.get_hash(str(path), compute=True) == hashlib.sha256(b"c" * 10).hexdigest()
+    assert index.get_hash(str(path)) == hashlib.sha256(b"c" * 10).hexdigest()
@@ -0,0 +1,43 @@
+import pytest
+import torch
+
+import comfy.cli_args
+# model_management picks its device when imported
+comfy.cli_args.args.cpu = True
+
+import comfy.sample  # noqa: E402
+from comfy.sample import philox4x32, philox_randn, prepare_noise  # noqa: E402
+
+
+# known answers of philox4x32_10 from Random123 (kat_vectors)
+@pytest.mark.parametrize("counter, key, expected", [
+    ((0, 0, 0, 0), (0, 0), (0x6627e8d5, 0xe169c58d, 0xbc57ac4c, 0x9b00dbd8)),
+    ((0xffffffff,) * 4, (0xffffffff, 0xffffffff), (0x408f276d, 0x41c83b0e, 0xa20bc7c6, 0x6d5451fd)),
+    ((0x243f6a88, 0x85a308d3, 0x13198a2e, 0x03707344), (0xa4093822, 0x299f31d0), (0xd16cfe09, 0x94fdcceb, 0x5001e420, 0x24126ea1)),
+])
+def test_philox4x32_known_answers(counter, key, expected):
+    out = philox4x32([torch.tensor([c], dtype=torch.int64) for c in counter], key)
+    assert tuple(int(w) for w in out) == expected
+
+
+def test_philox_randn_rows_only_depend_on_their_index():
+    shape = (4, 4, 9, 7)
+    full = philox_randn(shape, 1234, [0, 1, 2, 3], "cpu")
+    assert torch.equal(philox_randn(shape, 1234, [2], "cpu")[0], full[2])
+    assert torch.equal(philox_randn(shape, 1234, [3, 0], "cpu"), full[[3, 0]])
+    assert not torch.equal(full[0], full[1])
+    assert not torch.equal(philox_randn(shape, 1235, [0], "cpu")[0], full[0])
+
+
+def test_philox_randn_is_normal():
+    noise = philox_randn((1, 4, 128, 128), 0, [0], "cpu")
+    assert abs(noise.mean().item()) < 0.02
+    assert abs(noise.std().item() - 1.0) < 0.02
+
+
+def test_prepare_noise_batched(monkeypatch):
+    monkeypatch.setattr(comfy.sample.args, "batched_noise", True)
+    latent = torch.zeros(4, 4, 8, 8, dtype=torch.float16)
+    full = prepare_noise(latent, 42)
+    assert full.dtype == torch.float16 and full.device.type == "cpu"
+    assert torch.equal(prepare_noise(latent[:1], 42, noise_inds=[2])[0], full[2])
@@ -0,0 +1,167 @@
+import functools
+import os
+
+import pytest
+import torch
+
+import comfy.cli_args
+# model_management picks its device when imported
+comfy.cli_args.args.cpu = True
+
+import comfy.k_diffusion.sampling  # noqa: E402
+import comfy.model_patcher  # noqa: E402
+import comfy.sampling_checkpoint as sampling_checkpoint  # noqa: E402
+from comfy.sampling_checkpoint import KeyHasher  # noqa: E402
+
+
+@pytest.fixture
+def store(monkeypatch, tmp_path):
+    monkeypatch.setattr(sampling_checkpoint.args, "preemptible_sampling", True)
+    store = sampling_checkpoint.CheckpointStore(str(tmp_path))
+    monkeypatch.setattr(sampling_checkpoint, "store", store)
+    yield store
+    sampling_checkpoint.preempt_requested.clear()
+
+
+def digest(*values):
+    hasher = KeyHasher()
+    for v in values:
+        hasher.update(v)
+    return hasher.digest()
+
+
+def scale(x, factor):
+    return x * factor
+
+
+def test_key_hasher_is_deterministic():
+    torch.manual_seed(0)
+    cond = {"c_crossattn": torch.randn(1, 77, 16), "strength": 1.0, "uuid": 1, "patches": [functools.partial(scale, factor=2)]}
+    same = {"c_crossattn": cond["c_crossattn"].clone(), "strength": 1.0, "uuid": 2, "patches": [functools.partial(scale, factor=2)]}
+    assert digest(cond) == digest(same)
+
+
+def test_key_hasher_sees_changes():
+    torch.manual_seed(0)
+    cond = {"c_crossattn": torch.randn(1, 77, 16), "strength": 1.0, "patches": [functools.partial(scale, factor=2)]}
+    base = digest(cond)
+
+    changed = torch.randn(1, 77, 16)
+    assert digest(dict(cond, c_crossattn=changed)) != base
+    last_value = cond["c_crossattn"].clone()
+    last_value[0, -1, -1] += 1
+    assert digest(dict(cond, c_crossattn=last_value)) != base
+    assert digest(dict(cond, strength=0.5)) != base
+    assert digest(dict(cond, patches=[functools.partial(scale, factor=3)])) != base
+
+    def closure(factor):
+        return lambda x: x * factor
+    assert digest(closure(2)) == digest(closure(2))
+    assert digest(closure(2)) != digest(closure(3))
+
+
+def test_key_hasher_model_patches():
+    torch.manual_seed(0)
+    model = torch.nn.Linear(16, 16)
+    patcher = comfy.model_patcher.ModelPatcher(model, load_device=torch.device("cpu"), offload_device=torch.device("cpu"))
+    base = digest(patcher)
+    assert digest(patcher.clone()) == base
+
+    patch = {"weight": (torch.ones(16, 16),)}
+    a = patcher.clone()
+    a.add_patches(patch, 0.5)
+    b = patcher.clone()
+    b.add_patches(patch, 1.0)
+    assert digest(a) != base
+    assert digest(a) != digest(b)
+
+    c = patcher.clone()
+    c.set_model_attn1_patch(functools.partial(scale, factor=2))
+    assert digest(c) != base
+
+
+class FakeSampling:
+    '''SDE multistep sampling (noise RNG and history buffers) with a model that goes through the checkpoint.'''
+    def __init__(self, steps=8, shift=0.0):
+        self.steps = steps
+        self.shift = shift
+        self.calls = 0
+
+    def model(self, checkpoint):
+        def denoise(x, sigma, **kwargs):
+            def compute():
+                self.calls += 1
+                return [x / (1 + sigma.reshape(-1, 1, 1, 1)) + self.shift, x.mean() + sigma.reshape(-1, 1, 1, 1)]
+            out = checkpoint.calc_cond_batch(compute, x)
+            return out[0] + out[1] * 0.01
+        return denoise
+
+    def run(self, key="key", preempt_step=None):
+        checkpoint = sampling_checkpoint.begin(key)
+        self.calls = 0
+
+        def request(step, x0, x, total_steps):
+            if step == preempt_step:
+                sampling_checkpoint.request_preemption()
+        callback = checkpoint.wrap_callback(request)
+
+        torch.manual_seed(0)
+        x = torch.randn(1, 4, 8, 8) * 10
+        sigmas = torch.linspace(10, 0, self.steps + 1)
+        out = comfy.k_diffusion.sampling.sample_dpmpp_2m_sde(self.model(checkpoint), x, sigmas, extra_args={"seed": 1}, disable=True,
+                                                             callback=lambda d: callback(d["i"], d["denoised"], d["x"], self.steps))
+        checkpoint.close()
+        return out
+
+
+def preempted(sampling, key="key", preempt_step=3):
+    with pytest.raises(sampling_checkpoint.SamplingPreempted):
+        sampling.run(key, preempt_step=preempt_step)
+
+
+def test_resume_is_bit_identical(store):
+    sampling = FakeSampling()
+    reference = sampling.run()
+    assert sampling.calls == 8
+
+    preempted(sampling)
+    resumed = sampling.run()
+    # the first call gets evaluated again to validate the checkpoint
+    assert sampling.calls == 1 + 8 - 4
+    assert torch.equal(resumed, reference)
+
+
+def test_resume_from_spilled_chunks_after_restart(store, monkeypatch, tmp_path):
+    monkeypatch.setattr(sampling_checkpoint, "MAX_CHECKPOINT_MEMORY", 1)
+    sampling = FakeSampling()
+    reference = sampling.run()
+    assert os.listdir(tmp_path) == []
+
+    preempted(sampling, preempt_step=5)
+    assert len([f for f in os.listdir(tmp_path) if f.endswith(".outputs")]) == 6
+    monkeypatch.setattr(sampling_checkpoint, "store", sampling_checkpoint.CheckpointStore(str(tmp_path)))
+    resumed = sampling.run()
+    assert sampling.calls == 1 + 8 - 6
+    assert torch.equal(resumed, reference)
+    assert os.listdir(tmp_path) == []
+
+
+def test_checkpoint_memory_stays_bounded(store, monkeypatch):
+    monkeypatch.setattr(sampling_checkpoint, "MAX_CHECKPOINT_MEMORY", 3000)
+    checkpoint = sampling_checkpoint.SamplingCheckpoint("key")
+    x = torch.zeros(1, 4, 8, 8)
+    for _ in range(20):
+        checkpoint.calc_cond_batch(lambda: [x.clone(), x.clone()], x)
+        assert checkpoint.memory <= 3000
+    assert len(checkpoint.chunks) > 0
+    assert all(torch.equal(checkpoint.recorded(i)[0], x) for i in range(20))
+    checkpoint.close()
+
+
+def test_mismatch_discards_the_checkpoint(store):
+    preempted(FakeSampling())
+    sampling = FakeSampling(shift=1.0)
+    reference = FakeSampling(shift=1.0).run("other")
+    resumed = sampling.run()
+    assert sampling.calls == 8
+    assert torch.equal(resumed, reference)
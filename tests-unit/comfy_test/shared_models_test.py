@@ -0,0 +1,66 @@
+import gc
+import os
+
+import pytest
+
+import comfy.shared_models
+
+
+class FakeModel:
+    pass
+
+
+@pytest.fixture
+def loader(monkeypatch):
+    monkeypatch.setattr(comfy.shared_models.args, "parallel_prompts", 2)
+    monkeypatch.setattr(comfy.shared_models, "models", comfy.shared_models.SharedModels())
+    calls = []
+
+    @comfy.shared_models.shared_load("path")
+    def load(path, options={}, output_clip=True):
+        calls.append(path)
+        return (FakeModel(), FakeModel() if output_clip else None)
+
+    load.calls = calls
+    return load
+
+
+@pytest.fixture
+def model_file(tmp_path):
+    path = tmp_path / "model.safetensors"
+    path.write_bytes(b"a")
+    return str(path)
+
+
+def test_same_file_and_options_share_the_load(loader, model_file):
+    a = loader(model_file, {"dtype": "fp16"})
+    b = loader(model_file, options={"dtype": "fp16"})
+    assert a[0] is b[0] and a[1] is b[1]
+    assert len(loader.calls) == 1
+
+    c = loader(model_file, {"dtype": "fp8"})
+    d = loader(model_file, {"dtype": "fp16"}, output_clip=False)
+    assert c[0] is not a[0] and d[0] is not a[0] and d[1] is None
+    assert len(loader.calls) == 3
+
+
+def test_changed_file_is_loaded_again(loader, model_file):
+    a = loader(model_file)
+    with open(model_file, "wb") as f:
+        f.write(b"bb")
+    os.utime(model_file, ns=(0, 1))
+    assert loader(model_file)[0] is not a[0]
+
+
+def test_loads_are_not_kept_alive(loader, model_file):
+    a = loader(model_file)
+    del a
+    gc.collect()
+    loader(model_file)
+    assert len(loader.calls) == 2
+
+
+def test_disabled_without_parallel_prompts(loader, model_file, monkeypatch):
+    monkeypatch.setattr(comfy.shared_models.args, "parallel_prompts", 1)
+    a = loader(model_file)
+    assert loader(model_file)[0] is not a[0]
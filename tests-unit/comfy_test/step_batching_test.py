@@ -0,0 +1,213 @@
+import threading
+
+import pytest
+import torch
+
+import comfy.cli_args
+# model_management picks its device when imported, the fake models run on the cpu
+comfy.cli_args.args.cpu = True
+
+import comfy.model_management  # noqa: E402
+import comfy.step_batching  # noqa: E402
+from comfy.step_batching import EvalRequest, ModelScheduler, merge_requests  # noqa: E402
+
+
+class FakeModel:
+    def __init__(self, max_rows=None):
+        self.calls = []
+        self.max_rows = max_rows
+
+    def apply_model(self, x, t, c_crossattn=None, transformer_options={}):
+        self.calls.append(x.shape[0])
+        if self.max_rows is not None and x.shape[0] > self.max_rows:
+            raise comfy.model_management.OOM_EXCEPTION("fake oom")
+        return x * t.reshape(-1, 1, 1, 1) + c_crossattn.mean(dim=(1, 2)).reshape(-1, 1, 1, 1)
+
+    def memory_required(self, input_shape):
+        return input_shape[0] * 100
+
+
+def make_request(batch=1, seed=0, sigma=None, patches=None, channels=4):
+    g = torch.Generator().manual_seed(seed)
+    rows = batch * 2
+    t = torch.rand(batch, generator=g) if sigma is None else torch.full((batch,), sigma)
+    transformer_options = {"cond_or_uncond": [0, 1], "uuids": [seed, seed + 1], "sigmas": t}
+    if patches is not None:
+        transformer_options["patches"] = patches
+    c = {"c_crossattn": torch.randn(rows, 77, 16, generator=g), "transformer_options": transformer_options}
+    return EvalRequest(torch.randn(rows, channels, 8, 8, generator=g), torch.cat([t, t]), c)
+
+
+def reference(request):
+    return FakeModel().apply_model(request.input_x, request.timestep, **request.c)
+
+
+@pytest.fixture
+def free_memory(monkeypatch):
+    def _set(value):
+        monkeypatch.setattr(comfy.model_management, "get_free_memory", lambda *args, **kwargs: value)
+    return _set
+
+
+def test_can_merge_same_layout():
+    assert make_request(seed=0).can_merge(make_request(seed=1))
+
+
+def test_can_merge_rejects_different_inputs():
+    a = make_request()
+    assert not a.can_merge(make_request(channels=8))
+    assert not a.can_merge(make_request(batch=2))
+
+    b = make_request(seed=1)
+    b.c["transformer_options"]["cond_or_uncond"] = [0]
+    b.chunk_rows = b.rows
+    assert not a.can_merge(b)
+
+    c = make_request(seed=1)
+    c.c["control"] = {"strength": 1.0}
+    assert not a.can_merge(c)
+
+
+def test_can_merge_patches_need_same_sigmas():
+    patches = {"attn1_patch": [len]}
+    assert make_request(sigma=1.0, patches=patches).can_merge(make_request(seed=1, sigma=1.0, patches=patches))
+    assert not make_request(sigma=1.0, patches=patches).can_merge(make_request(seed=1, sigma=2.0, patches=patches))
+    assert not make_request(sigma=1.0, patches=patches).can_merge(make_request(seed=1, sigma=1.0, patches={"attn1_patch": [abs]}))
+    assert make_request(sigma=1.0, patches={}).can_merge(make_request(seed=1, sigma=2.0, patches={}))
+
+
+def test_merge_requests_splits_rows():
+    batch = [make_request(seed=0), make_request(seed=1), make_request(seed=2)]
+    input_x, timestep, c = merge_requests(batch)
+    assert input_x.shape[0] == 6
+    assert torch.equal(timestep, torch.cat([r.timestep for r in batch]))
+    assert c["transformer_options"]["cond_or_uncond"] == [0, 1] * 3
+    assert c["transformer_options"]["uuids"] == [0, 1, 1, 2, 2, 3]
+    assert torch.equal(c["transformer_options"]["sigmas"], torch.cat([r.c["transformer_options"]["sigmas"] for r in batch]))
+
+    model = FakeModel()
+    ModelScheduler().run(model, batch)
+    assert model.calls == [6]
+    for r in batch:
+        assert r.done and r.error is None
+        assert torch.allclose(r.output, reference(r))
+
+
+def test_merge_requests_keeps_shared_sigmas():
+    batch = [make_request(seed=0, sigma=1.0), make_request(seed=1, sigma=1.0)]
+    _, _, c = merge_requests(batch)
+    assert c["transformer_options"]["sigmas"] is batch[0].c["transformer_options"]["sigmas"]
+
+
+def test_take_batch_memory_limit(free_memory):
+    free_memory(1000)
+    scheduler = ModelScheduler()
+    request = make_request(seed=0)
+    others = [make_request(seed=i) for i in range(1, 4)]
+    incompatible = make_request(seed=9, channels=8)
+    scheduler.pending = [request, incompatible] + others
+
+    # 1.5 * 100 bytes per row, 6 rows fit in 1000
+    batch = scheduler.take_batch(FakeModel(), request)
+    assert batch == [request] + others[:2]
+    assert scheduler.pending == [incompatible, others[2]]
+    assert all(r.ready for r in scheduler.pending)
+
+    free_memory(0)
+    scheduler.pending = [request] + others
+    assert scheduler.take_batch(FakeModel(), request) == [request]
+
+
+def test_oom_falls_back_to_single_requests(monkeypatch):
+    monkeypatch.setattr(comfy.model_management, "soft_empty_cache", lambda *args, **kwargs: None)
+    batch = [make_request(seed=0), make_request(seed=1)]
+    model = FakeModel(max_rows=2)
+    ModelScheduler().run(model, batch)
+    assert model.calls == [4, 2, 2]
+    for r in batch:
+        assert r.error is None
+        assert torch.allclose(r.output, reference(r))
+
+
+def test_errors_reach_all_requests():
+    batch = [make_request(seed=0), make_request(seed=1)]
+    model = FakeModel(max_rows=0)
+    ModelScheduler().run(model, batch)
+    assert all(isinstance(r.error, comfy.model_management.OOM_EXCEPTION) and r.done for r in batch)
+
+
+def test_apply_model_merges_concurrent_requests(monkeypatch):
+    monkeypatch.setattr(comfy.step_batching, "BATCH_WAIT", 5.0)
+    scheduler = ModelScheduler()
+    scheduler.join("a")
+    scheduler.join("b")
+    model = FakeModel()
+    requests = [make_request(seed=0), make_request(seed=1)]
+    outputs = {}
+
+    def evaluate(i):
+        r = requests[i]
+        outputs[i] = scheduler.apply_model(model, r.input_x, r.timestep, r.c)
+
+    threads = [threading.Thread(target=evaluate, args=(i,)) for i in range(2)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join(10)
+    assert model.calls == [4]
+    for i, r in enumerate(requests):
+        assert torch.allclose(outputs[i], reference(r))
+
+
+def acquire_in_thread(scheduler, state):
+    acquired = threading.Event()
+    thread = threading.Thread(target=lambda: (scheduler.acquire(state), acquired.set()), daemon=True)
+    thread.start()
+    return acquired
+
+
+def test_acquire_exclusive():
+    scheduler = ModelScheduler()
+    scheduler.acquire(None)
+    shared = acquire_in_thread(scheduler, "state")
+    assert not shared.wait(0.2)
+    scheduler.release()
+    assert shared.wait(5)
+
+    exclusive = acquire_in_thread(scheduler, None)
+    assert not exclusive.wait(0.2)
+    scheduler.release()
+    assert exclusive.wait(5)
+    scheduler.release()
+    assert scheduler.users == 0 and scheduler.state is None
+
+
+def test_acquire_shares_same_state():
+    scheduler = ModelScheduler()
+    scheduler.acquire("state")
+    same = acquire_in_thread(scheduler, "state")
+    assert same.wait(5)
+    assert scheduler.users == 2
+
+    other = acquire_in_thread(scheduler, "other")
+    assert not other.wait(0.2)
+    scheduler.release()
+    assert not other.wait(0.2)
+    scheduler.release()
+    assert other.wait(5)
+    assert scheduler.state == "other"
+    scheduler.release()
+
+
+def test_session_models_stay_in_use(monkeypatch):
+    monkeypatch.setattr(comfy.step_batching.args, "parallel_prompts", 2)
+    patcher = type("Patcher", (), {"patches_uuid": 0, "object_patches": {}})
+    model, control = patcher(), patcher()
+    model.model, control.model = torch.nn.Linear(1, 1), torch.nn.Linear(1, 1)
+
+    with comfy.step_batching.SamplingSession(model) as session:
+        session.use([model, control])
+        assert comfy.step_batching.in_use(model.model)
+        assert comfy.step_batching.in_use(control.model)
+    assert not comfy.step_batching.in_use(model.model)
+    assert not comfy.step_batching.in_use(control.model)
@@ -0,0 +1,73 @@
+import gc
+
+import pytest
+import torch
+
+import comfy.cli_args
+# model_management picks its device when imported
+comfy.cli_args.args.cpu = True
+
+import comfy.tensor_intern  # noqa: E402
+from comfy.tensor_intern import intern_weights, is_shared, restore_shared  # noqa: E402
+
+
+@pytest.fixture(autouse=True)
+def interner(monkeypatch):
+    monkeypatch.setattr(comfy.tensor_intern, "interner", comfy.tensor_intern.TensorInterner())
+
+
+def make_model(seed):
+    torch.manual_seed(seed)
+    return torch.nn.Sequential(torch.nn.Linear(128, 256), torch.nn.Linear(256, 128)).requires_grad_(False)
+
+
+def storage_ref(tensor):
+    return comfy.tensor_intern.TensorRef(tensor).storage
+
+
+def test_identical_weights_are_shared():
+    a, b, c = make_model(0), make_model(0), make_model(1)
+    assert intern_weights(a) == 0
+    assert intern_weights(b) == a[0].weight.nbytes + a[1].weight.nbytes
+    assert intern_weights(c) == 0
+    assert a[0].weight.data_ptr() == b[0].weight.data_ptr()
+    assert a[1].weight.data_ptr() == b[1].weight.data_ptr()
+    assert a[0].weight.data_ptr() != c[0].weight.data_ptr()
+    assert is_shared(b, "0.weight")
+
+
+def test_weights_are_not_kept_alive():
+    a = make_model(0)
+    intern_weights(a)
+    ref = storage_ref(a[0].weight)
+    # what a move to another device does to the cpu weights
+    a.to(torch.float64)
+    gc.collect()
+    assert ref() is None
+
+
+def test_shared_weights_live_while_a_model_uses_them():
+    a, b = make_model(0), make_model(0)
+    intern_weights(a)
+    intern_weights(b)
+    ref = storage_ref(a[0].weight)
+    a.to(torch.float64)
+    gc.collect()
+    assert ref() is not None
+    del b
+    gc.collect()
+    assert ref() is None
+
+
+def test_restore_shared_checks_the_content():
+    a, b = make_model(0), make_model(0)
+    intern_weights(a)
+    intern_weights(b)
+
+    # offloaded copies: one identical and one that was modified
+    b[0].weight = torch.nn.Parameter(b[0].weight.clone(), requires_grad=False)
+    b[1].weight = torch.nn.Parameter(b[1].weight.clone() + 1, requires_grad=False)
+    restore_shared(b)
+    assert b[0].weight.data_ptr() == a[0].weight.data_ptr()
+    assert b[1].weight.data_ptr() != a[1].weight.data_ptr()
+    assert torch.equal(b[1].weight, a[1].weight + 1)